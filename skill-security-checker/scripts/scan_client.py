@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Skill Security Scanner の軽量クライアント
+
+常駐中のスキャナー（skill_scanner.py --serve）にスキャンを依頼し、
+`skill_scanner.py <path> --json` と同じ JSON を出力する。
+常駐していなければ、プロセス内でスキャンして同じ結果を返す。
+
+Usage:
+    python3 skill_scanner.py --serve &      # 常駐を開始
+    python3 scan_client.py <path>           # 常駐していれば依頼、なければプロセス内でスキャン
+
+Exit codes:
+    0 = SAFE (問題なし)
+    1 = WARNING (要確認)
+    2 = DANGER (インストール非推奨)
+"""
+
+# 起動を速くするため skill_scanner は import しない（import するとルールのコンパイルが走る）。
+# プロトコルとソケットの既定パスは skill_scanner.py の常駐モードと揃えること。
+
+import json
+import os
+import socket
+import sys
+from pathlib import Path
+from typing import Optional
+
+SCANNER_PATH = Path(__file__).resolve().parent / "skill_scanner.py"
+SOCKET_FILENAME = "scanner.sock"
+CONNECT_TIMEOUT = 0.5  # 秒
+RESPONSE_TIMEOUT = 300.0  # 秒
+EXIT_CODES = {"SAFE": 0, "WARNING": 1, "DANGER": 2}
+
+
+def default_socket_path() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+    return Path(base) / "skill-security-checker" / SOCKET_FILENAME
+
+
+def request_scan(target: Path, socket_path: Path) -> Optional[dict]:
+    """常駐スキャナーに依頼する。接続できない・応答が使えない場合は None"""
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    try:
+        stamp = SCANNER_PATH.stat().st_mtime_ns
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(CONNECT_TIMEOUT)
+            conn.connect(str(socket_path))
+            conn.settimeout(RESPONSE_TIMEOUT)
+            with conn.makefile("rwb") as stream:
+                request = {"path": str(target), "stamp": stamp}
+                stream.write(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+                stream.flush()
+                response = json.loads(stream.readline())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(response, dict) or "error" in response:
+        # "stale"（スキャナーが更新された）などはプロセス内スキャンに任せる
+        return None
+    return response
+
+
+def scan_in_process(target: Path) -> dict:
+    sys.path.insert(0, str(SCANNER_PATH.parent))
+    import skill_scanner
+
+    cache = skill_scanner.open_cache(None)
+    try:
+        return skill_scanner.scan_target(target, cache=cache).to_dict()
+    finally:
+        if cache:
+            cache.close()
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) != 1 or args[0] in {"-h", "--help"}:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
+
+    target = Path(args[0]).expanduser().resolve()
+    env_socket = os.environ.get("SKILL_SCANNER_SOCKET")
+    socket_path = Path(env_socket).expanduser() if env_socket else default_socket_path()
+    result = request_scan(target, socket_path)
+    if result is None:
+        result = scan_in_process(target)
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    sys.exit(EXIT_CODES.get(result.get("verdict"), 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,17 @@ Skill Security Scanner - Claude Code スキルの安全性を自動検査する
 Usage:
     python3 skill_scanner.py <path>            # スキャンのみ
     python3 skill_scanner.py <path> --json      # JSON出力のみ
+    python3 skill_scanner.py <path> --stream ndjson  # 検出を1件1行で逐次出力（sarif も可）
     python3 skill_scanner.py <path> --install   # スキャン → SAFEなら自動インストール
+    python3 skill_scanner.py --rollback <name>  # インストール前のバージョンに戻す
+    python3 skill_scanner.py <path> --jobs 8    # 8プロセスで並列スキャン
+    python3 skill_scanner.py <path> --no-cache  # スキャン結果キャッシュを使わない
+    python3 skill_scanner.py --watch            # ~/.claude/skills を監視し判定の変化を出力
+    python3 skill_scanner.py --batch <path>...  # 複数スキルをまとめてスキャン（NDJSON出力）
+    python3 skill_scanner.py <repo> --git-history  # Git の全履歴をスキャン
+    python3 skill_scanner.py <path> --install --fail-fast  # DANGER が確定した時点で打ち切る
+    python3 skill_scanner.py <path> --json --metrics-file scan.prom  # 所要時間などを OpenMetrics に書く
+    find . -name '*.skill' | python3 skill_scanner.py --batch --paths-from -
 
 Exit codes:
     0 = SAFE (問題なし)
@@ -14,17 +24,46 @@ Exit codes:
 """
 
 import argparse
+import asyncio
+import codecs
+import errno
+import fnmatch
+import hashlib
+import heapq
+import io
 import json
 import os
 import re
 import shutil
+import socket
+import sqlite3
+import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
 import zipfile
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
 from dataclasses import dataclass, field, asdict
 from enum import IntEnum
-from pathlib import Path
-from typing import Optional
+from itertools import accumulate, chain
+from pathlib import Path, PurePath, PurePosixPath
+from typing import Iterable, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
 
 
 class Severity(IntEnum):
@@ -61,6 +100,8 @@ class Finding:
     line: int
     matched_text: str
     in_code_block: bool = False
+    # Markdown の文脈（CONTEXT_PRIORITY のいずれか）。無ければ None
+    context: Optional[str] = None
 
     def to_dict(self) -> dict:
         return {
@@ -72,45 +113,219 @@ class Finding:
             "line": self.line,
             "matched_text": self.matched_text,
             "in_code_block": self.in_code_block,
+            "context": self.context,
         }
 
 
+class FindingStore:
+    """スキャン全体の検出を列ごとの配列で保持する
+
+    カテゴリ・メッセージ・ファイル名は ID に置き換え、文字列は1つずつだけ持つ。
+    cap を指定すると、同じファイルの同じルールの検出は最初の cap 件だけ保持し、
+    残りは件数だけ数える（suppressed）。
+    """
+
+    __slots__ = (
+        "cap", "kinds", "files", "_kind_ids", "_file_ids", "_hit_counts",
+        "_kind_col", "_file_col", "_line_col", "_flag_col", "_texts",
+    )
+
+    def __init__(self, cap: Optional[int] = None):
+        self.cap = cap
+        self.kinds: list[tuple[str, str]] = []  # ルール ID → (category, message)
+        self.files: list[str] = []  # ファイル ID → 相対パス
+        self._kind_ids: dict[tuple[str, str], int] = {}
+        self._file_ids: dict[str, int] = {}
+        # (ルール ID, ファイル ID) → 検出件数（cap 指定時のみ）
+        self._hit_counts: dict[tuple[int, int], int] = {}
+        self._kind_col = array("i")
+        self._file_col = array("i")
+        self._line_col = array("i")
+        # severity | in_code_block << 3 | 文脈の番号（_CONTEXT_IDS）<< 4
+        self._flag_col = array("B")
+        self._texts: list[str] = []
+
+    def _intern(self, ids: dict, table: list, value) -> int:
+        idx = ids.get(value)
+        if idx is None:
+            idx = ids[value] = len(table)
+            table.append(value)
+        return idx
+
+    def add(self, f: Finding, keep: bool = True) -> bool:
+        """検出を追加する。cap を超えて省略した場合は False（keep=False なら数えるだけ）"""
+        kind = self._intern(self._kind_ids, self.kinds, (f.category, f.message))
+        file_id = self._intern(self._file_ids, self.files, f.file)
+        if self.cap is not None:
+            key = (kind, file_id)
+            hits = self._hit_counts[key] = self._hit_counts.get(key, 0) + 1
+            if hits > self.cap:
+                return False
+        if keep:
+            self._kind_col.append(kind)
+            self._file_col.append(file_id)
+            self._line_col.append(f.line)
+            self._flag_col.append(
+                int(f.severity) | (f.in_code_block << 3) | (_CONTEXT_IDS[f.context] << 4)
+            )
+            self._texts.append(f.matched_text)
+        return True
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def __iter__(self) -> Iterator[Finding]:
+        kinds, files = self.kinds, self.files
+        for kind, file_id, line, flags, text in zip(
+            self._kind_col, self._file_col, self._line_col, self._flag_col, self._texts
+        ):
+            category, message = kinds[kind]
+            yield Finding(
+                category=category,
+                severity=Severity(flags & 7),
+                message=message,
+                file=files[file_id],
+                line=line,
+                matched_text=text,
+                in_code_block=bool(flags & 8),
+                context=_CONTEXT_NAMES[flags >> 4],
+            )
+
+    def suppressed(self) -> list[dict]:
+        """cap を超えて省略した検出の件数（ファイル・ルールごと）"""
+        return [
+            {
+                "category": self.kinds[kind][0],
+                "message": self.kinds[kind][1],
+                "file": self.files[file_id],
+                "count": hits - self.cap,
+            }
+            for (kind, file_id), hits in self._hit_counts.items()
+            if hits > self.cap
+        ]
+
+
 @dataclass
 class ScanResult:
     path: str
     file_count: int = 0
     total_lines: int = 0
-    findings: list = field(default_factory=list)
+    findings: FindingStore = field(default_factory=FindingStore)
     errors: list = field(default_factory=list)
     verdict: str = "SAFE"
+    cache_stats: Optional[dict] = None
+    # サイズ上限を超えてスキャンしなかったファイル数
+    skipped_files: int = 0
+    # --profile 時のルールごとの評価コスト
+    profile: Optional[dict] = None
+    # インストール済みのスキルを更新する場合の差分スキャンの内訳（SkillUpdate.finish）
+    update: Optional[dict] = None
+    # --git-history 時の履歴の規模と、検出のあったブロブを追加・変更したコミット
+    history: Optional[dict] = None
+    # --fail-fast や上限で打ち切った場合の理由と、そこまでに読んだ量（ScanCutoff.to_dict）
+    partial: Optional[dict] = None
+    # severity ごとの件数（添字が Severity の値）。add_findings で差分更新する
+    severity_counts: list = field(default_factory=lambda: [0] * len(Severity))
+    # --metrics 時のフェーズごとの所要時間と件数（ScanMetrics.to_dict）
+    metrics: Optional[dict] = None
+
+    def add_findings(self, findings: Iterable[Finding], reporter=None):
+        """検出を追加する。reporter があれば保持せずに逐次書き出す"""
+        counts = self.severity_counts
+        store = self.findings
+        if reporter is None:
+            for f in findings:
+                counts[f.severity] += 1
+                store.add(f)
+        elif store.cap is None:
+            for f in findings:
+                counts[f.severity] += 1
+                reporter.finding(f)
+        else:
+            for f in findings:
+                counts[f.severity] += 1
+                if store.add(f, keep=False):
+                    reporter.finding(f)
+
+    def summary(self) -> dict:
+        return {SEVERITY_LABELS[sev]: self.severity_counts[sev] for sev in reversed(Severity)}
 
     def to_dict(self) -> dict:
-        return {
+        d = {
             "path": self.path,
             "file_count": self.file_count,
             "total_lines": self.total_lines,
             "verdict": self.verdict,
-            "summary": {
-                "CRITICAL": sum(1 for f in self.findings if f.severity == Severity.CRITICAL),
-                "HIGH": sum(1 for f in self.findings if f.severity == Severity.HIGH),
-                "MEDIUM": sum(1 for f in self.findings if f.severity == Severity.MEDIUM),
-                "LOW": sum(1 for f in self.findings if f.severity == Severity.LOW),
-                "INFO": sum(1 for f in self.findings if f.severity == Severity.INFO),
-            },
+            "summary": self.summary(),
             "findings": [f.to_dict() for f in self.findings],
             "errors": self.errors,
         }
+        suppressed = self.findings.suppressed() if self.findings.cap is not None else []
+        if suppressed:
+            d["suppressed"] = suppressed
+        if self.cache_stats is not None:
+            d["cache"] = self.cache_stats
+        if self.profile is not None:
+            d["profile"] = self.profile
+        if self.update is not None:
+            d["update"] = self.update
+        if self.history is not None:
+            d["history"] = self.history
+        if self.partial is not None:
+            d["partial"] = self.partial
+        if self.metrics is not None:
+            d["metrics"] = self.metrics
+        return d
 
 
 # ---------------------------------------------------------------------------
 # 危険パターン定義（8カテゴリ）
 # ---------------------------------------------------------------------------
 
-PATTERNS: list[tuple[str, str, int, str]] = []
+@dataclass(frozen=True)
+class Rule:
+    category: str
+    pattern: str
+    severity: int
+    message: str
+    # True の場合は行単位ではなくバッファ全体に適用し、改行をまたぐマッチを許す
+    multiline: bool = False
+    # 評価するファイル種別（FILE_CLASSES の値）。None は全種別
+    applies_to: Optional[frozenset] = None
+
+
+PATTERNS: list[Rule] = []
+
+# 拡張子 → ファイル種別。ここに無い拡張子（拡張子なしを含む）は全ルールを評価する
+FILE_CLASSES = {
+    ".md": "doc", ".txt": "doc",
+    ".py": "python",
+    ".js": "js", ".ts": "js", ".jsx": "js", ".tsx": "js",
+    ".sh": "shell", ".bash": "shell", ".zsh": "shell", ".fish": "shell",
+    ".rb": "code", ".go": "code", ".rs": "code", ".java": "code", ".php": "code",
+    ".json": "config", ".yaml": "config", ".yml": "config", ".toml": "config",
+    ".env": "config", ".cfg": "config", ".ini": "config", ".conf": "config",
+    ".html": "markup",
+    ".css": "style", ".scss": "style",
+}
+
+# よく使う applies_to。スキルの Markdown はエージェントへの指示そのものなので、
+# doc は常に含める。シェルスクリプトは heredoc で他言語を埋め込むことが多い
+_ANY_BUT_STYLE = frozenset(set(FILE_CLASSES.values()) - {"style"})
+_CODE_LIKE = frozenset({"doc", "python", "js", "shell", "code", "markup"})
+_PYTHON_LIKE = frozenset({"doc", "python", "shell"})
+_JS_LIKE = frozenset({"doc", "js", "shell", "markup"})
 
 
-def _p(category: str, pattern: str, severity: int, message: str):
-    PATTERNS.append((category, pattern, severity, message))
+def _p(
+    category: str,
+    pattern: str,
+    severity: int,
+    message: str,
+    multiline: bool = False,
+    applies_to: Optional[frozenset] = None,
+):
+    PATTERNS.append(Rule(category, pattern, severity, message, multiline, applies_to))
 
 
 # 1. 認証情報の露出
@@ -122,495 +337,4681 @@ _p("credential_exposure", r'ghp_[A-Za-z0-9]{36}', Severity.CRITICAL, "GitHub Per
 _p("credential_exposure", r'xoxb-[0-9]{10,}-[A-Za-z0-9]{20,}', Severity.CRITICAL, "Slack Bot Tokenが含まれています")
 
 # 2. 危険コマンド
-_p("dangerous_command", r'\brm\s+-(?:[a-zA-Z]*r[a-zA-Z]*f|[a-zA-Z]*f[a-zA-Z]*r)[a-zA-Z]*\s', Severity.HIGH, "rm -rf コマンドが含まれています")
-_p("dangerous_command", r'\bsudo\s+', Severity.MEDIUM, "sudo コマンドが含まれています")
-_p("dangerous_command", r'\bcurl\b.*\|\s*(?:ba)?sh\b', Severity.CRITICAL, "リモートスクリプトのパイプ実行（curl|sh）")
-_p("dangerous_command", r'\bwget\b.*\|\s*(?:ba)?sh\b', Severity.CRITICAL, "リモートスクリプトのパイプ実行（wget|sh）")
-_p("dangerous_command", r'\beval\s*\(', Severity.HIGH, "eval() が使用されています")
-_p("dangerous_command", r'\bexec\s*\(', Severity.MEDIUM, "exec() が使用されています")
-_p("dangerous_command", r'\bDROP\s+(?:DATABASE|TABLE|SCHEMA)\b', Severity.CRITICAL, "DROP DATABASE/TABLE が含まれています")
-_p("dangerous_command", r'\bos\.system\s*\(', Severity.HIGH, "os.system() が使用されています")
-_p("dangerous_command", r'\bsubprocess\.(?:call|run|Popen)\s*\(.*shell\s*=\s*True', Severity.HIGH, "subprocess with shell=True が使用されています")
-_p("dangerous_command", r'--no-verify', Severity.MEDIUM, "--no-verify フラグが使用されています")
-_p("dangerous_command", r'\bgit\s+push\s+--force\b', Severity.HIGH, "git push --force が使用されています")
-_p("dangerous_command", r'\bgit\s+reset\s+--hard\b', Severity.HIGH, "git reset --hard が使用されています")
-_p("dangerous_command", r'\bchmod\s+777\b', Severity.HIGH, "chmod 777 が使用されています")
-_p("dangerous_command", r'\bmkfs\b', Severity.CRITICAL, "mkfs（ファイルシステム作成）が含まれています")
-_p("dangerous_command", r'\bdd\s+if=', Severity.HIGH, "dd コマンドが含まれています")
+_p("dangerous_command", r'\brm\s+-(?:[a-zA-Z]*r[a-zA-Z]*f|[a-zA-Z]*f[a-zA-Z]*r)[a-zA-Z]*\s', Severity.HIGH, "rm -rf コマンドが含まれています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bsudo\s+', Severity.MEDIUM, "sudo コマンドが含まれています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bcurl\b.*\|\s*(?:ba)?sh\b', Severity.CRITICAL, "リモートスクリプトのパイプ実行（curl|sh）", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bwget\b.*\|\s*(?:ba)?sh\b', Severity.CRITICAL, "リモートスクリプトのパイプ実行（wget|sh）", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\b(?:curl|wget)\b[^\n]*(?:\|[ \t]*\\?[ \t]*\r?\n|\\[ \t]*\r?\n(?:[^\n]*\\[ \t]*\r?\n)*[^\n]*\|)\s*(?:ba)?sh\b', Severity.CRITICAL, "改行をまたぐリモートスクリプトのパイプ実行（curl/wget|sh）", multiline=True, applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\beval\s*\(', Severity.HIGH, "eval() が使用されています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bexec\s*\(', Severity.MEDIUM, "exec() が使用されています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bDROP\s+(?:DATABASE|TABLE|SCHEMA)\b', Severity.CRITICAL, "DROP DATABASE/TABLE が含まれています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bos\.system\s*\(', Severity.HIGH, "os.system() が使用されています", applies_to=_PYTHON_LIKE)
+_p("dangerous_command", r'\bsubprocess\.(?:call|run|Popen)\s*\(.*shell\s*=\s*True', Severity.HIGH, "subprocess with shell=True が使用されています", applies_to=_PYTHON_LIKE)
+_p("dangerous_command", r'--no-verify', Severity.MEDIUM, "--no-verify フラグが使用されています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bgit\s+push\s+--force\b', Severity.HIGH, "git push --force が使用されています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bgit\s+reset\s+--hard\b', Severity.HIGH, "git reset --hard が使用されています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bchmod\s+777\b', Severity.HIGH, "chmod 777 が使用されています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bmkfs\b', Severity.CRITICAL, "mkfs（ファイルシステム作成）が含まれています", applies_to=_ANY_BUT_STYLE)
+_p("dangerous_command", r'\bdd\s+if=', Severity.HIGH, "dd コマンドが含まれています", applies_to=_ANY_BUT_STYLE)
 
 # 3. データ窃取
-_p("data_exfiltration", r'(?:process\.env|os\.environ|ENV\[)', Severity.MEDIUM, "環境変数へのアクセス")
-_p("data_exfiltration", r'(?:fetch|axios|requests?\.(?:get|post)|urllib|http\.request)\s*\(.*(?:env|token|key|secret|password|credential)', Severity.CRITICAL, "認証情報を含む外部リクエスト")
-_p("data_exfiltration", r'(?:fetch|axios|requests?\.(?:get|post))\s*\([^)]*(?:ngrok|webhook\.site|requestbin|pipedream|burpcollaborator)', Severity.CRITICAL, "不審な外部エンドポイントへの送信")
-_p("data_exfiltration", r'~/.ssh/', Severity.HIGH, "SSH鍵ディレクトリへのアクセス")
-_p("data_exfiltration", r'~/.aws/', Severity.HIGH, "AWS認証ディレクトリへのアクセス")
-_p("data_exfiltration", r'~/.claude/(?:settings|credentials|\.mcp)', Severity.CRITICAL, "Claude設定ファイルへのアクセス")
-_p("data_exfiltration", r'(?:readFile|cat|type)\s+.*\.env\b', Severity.HIGH, ".env ファイルの読み取り")
+_p("data_exfiltration", r'(?:process\.env|os\.environ|ENV\[)', Severity.MEDIUM, "環境変数へのアクセス", applies_to=_CODE_LIKE)
+_p("data_exfiltration", r'(?:fetch|axios|requests?\.(?:get|post)|urllib|http\.request)\s*\(.*(?:env|token|key|secret|password|credential)', Severity.CRITICAL, "認証情報を含む外部リクエスト", applies_to=_CODE_LIKE)
+_p("data_exfiltration", r'(?:fetch|axios|requests?\.(?:get|post))\s*\([^)]*(?:ngrok|webhook\.site|requestbin|pipedream|burpcollaborator)', Severity.CRITICAL, "不審な外部エンドポイントへの送信", applies_to=_CODE_LIKE)
+_p("data_exfiltration", r'~/.ssh/', Severity.HIGH, "SSH鍵ディレクトリへのアクセス", applies_to=_ANY_BUT_STYLE)
+_p("data_exfiltration", r'~/.aws/', Severity.HIGH, "AWS認証ディレクトリへのアクセス", applies_to=_ANY_BUT_STYLE)
+_p("data_exfiltration", r'~/.claude/(?:settings|credentials|\.mcp)', Severity.CRITICAL, "Claude設定ファイルへのアクセス", applies_to=_ANY_BUT_STYLE)
+_p("data_exfiltration", r'(?:readFile|cat|type)\s+.*\.env\b', Severity.HIGH, ".env ファイルの読み取り", applies_to=_ANY_BUT_STYLE)
 
 # 4. パストラバーサル
-_p("path_traversal", r'\.\.\/\.\.', Severity.HIGH, "パストラバーサル（../../）")
-_p("path_traversal", r'/etc/(?:passwd|shadow|hosts)', Severity.CRITICAL, "システムファイルへのアクセス")
-_p("path_traversal", r'~/.claude/(?:settings|CLAUDE)\.md', Severity.HIGH, "Claude設定ファイルの書き換え")
-_p("path_traversal", r'~/.claude/\.mcp\.json', Severity.CRITICAL, "MCP設定ファイルへのアクセス")
+_p("path_traversal", r'\.\.\/\.\.', Severity.HIGH, "パストラバーサル（../../）", applies_to=_ANY_BUT_STYLE)
+_p("path_traversal", r'/etc/(?:passwd|shadow|hosts)', Severity.CRITICAL, "システムファイルへのアクセス", applies_to=_ANY_BUT_STYLE)
+_p("path_traversal", r'~/.claude/(?:settings|CLAUDE)\.md', Severity.HIGH, "Claude設定ファイルの書き換え", applies_to=_ANY_BUT_STYLE)
+_p("path_traversal", r'~/.claude/\.mcp\.json', Severity.CRITICAL, "MCP設定ファイルへのアクセス", applies_to=_ANY_BUT_STYLE)
 
 # 5. 権限バイパス
-_p("permission_bypass", r'dangerouslyDisableSandbox', Severity.CRITICAL, "サンドボックスの無効化")
-_p("permission_bypass", r'bypassPermissions', Severity.CRITICAL, "権限バイパスの設定")
-_p("permission_bypass", r'"mode"\s*:\s*"(?:bypassPermissions|dontAsk)"', Severity.HIGH, "権限チェックのバイパスモード")
-_p("permission_bypass", r'allowedTools.*\*', Severity.MEDIUM, "全ツール許可のワイルドカード")
+_p("permission_bypass", r'dangerouslyDisableSandbox', Severity.CRITICAL, "サンドボックスの無効化", applies_to=_ANY_BUT_STYLE)
+_p("permission_bypass", r'bypassPermissions', Severity.CRITICAL, "権限バイパスの設定", applies_to=_ANY_BUT_STYLE)
+_p("permission_bypass", r'"mode"\s*:\s*"(?:bypassPermissions|dontAsk)"', Severity.HIGH, "権限チェックのバイパスモード", applies_to=_ANY_BUT_STYLE)
+_p("permission_bypass", r'allowedTools.*\*', Severity.MEDIUM, "全ツール許可のワイルドカード", applies_to=_ANY_BUT_STYLE)
 
 # 6. プロンプトインジェクション
 _p("prompt_injection", r'(?:ignore|disregard|forget)\s+(?:all\s+)?(?:previous|prior|above)\s+(?:instructions?|rules?|constraints?)', Severity.CRITICAL, "プロンプトインジェクション: 以前の指示を無視")
 _p("prompt_injection", r'(?:act|behave|operate)\s+(?:as if|without)\s+(?:no\s+)?(?:restrictions?|constraints?|limitations?|rules?)', Severity.CRITICAL, "プロンプトインジェクション: 制約なしで動作")
 _p("prompt_injection", r'you\s+are\s+now\s+(?:DAN|jailbroken|unrestricted|unfiltered)', Severity.CRITICAL, "プロンプトインジェクション: ジェイルブレイク試行")
-_p("prompt_injection", r'<system>.*?</system>', Severity.HIGH, "偽のsystemタグ")
+_p("prompt_injection", r'<system>(?:(?!</?system>).){0,4000}</system>', Severity.HIGH, "偽のsystemタグ", multiline=True)
 _p("prompt_injection", r'system[\s_-]?prompt\s*[:=]', Severity.HIGH, "system prompt の上書き試行")
 _p("prompt_injection", r'IMPORTANT:\s*(?:ignore|override|disregard)', Severity.CRITICAL, "偽の重要指示（IMPORTANT:）")
 
 # 7. 難読化
-_p("obfuscation", r'(?:atob|btoa|base64\.(?:b64decode|b64encode|decode))\s*\(', Severity.MEDIUM, "Base64エンコード/デコードの使用")
-_p("obfuscation", r'\\x[0-9a-fA-F]{2}(?:\\x[0-9a-fA-F]{2}){3,}', Severity.HIGH, "Hexバイト列の使用")
-_p("obfuscation", r'String\.fromCharCode\s*\(', Severity.HIGH, "String.fromCharCode の使用")
-_p("obfuscation", r'(?:chr|ord)\s*\(\s*\d+\s*\)(?:\s*\+\s*(?:chr|ord)\s*\(\s*\d+\s*\)){3,}', Severity.HIGH, "文字コード連結による難読化")
-_p("obfuscation", r'\\u[0-9a-fA-F]{4}(?:\\u[0-9a-fA-F]{4}){5,}', Severity.MEDIUM, "Unicodeエスケープの連続使用")
+_p("obfuscation", r'(?:atob|btoa|base64\.(?:b64decode|b64encode|decode))\s*\(', Severity.MEDIUM, "Base64エンコード/デコードの使用", applies_to=_CODE_LIKE)
+_p("obfuscation", r'\\x[0-9a-fA-F]{2}(?:\\x[0-9a-fA-F]{2}){3,}', Severity.HIGH, "Hexバイト列の使用", applies_to=_ANY_BUT_STYLE)
+_p("obfuscation", r'String\.fromCharCode\s*\(', Severity.HIGH, "String.fromCharCode の使用", applies_to=_JS_LIKE)
+_p("obfuscation", r'(?:chr|ord)\s*\(\s*\d+\s*\)(?:\s*\+\s*(?:chr|ord)\s*\(\s*\d+\s*\)){3,}', Severity.HIGH, "文字コード連結による難読化", applies_to=_CODE_LIKE)
+_p("obfuscation", r'\\u[0-9a-fA-F]{4}(?:\\u[0-9a-fA-F]{4}){5,}', Severity.MEDIUM, "Unicodeエスケープの連続使用", applies_to=_ANY_BUT_STYLE)
 
 # 8. サプライチェーン
-_p("supply_chain", r'pip\s+install\s+(?!-r\b)(?!--upgrade\b)\S+', Severity.LOW, "pip install の実行")
-_p("supply_chain", r'npm\s+install\s+(?!--save-dev\b)(?!-D\b)\S+', Severity.LOW, "npm install の実行")
-_p("supply_chain", r'(?:curl|wget)\s+.*\.(?:sh|py|js|rb)\b', Severity.HIGH, "リモートスクリプトのダウンロード")
-_p("supply_chain", r'git\s+clone\s+', Severity.LOW, "git clone の実行")
-_p("supply_chain", r'npx\s+\S+', Severity.MEDIUM, "npx によるパッケージ直接実行")
+_p("supply_chain", r'pip\s+install\s+(?!-r\b)(?!--upgrade\b)\S+', Severity.LOW, "pip install の実行", applies_to=_ANY_BUT_STYLE)
+_p("supply_chain", r'npm\s+install\s+(?!--save-dev\b)(?!-D\b)\S+', Severity.LOW, "npm install の実行", applies_to=_ANY_BUT_STYLE)
+_p("supply_chain", r'(?:curl|wget)\s+.*\.(?:sh|py|js|rb)\b', Severity.HIGH, "リモートスクリプトのダウンロード", applies_to=_ANY_BUT_STYLE)
+_p("supply_chain", r'git\s+clone\s+', Severity.LOW, "git clone の実行", applies_to=_ANY_BUT_STYLE)
+_p("supply_chain", r'npx\s+\S+', Severity.MEDIUM, "npx によるパッケージ直接実行", applies_to=_ANY_BUT_STYLE)
+
+
+
+def _rule_flags(rule: Rule) -> int:
+    """ルールのコンパイルフラグ"""
+    if rule.multiline:
+        return re.IGNORECASE | re.MULTILINE | re.DOTALL
+    # 単一行ルールは行範囲に限定して search するため、^ が行頭にマッチするようにする
+    return re.IGNORECASE | re.MULTILINE
 
 
 # コンパイル済みパターン
 COMPILED_PATTERNS = [
-    (cat, re.compile(pat, re.IGNORECASE), sev, msg)
-    for cat, pat, sev, msg in PATTERNS
+    (rule.category, re.compile(rule.pattern, _rule_flags(rule)), rule.severity, rule.message)
+    for rule in PATTERNS
 ]
 
+# バッファ全体に適用する複数行ルールの番号
+MULTILINE_RULES: frozenset[int] = frozenset(
+    idx for idx, rule in enumerate(PATTERNS) if rule.multiline
+)
+
 # ---------------------------------------------------------------------------
-# Markdownコードブロック検出
+# リテラルアンカーによるプレフィルタ
 # ---------------------------------------------------------------------------
+#
+# 各ルールの正規表現から「マッチするなら必ず含まれる文字列」（アンカー）を
+# 抽出し、アンカーが1つも含まれない行ではそのルールの正規表現を実行しない。
+# 行ごとに全ルールを試す代わりに、アンカーの出現位置から候補行を求める。
 
-CODE_BLOCK_FENCE = re.compile(r'^(`{3,}|~{3,})')
+try:
+    from re import _parser as _sre_parse  # Python 3.11+
+except ImportError:  # pragma: no cover
+    import sre_parse as _sre_parse
 
+_sre_constants = _sre_parse._constants if hasattr(_sre_parse, "_constants") else _sre_parse
+
+_ZERO_WIDTH_OPS = {_sre_constants.AT, _sre_constants.ASSERT, _sre_constants.ASSERT_NOT}
+_REPEAT_OPS = {
+    getattr(_sre_constants, name)
+    for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+    if hasattr(_sre_constants, name)
+}
+
+
+def _fold(text: str) -> str:
+    """re.IGNORECASE と同じ同一視になるよう文字列を正規化する（プレフィルタ用）
+
+    オフセットを元の文字列と一致させるため、文字数は変えない。
+    """
+    if text.isascii():
+        return text.lower()
+    # IGNORECASE で ASCII 英字にマッチする非ASCII文字: İ ı ſ K(Kelvin)
+    # İ は lower() で2文字になるため先に置換する（K は lower() で "k" になる）
+    text = text.replace("\u0130", "i").lower()
+    return text.replace("\u0131", "i").replace("\u017f", "s")
+
+
+def _anchor_score(anchors: frozenset) -> tuple[int, int]:
+    """アンカー集合の選択性（最短長が長く、候補が少ないほど良い）"""
+    return min(len(a) for a in anchors), -len(anchors)
+
+
+def _required_literals(items) -> Optional[frozenset]:
+    """パース済みパターンから、マッチに必須なリテラルの候補集合を返す。
+
+    返り値の集合のうち少なくとも1つが必ずマッチ文字列に含まれる。
+    判定できない場合は None（常に候補ルールとして扱う）。
+    """
+    best: Optional[frozenset] = None
+    run: list[str] = []
+
+    def consider(cands: Optional[frozenset]):
+        nonlocal best
+        if cands and (best is None or _anchor_score(cands) > _anchor_score(best)):
+            best = cands
+
+    def flush():
+        if run:
+            consider(frozenset({"".join(run)}))
+            run.clear()
+
+    for op, av in items:
+        if op is _sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if op in _ZERO_WIDTH_OPS:
+            # 幅ゼロのアサーションは前後のリテラルの連続性を壊さない
+            continue
+        flush()
+        if op is _sre_constants.SUBPATTERN:
+            _group, add_flags, del_flags, sub = av
+            if not add_flags and not del_flags:
+                consider(_required_literals(sub))
+        elif op is _sre_constants.BRANCH:
+            alternatives = [_required_literals(branch) for branch in av[1]]
+            if all(alternatives):
+                consider(frozenset().union(*alternatives))
+        elif op in _REPEAT_OPS:
+            min_count, _max_count, sub = av
+            if min_count >= 1:
+                consider(_required_literals(sub))
+        elif op is getattr(_sre_constants, "ATOMIC_GROUP", None):
+            consider(_required_literals(av))
+    flush()
+    return best
+
+
+def extract_anchors(pattern: str) -> Optional[tuple[str, ...]]:
+    """正規表現からプレフィルタ用アンカー（正規化済み）を抽出する"""
+    try:
+        literals = _required_literals(_sre_parse.parse(pattern))
+    except Exception:
+        return None
+    if not literals or not all(lit.isascii() for lit in literals):
+        return None
+    return tuple(sorted({_fold(lit) for lit in literals}))
+
+
+# ルールごとのアンカー（None はアンカーなし = 常に評価）
+RULE_ANCHORS: list[Optional[tuple[str, ...]]] = [extract_anchors(rule.pattern) for rule in PATTERNS]
+
+
+@dataclass(frozen=True)
+class RuleSet:
+    """ファイル種別ごとに事前計算した、評価するルールのアンカー表"""
+    # アンカー → そのアンカーを持つルール番号
+    anchor_rules: dict
+    # アンカーを持たず、常に評価するルール番号
+    unanchored: frozenset
+    # デコード前のバイト列に対するプレフィルタ用のアンカー（ASCII）
+    byte_anchors: tuple = ()
+
+
+def build_rule_set(rule_ids: Iterable[int]) -> RuleSet:
+    anchor_rules: dict[str, list[int]] = {}
+    unanchored = set()
+    for idx in sorted(rule_ids):
+        if RULE_ANCHORS[idx] is None:
+            unanchored.add(idx)
+        for anchor in RULE_ANCHORS[idx] or ():
+            anchor_rules.setdefault(anchor, []).append(idx)
+    # 短いアンカーほどよく現れるので先に調べる（どれか1つ見つかれば十分）
+    byte_anchors = tuple(anchor.encode("ascii") for anchor in sorted(anchor_rules, key=lambda a: (len(a), a)))
+    return RuleSet(anchor_rules, frozenset(unanchored), byte_anchors)
 
-def build_code_block_map(lines: list[str]) -> set[int]:
-    """コードブロック内の行番号セットを返す"""
-    in_block = False
-    fence_char = None
-    fence_len = 0
-    block_lines = set()
-
-    for i, line in enumerate(lines):
-        stripped = line.strip()
-        m = CODE_BLOCK_FENCE.match(stripped)
-        if m:
-            char = m.group(1)[0]
-            length = len(m.group(1))
-            if not in_block:
-                in_block = True
-                fence_char = char
-                fence_len = length
-                block_lines.add(i)
-            elif char == fence_char and length >= fence_len:
-                block_lines.add(i)
-                in_block = False
-                fence_char = None
-                fence_len = 0
-            else:
-                block_lines.add(i)
-        elif in_block:
-            block_lines.add(i)
 
-    return block_lines
+ALL_RULES = build_rule_set(range(len(PATTERNS)))
+
+# ファイル種別 → そのファイルで評価するルール
+RULE_SETS: dict[str, RuleSet] = {
+    file_class: build_rule_set(
+        idx for idx, rule in enumerate(PATTERNS)
+        if rule.applies_to is None or file_class in rule.applies_to
+    )
+    for file_class in sorted(set(FILE_CLASSES.values()))
+}
+
+
+def file_class(rel_path: str) -> Optional[str]:
+    """ファイル種別（不明な拡張子は None）"""
+    return FILE_CLASSES.get(PurePosixPath(rel_path).suffix.lower())
+
+
+def rule_set_for(rel_path: str) -> RuleSet:
+    """ファイルに適用するルール。種別が不明なら全ルール"""
+    return RULE_SETS.get(file_class(rel_path), ALL_RULES)
 
 
 # ---------------------------------------------------------------------------
-# スキャナー本体
+# ルールの静的検査（破滅的バックトラック）
 # ---------------------------------------------------------------------------
+#
+# (a+)+ のように、上限なしの繰り返しの中に曖昧さ（上限なしの繰り返しや選択）が
+# あると、マッチしない入力に対してバックトラックが指数的に増える。
+# 繰り返しの本体に「本体の他の要素がマッチしえない必須の1文字」（区切り文字）が
+# あれば、1回の繰り返しがちょうど1つの区切り文字を消費するため分割は一意に決まる。
+# 区切り文字のない曖昧な繰り返しを持つルールは起動時に拒否する。
 
-# スキャン対象の拡張子
-SCAN_EXTENSIONS = {
-    ".md", ".txt", ".py", ".js", ".ts", ".jsx", ".tsx",
-    ".sh", ".bash", ".zsh", ".fish",
-    ".json", ".yaml", ".yml", ".toml",
-    ".html", ".css", ".scss",
-    ".rb", ".go", ".rs", ".java", ".php",
-    ".env", ".cfg", ".ini", ".conf",
-    "", # 拡張子なし（Makefile, Dockerfile等）
+_REPEAT_NAMES = {"MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"}
+_CATEGORY_CLASSES = {
+    "CATEGORY_DIGIT": re.compile(r"\d"),
+    "CATEGORY_NOT_DIGIT": re.compile(r"\D"),
+    "CATEGORY_SPACE": re.compile(r"\s"),
+    "CATEGORY_NOT_SPACE": re.compile(r"\S"),
+    "CATEGORY_WORD": re.compile(r"\w"),
+    "CATEGORY_NOT_WORD": re.compile(r"\W"),
 }
 
-# 除外パターン
-SKIP_DIRS = {
-    "__pycache__", "node_modules", ".git", ".venv", "venv",
-    ".mypy_cache", ".pytest_cache", "dist", "build",
-}
 
-MAX_ZIP_SIZE = 100 * 1024 * 1024  # 100MB
+def _is_unbounded(av) -> bool:
+    return av[1] == _sre_constants.MAXREPEAT
 
 
-def should_scan_file(path: Path) -> bool:
-    """スキャン対象かどうか判定"""
-    if path.suffix.lower() in SCAN_EXTENSIONS:
-        return True
-    # 拡張子なしファイルの場合、名前で判定
-    if path.suffix == "" and path.name in {
-        "Makefile", "Dockerfile", "Vagrantfile", "Gemfile",
-        "Rakefile", "Procfile", ".env",
-    }:
-        return True
+def _item_may_match(op, av, ch: str) -> bool:
+    """パース木の要素が文字 ch を消費しうるか（不明な要素は True と見なす）"""
+    name = str(op)
+    if name == "LITERAL":
+        return chr(av).lower() == ch.lower()
+    if name == "NOT_LITERAL":
+        return chr(av).lower() != ch.lower()
+    if name == "IN":
+        negate = False
+        hit = False
+        for sub_op, sub_av in av:
+            sub_name = str(sub_op)
+            if sub_name == "NEGATE":
+                negate = True
+            elif sub_name == "LITERAL":
+                hit = hit or chr(sub_av).lower() == ch.lower()
+            elif sub_name == "RANGE":
+                hit = hit or any(sub_av[0] <= ord(c) <= sub_av[1] for c in {ch, ch.lower(), ch.upper()})
+            elif sub_name == "CATEGORY":
+                category = _CATEGORY_CLASSES.get(str(sub_av))
+                # 不明なカテゴリは保守的にマッチしうるものとする
+                hit = hit or category is None or bool(category.match(ch))
+            else:
+                hit = True
+        return hit != negate
+    if name in _REPEAT_NAMES:
+        return any(_item_may_match(o, a, ch) for o, a in av[2])
+    if name == "SUBPATTERN":
+        return any(_item_may_match(o, a, ch) for o, a in av[-1])
+    if name == "BRANCH":
+        return any(_item_may_match(o, a, ch) for branch in av[1] for o, a in branch)
+    if name in {"AT", "ASSERT", "ASSERT_NOT"}:
+        return False  # 文字を消費しない
+    return True
+
+
+def _is_ambiguous(items) -> bool:
+    """上限なしの繰り返しまたは選択を含むか"""
+    for op, av in items:
+        name = str(op)
+        if name in _REPEAT_NAMES and (_is_unbounded(av) or _is_ambiguous(av[2])):
+            return True
+        if name == "BRANCH":
+            return True
+        if name == "SUBPATTERN" and _is_ambiguous(av[-1]):
+            return True
     return False
 
 
-def scan_file(filepath: Path, base_dir: Path) -> tuple[list[Finding], int]:
-    """単一ファイルをスキャン"""
-    findings = []
-    try:
-        content = filepath.read_text(encoding="utf-8", errors="replace")
-    except (PermissionError, OSError) as e:
-        return [], 0
+def _has_delimiter(items) -> bool:
+    """本体の他の要素がマッチしえない必須の1文字（区切り文字）があるか"""
+    items = list(items)
+    # (?:...) や (...) 1つだけの本体は中身で判定する
+    while len(items) == 1 and str(items[0][0]) == "SUBPATTERN":
+        items = list(items[0][1][-1])
+    for idx, (op, av) in enumerate(items):
+        if str(op) != "LITERAL":
+            continue
+        ch = chr(av)
+        others = items[:idx] + items[idx + 1:]
+        if not any(_item_may_match(o, a, ch) for o, a in others):
+            return True
+    return False
 
-    lines = content.splitlines()
-    line_count = len(lines)
 
-    # Markdownファイルの場合、コードブロックマップを構築
-    is_markdown = filepath.suffix.lower() in {".md", ".txt"}
-    code_block_lines = build_code_block_map(lines) if is_markdown else set()
+def _lint_items(items, problems: list[str]):
+    for op, av in items:
+        name = str(op)
+        if name in _REPEAT_NAMES:
+            body = av[2]
+            if _is_unbounded(av) and _is_ambiguous(body) and not _has_delimiter(body):
+                problems.append("区切り文字のない曖昧な繰り返し（入れ子の量指定子など）")
+            _lint_items(body, problems)
+        elif name == "SUBPATTERN":
+            _lint_items(av[-1], problems)
+        elif name == "BRANCH":
+            for branch in av[1]:
+                _lint_items(branch, problems)
+        elif name in {"ASSERT", "ASSERT_NOT"}:
+            _lint_items(av[1], problems)
 
-    rel_path = str(filepath.relative_to(base_dir))
 
-    for i, line in enumerate(lines):
-        for category, pattern, severity, message in COMPILED_PATTERNS:
-            match = pattern.search(line)
-            if match:
-                in_code_block = i in code_block_lines
-                actual_severity = severity
-
-                # コードブロック内の検出はseverityを1段階下げる
-                if in_code_block and actual_severity > Severity.INFO:
-                    actual_severity = actual_severity - 1
-
-                matched_text = match.group(0)
-                # 長すぎるマッチは切り詰め
-                if len(matched_text) > 120:
-                    matched_text = matched_text[:117] + "..."
-
-                findings.append(Finding(
-                    category=category,
-                    severity=actual_severity,
-                    message=message,
-                    file=rel_path,
-                    line=i + 1,
-                    matched_text=matched_text,
-                    in_code_block=in_code_block,
-                ))
-
-    return findings, line_count
-
-
-def scan_directory(dir_path: Path) -> ScanResult:
-    """ディレクトリ全体をスキャン"""
-    result = ScanResult(path=str(dir_path))
-
-    for root, dirs, files in os.walk(dir_path):
-        # 除外ディレクトリをスキップ
-        dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
-
-        for fname in files:
-            fpath = Path(root) / fname
-            if not should_scan_file(fpath):
-                continue
+def lint_rule(pattern: str) -> list[str]:
+    """破滅的バックトラックの恐れがある構造を列挙する"""
+    problems: list[str] = []
+    _lint_items(_sre_parse.parse(pattern), problems)
+    return problems
 
-            result.file_count += 1
-            findings, line_count = scan_file(fpath, dir_path)
-            result.total_lines += line_count
-            result.findings.extend(findings)
 
-    # 判定
-    result.verdict = determine_verdict(result.findings)
-    return result
+def check_rules(rules: list[Rule]):
+    """問題のあるルールがあれば ValueError を送出する"""
+    errors = [
+        f"{rule.pattern!r}: {problem}"
+        for rule in rules
+        for problem in lint_rule(rule.pattern)
+    ]
+    if errors:
+        raise ValueError("破滅的バックトラックの恐れがあるルールがあります:\n" + "\n".join(errors))
 
 
-def scan_zip(zip_path: Path) -> ScanResult:
-    """ZIP/.skill ファイルをスキャン"""
-    result = ScanResult(path=str(zip_path))
+check_rules(PATTERNS)
 
-    # ZIPボム検出
-    try:
-        file_size = zip_path.stat().st_size
-        if file_size > MAX_ZIP_SIZE:
-            result.errors.append(f"ファイルサイズが上限（100MB）を超えています: {file_size / 1024 / 1024:.1f}MB")
-            result.verdict = "DANGER"
-            return result
-    except OSError as e:
-        result.errors.append(f"ファイルアクセスエラー: {e}")
-        result.verdict = "DANGER"
-        return result
 
-    try:
-        with zipfile.ZipFile(zip_path, "r") as zf:
-            # 展開後サイズチェック
-            total_uncompressed = sum(info.file_size for info in zf.infolist())
-            if total_uncompressed > MAX_ZIP_SIZE:
-                result.errors.append(
-                    f"ZIPボムの可能性: 展開後サイズ {total_uncompressed / 1024 / 1024:.1f}MB "
-                    f"（圧縮率 {total_uncompressed / max(file_size, 1):.0f}x）"
-                )
-                result.verdict = "DANGER"
-                return result
-
-            # 一時ディレクトリに展開してスキャン
-            with tempfile.TemporaryDirectory(prefix="skill_scan_") as tmpdir:
-                zf.extractall(tmpdir)
-                tmp_path = Path(tmpdir)
-                dir_result = scan_directory(tmp_path)
-                result.file_count = dir_result.file_count
-                result.total_lines = dir_result.total_lines
-                result.findings = dir_result.findings
-                result.errors = dir_result.errors
-
-    except zipfile.BadZipFile:
-        result.errors.append("無効なZIPファイルです")
-        result.verdict = "DANGER"
-        return result
-    except Exception as e:
-        result.errors.append(f"ZIP展開エラー: {e}")
-        result.verdict = "DANGER"
-        return result
+# ---------------------------------------------------------------------------
+# 行オフセットインデックス
+# ---------------------------------------------------------------------------
 
-    result.verdict = determine_verdict(result.findings)
-    return result
+# str.splitlines() と同じ改行文字（行番号を従来と一致させるため）
+LINE_BREAK = re.compile(r'\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+_NEWLINE = re.compile(r'\n')
+_RARE_BREAKS = ("\r", "\x0b", "\x0c", "\x1c", "\x1d", "\x1e")
+_RARE_UNICODE_BREAKS = ("\x85", "\u2028", "\u2029")
 
 
-def determine_verdict(findings: list[Finding]) -> str:
-    """検出結果から最終判定を返す"""
-    if not findings:
-        return "SAFE"
+def build_line_index(content: str) -> list[int]:
+    """各行の開始オフセットのリストを返す"""
+    breaks = LINE_BREAK
+    if not any(ch in content for ch in _RARE_BREAKS) and (
+        content.isascii() or not any(ch in content for ch in _RARE_UNICODE_BREAKS)
+    ):
+        # "\n" だけのファイル（大半）はより速い単純パターンで足りる
+        breaks = _NEWLINE
+    return [0] + [m.end() for m in breaks.finditer(content)]
 
-    max_severity = max(f.severity for f in findings)
 
-    if max_severity >= Severity.HIGH:
-        return "DANGER"
-    elif max_severity >= Severity.MEDIUM:
-        return "WARNING"
-    elif max_severity >= Severity.LOW:
-        # LOW が3件以上ある場合は WARNING
-        low_count = sum(1 for f in findings if f.severity >= Severity.LOW)
-        if low_count >= 3:
-            return "WARNING"
-        return "SAFE"
-    else:
-        return "SAFE"
+def count_lines(content: str, line_starts: list[int]) -> int:
+    """splitlines() と同じ数え方の行数（末尾改行の後ろは行に数えない）"""
+    if line_starts[-1] == len(content):
+        return len(line_starts) - 1
+    return len(line_starts)
+
 
+def line_end(content: str, line_starts: list[int], line: int) -> int:
+    """行末（改行文字を除く）のオフセット"""
+    if line + 1 >= len(line_starts):
+        return len(content)
+    end = line_starts[line + 1] - 1
+    if end > 0 and content[end - 1:end + 1] == "\r\n":
+        end -= 1
+    return end
 
 # ---------------------------------------------------------------------------
-# レポート出力
+# Markdown の文脈（コードブロック・フロントマター・HTMLコメント）
 # ---------------------------------------------------------------------------
+#
+# 検出があったファイルについてだけ、後から検出行の文脈を求める。
+# 文脈ごとに [開始行, 終了行) の区間リストを作り、行の判定は bisect で行う。
+# 文脈を変えうるのは _CONTEXT_MARKERS を含む行だけなので、他の行は読まない。
+# 文脈を増やす場合は IntervalTracker のサブクラスを作り、ContextTracker に加える。
 
-VERDICT_ICONS = {
-    "SAFE": "✅",
-    "WARNING": "⚠️",
-    "DANGER": "🚨",
+CODE_BLOCK_FENCE = re.compile(r'^(`{3,}|~{3,})')
+_CONTEXT_MARKERS = re.compile(r'```|~~~|---|<!--|-->')
+# 1行が複数の文脈に入る場合の優先順
+CONTEXT_PRIORITY = ("code_block", "frontmatter", "html_comment")
+_CONTEXT_NAMES = (None,) + CONTEXT_PRIORITY
+_CONTEXT_IDS = {name: idx for idx, name in enumerate(_CONTEXT_NAMES)}
+CONTEXT_NOTES = {
+    "code_block": " (コードブロック内)",
+    "frontmatter": " (フロントマター内)",
+    "html_comment": " (HTMLコメント内)",
 }
 
 
-def format_report(result: ScanResult) -> str:
-    """human-readable レポートを生成"""
-    lines = []
-    icon = VERDICT_ICONS.get(result.verdict, "❓")
+class IntervalTracker(ABC):
+    """目印を含む行を行番号順に受け取り、文脈の範囲を区間リストで記録する"""
 
-    lines.append(f"{'=' * 60}")
-    lines.append(f"  Skill Security Scanner - スキャン結果")
-    lines.append(f"{'=' * 60}")
-    lines.append(f"")
-    lines.append(f"  対象: {result.path}")
-    lines.append(f"  ファイル数: {result.file_count}")
-    lines.append(f"  総行数: {result.total_lines}")
-    lines.append(f"")
-    lines.append(f"  判定: {icon} {result.verdict}")
-    lines.append(f"")
+    def __init__(self):
+        self.start: Optional[int] = None  # 開いている区間の開始行
+        self.intervals: list[tuple[int, int]] = []
 
-    if result.errors:
-        lines.append(f"  エラー:")
-        for err in result.errors:
-            lines.append(f"    ❌ {err}")
-        lines.append(f"")
+    @abstractmethod
+    def feed_line(self, lineno: int, line: str):
+        """lineno 行目（目印を含む行）を受け取り、区間を開く・閉じる"""
 
-    d = result.to_dict()
-    summary = d["summary"]
-    lines.append(f"  検出サマリー:")
-    lines.append(f"    🚨 CRITICAL: {summary['CRITICAL']}")
-    lines.append(f"    🔴 HIGH:     {summary['HIGH']}")
-    lines.append(f"    🟠 MEDIUM:   {summary['MEDIUM']}")
-    lines.append(f"    🟡 LOW:      {summary['LOW']}")
-    lines.append(f"    ℹ️  INFO:     {summary['INFO']}")
-    lines.append(f"")
+    def finish(self, line_count: int) -> list[tuple[int, int]]:
+        """閉じられていない区間はファイル末尾までとして区間を返す"""
+        if self.start is not None:
+            self.intervals.append((self.start, line_count))
+            self.start = None
+        return self.intervals
 
-    if result.findings:
-        lines.append(f"{'─' * 60}")
-        lines.append(f"  検出詳細")
-        lines.append(f"{'─' * 60}")
-        lines.append(f"")
 
-        # カテゴリでグループ化
-        by_category: dict[str, list[Finding]] = {}
-        for f in sorted(result.findings, key=lambda x: (-x.severity, x.category)):
-            by_category.setdefault(f.category, []).append(f)
+class CodeBlockTracker(IntervalTracker):
+    """フェンスで囲まれたコードブロック（フェンス行自身も含む）"""
 
-        category_labels = {
-            "credential_exposure": "認証情報の露出",
-            "dangerous_command": "危険コマンド",
-            "data_exfiltration": "データ窃取",
-            "path_traversal": "パストラバーサル",
-            "permission_bypass": "権限バイパス",
-            "prompt_injection": "プロンプトインジェクション",
-            "obfuscation": "難読化",
-            "supply_chain": "サプライチェーン",
-        }
+    def __init__(self):
+        super().__init__()
+        self.fence_char = None
+        self.fence_len = 0
 
-        for cat, cat_findings in by_category.items():
-            label = category_labels.get(cat, cat)
-            lines.append(f"  [{label}]")
-            for f in cat_findings:
-                sev_icon = SEVERITY_ICONS.get(f.severity, "❓")
-                code_note = " (コードブロック内)" if f.in_code_block else ""
-                lines.append(f"    {sev_icon} {SEVERITY_LABELS[f.severity]} | {f.file}:{f.line}")
-                lines.append(f"       {f.message}{code_note}")
-                lines.append(f"       → {f.matched_text}")
-                lines.append(f"")
-    else:
-        lines.append(f"  検出なし - 既知の危険パターンは見つかりませんでした。")
-        lines.append(f"")
+    def feed_line(self, lineno: int, line: str):
+        m = CODE_BLOCK_FENCE.match(line.strip())
+        if not m:
+            return
+        char = m.group(1)[0]
+        length = len(m.group(1))
+        if self.start is None:
+            self.start = lineno
+            self.fence_char = char
+            self.fence_len = length
+        elif char == self.fence_char and length >= self.fence_len:
+            self.intervals.append((self.start, lineno + 1))
+            self.start = None
+            self.fence_char = None
+            self.fence_len = 0
 
-    lines.append(f"{'=' * 60}")
 
-    if result.verdict == "SAFE":
-        lines.append(f"  自動スキャンでは問題は検出されませんでした。")
-        lines.append(f"  ※ セマンティック分析（Claude）での追加確認を推奨します。")
-    elif result.verdict == "WARNING":
-        lines.append(f"  注意が必要な項目があります。")
-        lines.append(f"  インストール前に検出項目を確認してください。")
-    else:
-        lines.append(f"  危険な項目が検出されました。")
-        lines.append(f"  このスキルのインストールは推奨しません。")
+class FrontmatterTracker(IntervalTracker):
+    """1行目の --- から次の --- までの YAML フロントマター"""
 
-    lines.append(f"{'=' * 60}")
+    def __init__(self):
+        super().__init__()
+        self.done = False
 
-    return "\n".join(lines)
+    def feed_line(self, lineno: int, line: str):
+        if self.done:
+            return
+        if self.start is None:
+            if lineno == 0 and line.strip() == "---":
+                self.start = 0
+            else:
+                self.done = True
+        elif line.strip() == "---":
+            self.intervals.append((self.start, lineno + 1))
+            self.start = None
+            self.done = True
 
+    def finish(self, line_count: int) -> list[tuple[int, int]]:
+        # 閉じられていなければフロントマターではない
+        self.start = None
+        return self.intervals
 
-# ---------------------------------------------------------------------------
-# インストール機能
-# ---------------------------------------------------------------------------
 
-SKILLS_DIR = Path.home() / ".claude" / "skills"
+class HtmlCommentTracker(IntervalTracker):
+    """<!-- から --> までを含む行（表示されない指示を見分けるため）"""
 
+    def feed_line(self, lineno: int, line: str):
+        in_comment = self.start is not None
+        pos = 0
+        while True:
+            if not in_comment:
+                pos = line.find("<!--", pos)
+                if pos == -1:
+                    break
+                in_comment = True
+                if self.start is None:
+                    self.start = lineno
+                pos += 4
+            else:
+                pos = line.find("-->", pos)
+                if pos == -1:
+                    break
+                in_comment = False
+                pos += 3
+        if not in_comment and self.start is not None:
+            self.intervals.append((self.start, lineno + 1))
+            self.start = None
 
-def resolve_skill_source(target: Path) -> tuple[Path, Optional[tempfile.TemporaryDirectory]]:
-    """インストール元のディレクトリパスを返す。ZIPの場合は一時展開する。"""
-    if target.is_file() and target.suffix in {".skill", ".zip"}:
-        tmpdir = tempfile.TemporaryDirectory(prefix="skill_install_")
-        with zipfile.ZipFile(target, "r") as zf:
-            zf.extractall(tmpdir.name)
-        return Path(tmpdir.name), tmpdir
-    return target, None
 
+class ContextMap:
+    """文脈ごとの区間リスト"""
 
-def detect_skill_name(source_dir: Path) -> Optional[str]:
-    """SKILL.md の YAML フロントマターから name を取得する。"""
-    skill_md = source_dir / "SKILL.md"
-    if not skill_md.exists():
+    __slots__ = ("intervals",)
+
+    def __init__(self, intervals: dict[str, list[tuple[int, int]]]):
+        self.intervals = intervals
+
+    def context_of(self, line: int) -> Optional[str]:
+        """行の文脈（CONTEXT_PRIORITY の順で最初に当てはまるもの）。無ければ None"""
+        for name in CONTEXT_PRIORITY:
+            if in_intervals(self.intervals[name], line):
+                return name
         return None
-    try:
-        content = skill_md.read_text(encoding="utf-8", errors="replace")
-        lines = content.splitlines()
-        if lines and lines[0].strip() == "---":
-            for line in lines[1:]:
-                if line.strip() == "---":
-                    break
-                m = re.match(r'^name:\s*(.+)', line)
-                if m:
-                    return m.group(1).strip().strip('"').strip("'")
-    except OSError:
-        pass
-    # フォールバック: ディレクトリ名を使用
-    return source_dir.name if source_dir.name else None
 
 
-def install_skill(source_dir: Path, skill_name: str) -> Path:
-    """スキルを ~/.claude/skills/ にコピーする。"""
-    dest = SKILLS_DIR / skill_name
-    if dest.exists():
-        shutil.rmtree(dest)
-    shutil.copytree(
-        source_dir,
-        dest,
-        ignore=shutil.ignore_patterns(".DS_Store", "__pycache__", "*.pyc"),
-    )
-    return dest
+class ContextTracker:
+    """Markdown の文脈を追跡する
 
+    行は番号順に渡す。目印を含まない行は省略してよいため、チャンク単位の
+    スキャンでは全行を feed し、全体がある場合は build_context_map で目印の行だけを渡す。
+    コメント内のフェンスと、コードブロック内のコメント記法は無視する。
+    """
 
-# ---------------------------------------------------------------------------
-# メイン
-# ---------------------------------------------------------------------------
+    def __init__(self):
+        self.line = 0  # feed で次に渡す行番号
+        self.code_block = CodeBlockTracker()
+        self.frontmatter = FrontmatterTracker()
+        self.html_comment = HtmlCommentTracker()
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Claude Code スキルの安全性を検査する",
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog=__doc__,
-    )
-    parser.add_argument("path", help="スキャン対象のパス（ディレクトリまたは .skill/.zip）")
-    parser.add_argument("--json", action="store_true", help="JSON出力のみ")
-    parser.add_argument(
-        "--install",
-        action="store_true",
-        help="スキャン後、SAFEの場合のみ ~/.claude/skills/ にインストール",
-    )
-    args = parser.parse_args()
+    def feed_line(self, lineno: int, line: str):
+        self.line = lineno + 1
+        if _CONTEXT_MARKERS.search(line) is None:
+            return
+        self.frontmatter.feed_line(lineno, line)
+        if self.html_comment.start is None:
+            self.code_block.feed_line(lineno, line)
+        if self.code_block.start is None:
+            self.html_comment.feed_line(lineno, line)
 
-    target = Path(args.path).expanduser().resolve()
+    def feed(self, lines: Iterable[str]):
+        for line in lines:
+            self.feed_line(self.line, line)
 
-    if not target.exists():
-        print(f"エラー: パスが見つかりません: {target}", file=sys.stderr)
-        sys.exit(2)
+    def finish(self, line_count: int) -> ContextMap:
+        return ContextMap({
+            "code_block": self.code_block.finish(line_count),
+            "frontmatter": self.frontmatter.finish(line_count),
+            "html_comment": self.html_comment.finish(line_count),
+        })
 
-    if target.is_file() and target.suffix in {".skill", ".zip"}:
-        result = scan_zip(target)
-    elif target.is_dir():
-        result = scan_directory(target)
+
+def build_context_map(content: str, line_starts: list[int]) -> ContextMap:
+    """目印を含む行だけを追跡して、テキスト全体の文脈を求める"""
+    tracker = ContextTracker()
+    last = -1
+    for m in _CONTEXT_MARKERS.finditer(content):
+        i = bisect_right(line_starts, m.start()) - 1
+        if i == last:
+            continue
+        last = i
+        tracker.feed_line(i, content[line_starts[i]:line_end(content, line_starts, i)])
+    return tracker.finish(count_lines(content, line_starts))
+
+
+def in_intervals(intervals: list[tuple[int, int]], line: int) -> bool:
+    """行番号がソート済み区間リストのいずれかに含まれるか"""
+    idx = bisect_right(intervals, (line, float("inf"))) - 1
+    return idx >= 0 and intervals[idx][0] <= line < intervals[idx][1]
+
+
+# ---------------------------------------------------------------------------
+# スキャナー本体
+# ---------------------------------------------------------------------------
+
+# スキャン対象の拡張子
+SCAN_EXTENSIONS = {
+    ".md", ".txt", ".py", ".js", ".ts", ".jsx", ".tsx",
+    ".sh", ".bash", ".zsh", ".fish",
+    ".json", ".yaml", ".yml", ".toml",
+    ".html", ".css", ".scss",
+    ".rb", ".go", ".rs", ".java", ".php",
+    ".env", ".cfg", ".ini", ".conf",
+    "", # 拡張子なし（Makefile, Dockerfile等）
+}
+
+# 除外パターン
+SKIP_DIRS = {
+    "__pycache__", "node_modules", ".git", ".venv", "venv",
+    ".mypy_cache", ".pytest_cache", "dist", "build",
+}
+
+MAX_ZIP_SIZE = 100 * 1024 * 1024  # 100MB
+MAX_ZIP_MEMBER_SIZE = 50 * 1024 * 1024  # 50MB（ZIPメンバー1つあたり）
+ZIP_READ_CHUNK = 1024 * 1024  # ZIPメンバーのストリーム展開単位
+
+# 並列スキャン時に1タスクへまとめる小ファイルの上限
+PARALLEL_BATCH_BYTES = 1024 * 1024  # 1MB
+PARALLEL_BATCH_FILES = 64
+
+
+# 拡張子なしでもスキャンするファイル名
+SCAN_FILENAMES = {
+    "Makefile", "Dockerfile", "Vagrantfile", "Gemfile",
+    "Rakefile", "Procfile", ".env",
+}
+
+
+def name_suffix(name: str) -> str:
+    """PurePath(name).suffix と同じ拡張子（Path を作らずに求める）"""
+    idx = name.rfind(".")
+    return name[idx:] if 0 < idx < len(name) - 1 else ""
+
+
+def should_scan_name(name: str) -> bool:
+    """ファイル名からスキャン対象かどうか判定"""
+    suffix = name_suffix(name)
+    if suffix.lower() in SCAN_EXTENSIONS:
+        return True
+    # 拡張子なしファイルの場合、名前で判定
+    return suffix == "" and name in SCAN_FILENAMES
+
+
+def should_scan_file(path: PurePath) -> bool:
+    """スキャン対象かどうか判定"""
+    return should_scan_name(path.name)
+
+
+# 評価の上限。RULE_WINDOW 文字を超える行はアンカー周辺の窓だけを評価し、
+# 1ファイルで1ルールに RULE_TIME_BUDGET 秒以上かかったらそのルールの評価を打ち切る
+RULE_WINDOW = 4096  # 文字数
+MAX_WINDOW = RULE_WINDOW * 8  # 重なる窓をまとめたときの上限（文字数）
+MULTILINE_WINDOW = 8192  # 複数行ルールで必ず検出できるマッチの長さ（文字数）
+RULE_TIME_BUDGET = 0.5  # 秒
+_BUDGET_CHECK_EVERY = 16  # 何回の search ごとに経過時間を確認するか
+
+
+class RuleBudget:
+    """1ファイル分のルールごとの評価時間"""
+
+    def __init__(self, limit: float = RULE_TIME_BUDGET, profile: bool = False):
+        self.limit = limit
+        self.spent: dict[int, float] = {}
+        self.exhausted: set[int] = set()
+        # --profile 時のみ: 評価した行・窓の数と文字数
+        self.profile = profile
+        self.evaluated: dict[int, int] = {}
+        self.chars: dict[int, int] = {}
+
+    def count(self, rule_id: int, evaluated: int, chars: int):
+        self.evaluated[rule_id] = self.evaluated.get(rule_id, 0) + evaluated
+        self.chars[rule_id] = self.chars.get(rule_id, 0) + chars
+
+    def remaining(self, rule_id: int) -> float:
+        return self.limit - self.spent.get(rule_id, 0.0)
+
+    def charge(self, rule_id: int, seconds: float):
+        total = self.spent.get(rule_id, 0.0) + seconds
+        self.spent[rule_id] = total
+        if total > self.limit:
+            self.exhausted.add(rule_id)
+
+
+def find_matches(
+    content: str,
+    line_starts: list[int],
+    budget: Optional[RuleBudget] = None,
+    rule_set: RuleSet = ALL_RULES,
+) -> dict[tuple[int, int], str]:
+    """content 内のマッチを (行番号, ルール番号) → 表示用テキスト で返す
+
+    単一行ルールはアンカーの出現位置から求めた候補行の範囲内だけで search し、
+    複数行ルールはバッファ全体に finditer を適用する。マッチ位置は
+    行オフセットインデックスから bisect で行番号に変換する。
+    1行1ルールにつき最初のマッチのみ採用する。
+    budget を超えたルールは評価を打ち切り、budget.exhausted に記録する。
+    rule_set に含まれないルールは評価しない。
+    """
+    budget = budget if budget is not None else RuleBudget()
+    # ファイル全体に1つもアンカーが現れなければ、どのルールもマッチしない
+    folded = _fold(content)
+    anchor_rules = rule_set.anchor_rules
+    unanchored = rule_set.unanchored
+    file_anchors = [a for a in anchor_rules if a in folded]
+    if not file_anchors and not unanchored:
+        return {}
+
+    # 単一行ルールの候補: ルール番号 → 行番号の集合。
+    # 長い行は行全体ではなく (行番号, 開始, 終了) の窓を候補にする
+    candidates: dict[int, set[int]] = {}
+    windows: dict[int, list[tuple[int, int, int]]] = {}
+    multiline_rules = {idx for idx in unanchored if idx in MULTILINE_RULES}
+    last_line = len(line_starts) - 1
+
+    for idx in sorted(unanchored - MULTILINE_RULES):
+        for i in range(count_lines(content, line_starts)):
+            start = line_starts[i]
+            end = line_end(content, line_starts, i)
+            if end - start <= RULE_WINDOW * 2:
+                candidates.setdefault(idx, set()).add(i)
+                continue
+            for pos in range(start, end, RULE_WINDOW):
+                windows.setdefault(idx, []).append((i, pos, min(pos + RULE_WINDOW * 2, end)))
+
+    for anchor in file_anchors:
+        rule_ids = anchor_rules[anchor]
+        multiline_rules.update(idx for idx in rule_ids if idx in MULTILINE_RULES)
+        single_rules = [idx for idx in rule_ids if idx not in MULTILINE_RULES]
+        if not single_rules:
+            continue
+        pos = folded.find(anchor)
+        while pos != -1:
+            i = bisect_right(line_starts, pos) - 1
+            start = line_starts[i]
+            end = line_starts[i + 1] if i < last_line else len(content)
+            if end - start <= RULE_WINDOW * 2:
+                for idx in single_rules:
+                    candidates.setdefault(idx, set()).add(i)
+                if i >= last_line:
+                    break
+                # 同じ行の残りの出現は見る必要がない
+                pos = folded.find(anchor, end)
+                continue
+            # 長い行（圧縮された JS など）はアンカー周辺の窓だけを評価する
+            end = line_end(content, line_starts, i)
+            window = (i, max(start, pos - RULE_WINDOW), min(end, pos + RULE_WINDOW))
+            for idx in single_rules:
+                windows.setdefault(idx, []).append(window)
+            # 窓が重なる範囲の出現は飛ばすが、行末を越えて次の行の出現を飛ばさない
+            pos = folded.find(anchor, min(pos + RULE_WINDOW // 2, end))
+
+    hits: dict[tuple[int, int], str] = {}
+    perf_counter = time.perf_counter
+    for rule_id in candidates.keys() | windows.keys():
+        if rule_id in budget.exhausted:
+            continue
+        search = COMPILED_PATTERNS[rule_id][1].search
+        work = [(i, line_starts[i], line_end(content, line_starts, i)) for i in candidates.get(rule_id, ())]
+        # 窓は行内で先に始まるものから評価し、最初に見つかったマッチを採用する
+        work.extend(_coalesce_windows(sorted(windows.get(rule_id, ()))))
+        if budget.profile:
+            budget.count(rule_id, len(work), sum(end - start for _, start, end in work))
+        deadline = budget.remaining(rule_id)
+        started = perf_counter()
+        for n, (i, start, end) in enumerate(work, 1):
+            if (i, rule_id) not in hits:
+                match = search(content, start, end)
+                if match:
+                    hits[(i, rule_id)] = _display_text(rule_id, match.group(0))
+            if n % _BUDGET_CHECK_EVERY == 0 and perf_counter() - started > deadline:
+                break
+        budget.charge(rule_id, perf_counter() - started)
+
+    # 複数行ルールは短いバッファなら全体に、長いバッファならアンカー周辺の
+    # 窓（MULTILINE_WINDOW 文字以内のマッチを取りこぼさない幅）ごとに finditer する
+    for rule_id in multiline_rules:
+        if rule_id in budget.exhausted:
+            continue
+        pattern = COMPILED_PATTERNS[rule_id][1]
+        deadline = budget.remaining(rule_id)
+        started = perf_counter()
+        multiline_windows = _multiline_windows(content, folded, rule_id)
+        if budget.profile:
+            budget.count(rule_id, len(multiline_windows), sum(end - start for start, end in multiline_windows))
+        for start, end in multiline_windows:
+            for match in pattern.finditer(content, start, end):
+                i = bisect_right(line_starts, match.start()) - 1
+                if (i, rule_id) not in hits:
+                    hits[(i, rule_id)] = _display_text(rule_id, match.group(0))
+            if perf_counter() - started > deadline:
+                break
+        budget.charge(rule_id, perf_counter() - started)
+
+    return hits
+
+
+def _coalesce_windows(windows: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+    """同じ行で重なる窓を、1回の search の範囲が MAX_WINDOW を超えない範囲でまとめる"""
+    merged: list[tuple[int, int, int]] = []
+    for line, start, end in windows:
+        if merged:
+            prev_line, prev_start, prev_end = merged[-1]
+            if prev_line == line and start <= prev_end and end - prev_start <= MAX_WINDOW:
+                merged[-1] = (line, prev_start, max(prev_end, end))
+                continue
+        merged.append((line, start, end))
+    return merged
+
+
+def _multiline_windows(content: str, folded: str, rule_id: int) -> list[tuple[int, int]]:
+    """複数行ルールを評価する (開始, 終了) の窓のリスト"""
+    size = len(content)
+    anchors = RULE_ANCHORS[rule_id]
+    if size <= MULTILINE_WINDOW * 4 or anchors is None:
+        return [(0, size)]
+    windows = []
+    for anchor in anchors:
+        pos = folded.find(anchor)
+        while pos != -1:
+            windows.append((max(0, pos - MULTILINE_WINDOW * 2), min(size, pos + MULTILINE_WINDOW * 2)))
+            pos = folded.find(anchor, pos + MULTILINE_WINDOW)
+    # 窓はまとめない（まとめると1回の finditer の範囲が際限なく広がる）
+    return sorted(set(windows))
+
+
+def _display_text(rule_id: int, matched_text: str) -> str:
+    """レポート用のマッチ文字列（改行の可視化と切り詰め）"""
+    if rule_id in MULTILINE_RULES:
+        # 改行をまたぐマッチは1行で表示できるよう改行を可視化する
+        matched_text = LINE_BREAK.sub(r"\\n", matched_text)
+    return _truncate(matched_text)
+
+
+def _truncate(text: str) -> str:
+    """長すぎる表示文字列を切り詰める"""
+    if len(text) > 120:
+        return text[:117] + "..."
+    return text
+
+
+def build_findings(
+    hits: dict[tuple[int, int], str],
+    rel_path: str,
+    contexts: Optional[ContextMap] = None,
+) -> list[Finding]:
+    """find_matches の結果を行順・ルール順の Finding リストにする"""
+    findings = []
+    for (i, rule_id), matched_text in sorted(hits.items(), key=lambda item: item[0]):
+        category, _pattern, severity, message = COMPILED_PATTERNS[rule_id]
+        context = contexts.context_of(i) if contexts else None
+        in_code_block = context == "code_block"
+        actual_severity = severity
+
+        # コードブロック内の検出はseverityを1段階下げる
+        if in_code_block and actual_severity > Severity.INFO:
+            actual_severity = actual_severity - 1
+
+        findings.append(Finding(
+            category=category,
+            severity=actual_severity,
+            message=message,
+            file=rel_path,
+            line=i + 1,
+            matched_text=matched_text,
+            in_code_block=in_code_block,
+            context=context,
+        ))
+    return findings
+
+
+def scan_text(
+    content: str,
+    rel_path: str,
+    is_markdown: bool = False,
+    profiler: Optional["ScanProfiler"] = None,
+    metrics: Optional["ScanMetrics"] = None,
+) -> tuple[list[Finding], int]:
+    """デコード済みテキスト全体をスキャンする"""
+    line_starts = build_line_index(content)
+    line_count = count_lines(content, line_starts)
+
+    budget = RuleBudget(profile=profiler is not None)
+    hits = find_matches(content, line_starts, budget, rule_set_for(rel_path))
+    if profiler:
+        profiler.record(rel_path, len(content), budget, hits)
+    if not hits:
+        return budget_findings(budget, rel_path), line_count
+
+    # Markdownファイルの場合、検出行の文脈を求める（検出がある場合のみ）
+    contexts = None
+    if is_markdown:
+        started = time.perf_counter() if metrics else 0.0
+        contexts = build_context_map(content, line_starts)
+        if metrics:
+            metrics.add("context", time.perf_counter() - started)
+    findings = build_findings(hits, rel_path, contexts)
+    return findings + budget_findings(budget, rel_path), line_count
+
+
+# 時間予算による打ち切りは結果がマシンの負荷で変わるため、内容だけで決まる
+# scan_limit とはカテゴリを分ける（キャッシュに保存しない目印にもなる）
+BUDGET_CATEGORY = "scan_timeout"
+
+
+def budget_findings(budget: RuleBudget, rel_path: str) -> list[Finding]:
+    """評価を打ち切ったルールを検出として報告する（未評価のまま SAFE にしない）"""
+    return [
+        Finding(
+            category=BUDGET_CATEGORY,
+            severity=Severity.MEDIUM,
+            message=f"ルールの評価が時間予算（{budget.limit:g}秒）を超えたため打ち切りました",
+            file=rel_path,
+            line=1,
+            matched_text=_truncate(PATTERNS[rule_id].pattern),
+        )
+        for rule_id in sorted(budget.exhausted)
+    ]
+
+
+def has_budget_findings(findings: Iterable[Finding]) -> bool:
+    """時間予算で評価を打ち切ったルールがあるか（結果はマシンの負荷で変わる）"""
+    return any(f.category == BUDGET_CATEGORY for f in findings)
+
+
+# ---------------------------------------------------------------------------
+# 大きなファイルのチャンクスキャン
+# ---------------------------------------------------------------------------
+#
+# LARGE_FILE_THRESHOLD を超えるファイルは全体を読み込まず、SCAN_CHUNK_SIZE ずつ
+# 読んでデコードし、行境界で区切ったウィンドウごとにスキャンする。
+# 直前のウィンドウの末尾 CHUNK_OVERLAP 文字を次のウィンドウに重ねることで、
+# 区切りをまたぐ複数行ルールのマッチも検出する（重複は行・ルール単位で除く）。
+# 1行が LONG_LINE_LIMIT を超える場合のみ行の途中で区切る。
+
+LARGE_FILE_THRESHOLD = 16 * 1024 * 1024  # 16MB
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB
+LONG_LINE_LIMIT = 2 * SCAN_CHUNK_SIZE  # 文字数
+CHUNK_OVERLAP_CAP = 64 * 1024  # 文字数
+MAX_FILE_SIZE = 256 * 1024 * 1024  # 256MB（これを超えるファイルはスキャンせずエラーにする）
+
+
+def _max_rule_width() -> int:
+    """ルールがマッチしうる最大文字数（上限なしのルールがあれば CHUNK_OVERLAP_CAP）"""
+    widest = 0
+    for rule in PATTERNS:
+        try:
+            widest = max(widest, _sre_parse.parse(rule.pattern).getwidth()[1])
+        except Exception:
+            return CHUNK_OVERLAP_CAP
+    return min(widest, CHUNK_OVERLAP_CAP)
+
+
+CHUNK_OVERLAP = _max_rule_width()
+
+
+@dataclass(frozen=True)
+class LargeFile:
+    """チャンク単位でスキャンする大きなファイル（内容はメモリに読み込まない）"""
+    path: Path
+    size: int
+
+
+@dataclass(frozen=True)
+class ArchiveError:
+    """展開できなかった入れ子のアーカイブ（スキャン時に検出として報告する）"""
+    message: str
+    severity: int = Severity.HIGH
+
+    def findings(self, rel_path: str) -> list[Finding]:
+        return [
+            Finding(
+                category="scan_limit",
+                severity=self.severity,
+                message=self.message,
+                file=rel_path,
+                line=1,
+                matched_text="",
+            )
+        ]
+
+
+def iter_text_chunks(filepath: Path, chunk_size: int = SCAN_CHUNK_SIZE) -> Iterator[str]:
+    """ファイルを固定サイズで読み、read_text() と同じ規則でデコードしたテキストを順に返す"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending_cr = ""
+    with open(filepath, "rb") as fp:
+        while True:
+            data = fp.read(chunk_size)
+            final = not data
+            text = pending_cr + decoder.decode(data, final=final)
+            pending_cr = ""
+            # "\r\n" がチャンク境界で分かれた場合に備え、末尾の "\r" は次に回す
+            if not final and text.endswith("\r"):
+                text, pending_cr = text[:-1], "\r"
+            yield text.replace("\r\n", "\n").replace("\r", "\n")
+            if final:
+                return
+
+
+def scan_chunks(
+    chunks: Iterable[str],
+    rel_path: str,
+    is_markdown: bool = False,
+    profiler: Optional["ScanProfiler"] = None,
+) -> tuple[list[Finding], int]:
+    """テキストのチャンク列を、メモリ使用量を抑えながらスキャンする
+
+    結果は（行が LONG_LINE_LIMIT を超えない限り）scan_text と同じになる。
+    """
+    hits: dict[tuple[int, int], str] = {}
+    budget = RuleBudget(profile=profiler is not None)
+    rule_set = rule_set_for(rel_path)
+    scanned_chars = 0
+    tracker = ContextTracker() if is_markdown else None
+    text = ""         # ウィンドウ（先頭は text_line 行目の行頭。ただし長い行の途中の場合あり）
+    text_line = 0
+    scanned = 0       # text のうちスキャン済みの位置
+    fed = 0           # text のうち文脈の追跡に渡した位置
+    partial_fed = False  # 行途中で区切った行の先頭部分を追跡済みか
+    line_count = 0
+
+    for chunk in chain(chunks, [None]):
+        final = chunk is None
+        if not final:
+            text += chunk
+            cut = text.rfind("\n") + 1
+            if cut <= scanned:
+                if len(text) - scanned < LONG_LINE_LIMIT:
+                    continue
+                cut = len(text)  # 非常に長い行は途中で区切る
+        else:
+            cut = len(text)
+
+        window = text[:cut]
+        scanned_chars += cut - scanned
+        line_starts = build_line_index(window)
+        for (i, rule_id), matched_text in find_matches(window, line_starts, budget, rule_set).items():
+            hits.setdefault((text_line + i, rule_id), matched_text)
+
+        if tracker is not None:
+            new_lines = window[fed:].splitlines()
+            if partial_fed and new_lines:
+                new_lines = new_lines[1:]
+            # 行の途中で区切った場合は途中までの行を1回だけ渡し、残りは次回読み飛ばす
+            # （フェンスとフロントマターは行頭だけで決まる。HTMLコメントは近似になる）
+            tracker.feed(new_lines)
+            partial_fed = not final and bool(window) and len((window[-1] + "x").splitlines()) == 1
+            fed = cut
+
+        if final:
+            line_count = text_line + count_lines(window, line_starts)
+            break
+
+        # 次のウィンドウに重ねる部分（できれば行頭から）
+        keep_from = max(cut - CHUNK_OVERLAP, 0)
+        if keep_from > 0:
+            newline = text.find("\n", keep_from - 1, cut)
+            if newline != -1:
+                keep_from = newline + 1
+        text_line += bisect_right(line_starts, keep_from) - 1
+        text = text[keep_from:]
+        scanned = cut - keep_from
+        fed = max(fed - keep_from, 0)
+
+    if profiler:
+        profiler.record(rel_path, scanned_chars, budget, hits)
+    contexts = tracker.finish(line_count) if tracker is not None and hits else None
+    findings = build_findings(hits, rel_path, contexts)
+    return findings + budget_findings(budget, rel_path), line_count
+
+
+def scan_large_file(
+    filepath: Path,
+    rel_path: str,
+    profiler: Optional["ScanProfiler"] = None,
+) -> tuple[list[Finding], int]:
+    """大きなファイルをチャンク単位でスキャン"""
+    try:
+        with open(filepath, "rb") as fp:
+            sample = fp.read(BINARY_SCAN_LIMIT)
+        if is_binary(sample):
+            findings, line_count = scan_bytes(sample, rel_path, profiler)
+            return findings + binary_findings(rel_path), line_count
+        return scan_chunks(iter_text_chunks(filepath), rel_path, is_markdown_path(rel_path), profiler)
+    except (PermissionError, OSError):
+        return [], 0
+
+
+def read_file_bytes(filepath) -> bytes:
+    """ファイルを読む。読めない場合は空として扱う"""
+    try:
+        with open(filepath, "rb") as f:
+            return f.read()
+    except (PermissionError, OSError):
+        return b""
+
+
+# ---------------------------------------------------------------------------
+# デコード前の判定（バイナリ・アンカーの有無）
+# ---------------------------------------------------------------------------
+#
+# ルールのアンカーはすべて ASCII なので、UTF-8 のバイト列を ASCII の範囲で小文字化
+# すればデコード後のプレフィルタ（_fold）と同じ判定ができる。アンカーが1つも
+# 無いファイルはデコードせず、行数だけバイト列から数える。
+# バイナリ（先頭に NUL や制御文字が多い）は先頭 BINARY_SCAN_LIMIT バイトだけを標本として
+# スキャンし、残りは未検査として報告する。
+# 照合そのものは str のまま行う（\s・\w・IGNORECASE の Unicode の扱いを変えないため）。
+
+BINARY_SAMPLE = 8192  # バイナリ判定に使う先頭のバイト数
+BINARY_CONTROL_RATIO = 0.3  # これを超える割合で制御文字があればバイナリとみなす
+BINARY_SCAN_LIMIT = 1024 * 1024  # バイナリはこのバイト数を超える部分をスキャンしない
+# テキストに現れうる制御文字（タブ・改行類・ESC）以外
+_NON_TEXT_BYTES = bytes(b for b in range(32) if b not in b"\t\n\r\x0b\x0c\x1b") + b"\x7f"
+# IGNORECASE で ASCII 英字にマッチする非ASCII文字（İ ı ſ K）の UTF-8
+_FOLD_SPECIAL_BYTES = (b"\xc4\xb0", b"\xc4\xb1", b"\xc5\xbf", b"\xe2\x84\xaa")
+# LINE_BREAK のバイト列版。\n 以外の改行を含むかどうかの判定用
+_RARE_BYTE_BREAKS = re.compile(rb'[\r\x0b\x0c\x1c\x1d\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+_BYTE_LINE_BREAK = re.compile(rb'\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+_BYTE_LINE_BREAK_AT_END = re.compile(rb'(?:[\n\r\x0b\x0c\x1c\x1d\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9])\Z')
+
+
+def is_binary(sample: bytes) -> bool:
+    """先頭 BINARY_SAMPLE バイトに NUL があるか、制御文字が多ければバイナリとみなす"""
+    sample = sample[:BINARY_SAMPLE]
+    if not sample:
+        return False
+    if b"\x00" in sample:
+        return True
+    controls = len(sample) - len(sample.translate(None, _NON_TEXT_BYTES))
+    return controls > len(sample) * BINARY_CONTROL_RATIO
+
+
+def binary_findings(rel_path: str) -> list[Finding]:
+    """先頭しかスキャンしなかったバイナリを報告する（未検査のまま SAFE にしない）"""
+    return [
+        Finding(
+            category="scan_limit",
+            severity=Severity.MEDIUM,
+            message=(
+                f"テキストではない内容（NUL バイトや制御文字）を含むため、"
+                f"先頭 {BINARY_SCAN_LIMIT // 1024 // 1024}MB のみスキャンしました"
+            ),
+            file=rel_path,
+            line=1,
+            matched_text="",
+        )
+    ]
+
+
+def may_match_bytes(data: bytes, rule_set: RuleSet) -> bool:
+    """デコードした場合にいずれかのルールのアンカーが現れうるか"""
+    if rule_set.unanchored:
+        return True
+    if not data.isascii() and any(special in data for special in _FOLD_SPECIAL_BYTES):
+        return True
+    folded = data.lower()
+    if b"\r" in folded:
+        folded = folded.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    return any(anchor in folded for anchor in rule_set.byte_anchors)
+
+
+def count_lines_bytes(data: bytes) -> int:
+    """decode_text(data) を splitlines() した場合の行数"""
+    if not data:
+        return 0
+    if _RARE_BYTE_BREAKS.search(data) is None:
+        breaks = data.count(b"\n")
+    else:
+        breaks = len(_BYTE_LINE_BREAK.findall(data))
+    return breaks + (0 if _BYTE_LINE_BREAK_AT_END.search(data) else 1)
+
+
+def decode_text(data: bytes) -> str:
+    """read_text() と同じ規則（UTF-8 + replace、改行の正規化）でデコードする"""
+    return data.decode("utf-8", errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def is_markdown_path(rel_path: str) -> bool:
+    """コードブロック判定の対象（Markdown/テキスト）かどうか"""
+    return PurePosixPath(rel_path).suffix.lower() in {".md", ".txt"}
+
+
+def scan_blob(
+    data,
+    rel_path: str,
+    profiler: Optional["ScanProfiler"] = None,
+    metrics: Optional["ScanMetrics"] = None,
+) -> tuple[list[Finding], int]:
+    """ファイルシステムを経由せず、メモリ上の内容をスキャン（LargeFile はチャンク単位）"""
+    if isinstance(data, LargeFile):
+        return scan_large_file(data.path, rel_path, profiler)
+    if isinstance(data, (ArchiveError, OutsideSymlink)):
+        return data.findings(rel_path), 0
+    if isinstance(data, UnchangedFile):
+        return decode_findings(data.entry.findings, rel_path), data.entry.line_count
+    if isinstance(data, FileUpdate):
+        return scan_file_update(data, rel_path, profiler)
+    if len(data) > BINARY_SCAN_LIMIT and is_binary(data):
+        # 大きなバイナリは先頭だけを標本としてスキャンする
+        findings, _ = scan_bytes(data[:BINARY_SCAN_LIMIT], rel_path, profiler, metrics)
+        return findings + binary_findings(rel_path), count_lines_bytes(data)
+    return scan_bytes(data, rel_path, profiler, metrics)
+
+
+def scan_bytes(
+    data: bytes,
+    rel_path: str,
+    profiler: Optional["ScanProfiler"] = None,
+    metrics: Optional["ScanMetrics"] = None,
+) -> tuple[list[Finding], int]:
+    """バイト列をスキャンする。どのアンカーも含まなければデコードしない"""
+    if not may_match_bytes(data, rule_set_for(rel_path)):
+        # どのルールもマッチしえないのでデコードしない
+        if profiler:
+            profiler.record(rel_path, len(data), RuleBudget(profile=True), {})
+        return [], count_lines_bytes(data)
+    if metrics:
+        started = time.perf_counter()
+        content = decode_text(data)
+        metrics.add("decode", time.perf_counter() - started)
+        return scan_text(content, rel_path, is_markdown_path(rel_path), profiler, metrics)
+    return scan_text(decode_text(data), rel_path, is_markdown_path(rel_path), profiler)
+
+
+def scan_file(filepath: Path, base_dir: Path) -> tuple[list[Finding], int]:
+    """単一ファイルをスキャン"""
+    rel_path = str(filepath.relative_to(base_dir))
+    return scan_blob(read_file_bytes(filepath), rel_path)
+
+
+def blob_size(data) -> int:
+    """scan_blob に渡す内容のバイト数（並列スキャンのバッチ分割用）"""
+    if isinstance(data, LargeFile):
+        return data.size
+    if isinstance(data, FileUpdate):
+        return len(data.data)
+    return len(data) if isinstance(data, bytes) else 0
+
+
+def _scan_blob_batch(items: list[tuple[str, bytes]], with_metrics: bool = False):
+    """ワーカープロセスでメモリ上の複数ファイルをまとめてスキャンする
+
+    with_metrics の場合は (結果のリスト, ScanMetrics) を返す。
+    """
+    if not with_metrics:
+        return [scan_blob(data, rel_path) for rel_path, data in items]
+    metrics = ScanMetrics()
+    return [metrics.scan_blob(data, rel_path) for rel_path, data in items], metrics
+
+
+def resolve_jobs(jobs: int) -> int:
+    """--jobs の値を実際のワーカー数に変換する（0 は CPU 数）"""
+    if jobs <= 0:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def scan_blobs(
+    items: Iterable[tuple[str, bytes]],
+    jobs: int = 1,
+    cache: Optional["ScanCache"] = None,
+    profiler: Optional["ScanProfiler"] = None,
+    metrics: Optional["ScanMetrics"] = None,
+    bounded: bool = False,
+) -> Iterator[tuple[list[Finding], int]]:
+    """(相対パス, 内容) の列をスキャンし、入力順に結果を返す
+
+    cache があれば内容ハッシュで検索し、ヒットしたファイルはスキャンしない。
+    jobs が 2 以上の場合、キャッシュに無いファイルを小さなバッチにまとめて
+    プロセスプールでスキャンする。結果は入力順に返すため、出力は逐次と同一。
+    profiler を渡すと全ファイルを実際に評価する必要があるため、キャッシュを
+    使わず逐次でスキャンする。
+    metrics を渡すとキャッシュの検索・保存とスキャンの時間、読み込み量を数える。
+    bounded（--fail-fast や上限で打ち切りうる場合）なら1ファイルずつ投入し、
+    ワーカー数を超えて先読みしない。打ち切った時点で読んでいるのは、返した
+    ファイルのほかに高々 jobs 個になる。
+    """
+    jobs = resolve_jobs(jobs)
+    if profiler:
+        jobs, cache = 1, None
+    lookup = store = None
+    if cache:
+        lookup = metrics.cache_lookup(cache) if metrics else cache.lookup
+        store = metrics.timed_call("cache", cache.store) if metrics else cache.store
+    if metrics:
+        items = metrics.count_bytes(items)
+    if jobs <= 1:
+        scan = metrics.scan_blob if metrics else scan_blob
+        for rel_path, data in items:
+            cached = lookup(data, rel_path) if lookup else None
+            if cached is not None:
+                yield cached
+                continue
+            file_result = scan(data, rel_path, profiler)
+            if store:
+                store(data, rel_path, file_result)
+            yield file_result
+        return
+
+    def is_done(entry) -> bool:
+        future = entry[1]
+        return future is None or future.done()
+
+    def resolve(batch, future):
+        scanned = future.result() if future else ()
+        if future and metrics:
+            scanned, worker_metrics = scanned
+            metrics.merge(worker_metrics)
+        scanned = iter(scanned)
+        for rel_path, data, cached in batch:
+            if cached is None:
+                cached = next(scanned)
+                if store:
+                    store(data, rel_path, cached)
+            yield cached
+
+    batch_files = 1 if bounded else PARALLEL_BATCH_FILES
+    max_pending = jobs if bounded else jobs * 2
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # 投入済みバッチ。メモリを抑えるため同時に保持する数を制限する
+        pending: deque = deque()
+        batch: list = []
+        batch_bytes = 0
+
+        def submit():
+            misses = [(rel_path, data) for rel_path, data, cached in batch if cached is None]
+            future = executor.submit(_scan_blob_batch, misses, metrics is not None) if misses else None
+            pending.append((batch, future))
+
+        try:
+            for rel_path, data in items:
+                cached = lookup(data, rel_path) if lookup else None
+                batch.append((rel_path, data, cached))
+                if cached is None:
+                    batch_bytes += blob_size(data)
+                if batch_bytes >= PARALLEL_BATCH_BYTES or len(batch) >= batch_files:
+                    submit()
+                    batch, batch_bytes = [], 0
+                    # 先頭のバッチが終わっていれば待たずに返す（--fail-fast で早く打ち切れる）
+                    while len(pending) > max_pending or (pending and is_done(pending[0])):
+                        yield from resolve(*pending.popleft())
+            if batch:
+                submit()
+            while pending:
+                yield from resolve(*pending.popleft())
+        finally:
+            # 途中で閉じられた（--fail-fast などで打ち切った）場合は未着手のバッチを取り消す
+            for _batch, future in pending:
+                if future:
+                    future.cancel()
+
+
+# ---------------------------------------------------------------------------
+# ディレクトリの走査
+# ---------------------------------------------------------------------------
+#
+# os.scandir で走査し、DirEntry が持つ種別と stat の結果をそのまま使う（ファイル
+# ごとに Path を作らない）。除外は名前で指定するディレクトリ（SKIP_DIRS）と、
+# 利用者が渡す .gitignore 形式のパターン（--ignore-file）で行う。スキャン対象の
+# .gitignore は読まない。スキルの作者が自分のファイルをスキャンから外せてしまうため。
+#
+# シンボリックリンクは実体がスキルの中にあればその実体として扱い、外を指すものは
+# 辿らずに検出として報告する（インストールしたスキルがスキル外のファイルを読む
+# 経路になる）。同じディレクトリ（(st_dev, st_ino) が同じもの）には2度入らないので、
+# リンクの循環やバインドマウントがあっても走査は終わる。
+
+
+def _ignore_glob_regex(pattern: str) -> str:
+    """.gitignore のグロブを正規表現にする（"*" と "?" は "/" にマッチしない）"""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if (
+                pattern.startswith("**", i)
+                and (i == 0 or pattern[i - 1] == "/")
+                and (i + 2 == n or pattern[i + 2] == "/")
+            ):
+                if i + 2 < n:
+                    out.append("(?:.*/)?")  # "**/" は0個以上のディレクトリ
+                    i += 3
+                else:
+                    out.append(".*")  # 末尾の "/**" は中身すべて
+                    i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j]
+                if body[:1] in ("!", "^"):
+                    body = "^" + body[1:]
+                out.append("[" + body.replace("\\", "\\\\").replace("[", "\\[") + "]")
+                i = j + 1
+                continue
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+def compile_ignore_pattern(line: str) -> Optional[tuple[re.Pattern, bool, bool]]:
+    """.gitignore の1行を (正規表現, 否定か, ディレクトリのみか) にする。空行とコメントは None"""
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "  # "\ " で終わる行は末尾の空白を残す
+    line = stripped
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    # 途中に "/" を含むパターンはルートからの相対パス、含まなければどの階層の名前にもマッチする
+    anchored = "/" in line
+    if line.startswith("/"):
+        line = line[1:]
+    prefix = "" if anchored else "(?:.*/)?"
+    return re.compile(prefix + _ignore_glob_regex(line) + r"\Z"), negate, dir_only
+
+
+class IgnoreRules:
+    """走査しないディレクトリ名と、.gitignore 形式のパターン（後に書いたものが優先）"""
+
+    def __init__(self, patterns: Iterable[str] = (), skip_dirs: Iterable[str] = SKIP_DIRS):
+        self.skip_dirs = frozenset(skip_dirs)
+        self.patterns = [p for p in map(compile_ignore_pattern, patterns) if p is not None]
+
+    @classmethod
+    def from_files(cls, paths: Iterable, skip_dirs: Iterable[str] = SKIP_DIRS) -> "IgnoreRules":
+        patterns: list[str] = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                patterns.extend(f.read().splitlines())
+        return cls(patterns, skip_dirs)
+
+    def ignored(self, name: str, rel_path: str, is_dir: bool) -> bool:
+        """rel_path は "/" 区切りのルートからの相対パス"""
+        if is_dir and name in self.skip_dirs:
+            return True
+        ignored = False
+        for regex, negate, dir_only in self.patterns:
+            # 結果を変えうるパターンだけを評価する
+            if ignored == negate and (is_dir or not dir_only) and regex.match(rel_path):
+                ignored = not negate
+        return ignored
+
+
+DEFAULT_IGNORE = IgnoreRules()
+
+
+@dataclass(frozen=True)
+class OutsideSymlink:
+    """スキルの外を指すシンボリックリンク（辿らずに検出として報告する）"""
+    target: str
+
+    def findings(self, rel_path: str) -> list[Finding]:
+        return [
+            Finding(
+                category="path_traversal",
+                severity=Severity.HIGH,
+                message="スキルの外を指すシンボリックリンク",
+                file=rel_path,
+                line=1,
+                matched_text=_truncate(f"-> {self.target}"),
+            )
+        ]
+
+
+def _is_within(path: str, root: str) -> bool:
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def walk_scan_targets(
+    root: Path,
+    ignore: Optional[IgnoreRules] = None,
+) -> Iterator[tuple[str, object]]:
+    """スキャン対象を走査順に (相対パス, os.DirEntry または OutsideSymlink) で返す
+
+    各ディレクトリのファイルを先に、サブディレクトリをその後に返す（os.walk と同じ順）。
+    """
+    ignore = ignore or DEFAULT_IGNORE
+    root_path = os.fspath(root)
+    real_root = os.path.realpath(root_path)
+    try:
+        st = os.stat(root_path)
+    except OSError:
+        return
+    visited = {(st.st_dev, st.st_ino)}
+    native = (lambda rel: rel) if os.sep == "/" else (lambda rel: rel.replace("/", os.sep))
+    # (ディレクトリのパス, "/" 区切りの相対パスの接頭辞)
+    stack = [(root_path, "")]
+    while stack:
+        dir_path, prefix = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            name = entry.name
+            rel = prefix + name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if ignore.ignored(name, rel, is_dir):
+                continue
+            if entry.is_symlink():
+                target = os.path.realpath(entry.path)
+                if not _is_within(target, real_root):
+                    yield native(rel), OutsideSymlink(target)
+                    continue
+            if is_dir:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                key = (st.st_dev, st.st_ino)
+                if key in visited:
+                    # リンクの循環、または別の経路で既に辿ったディレクトリ
+                    continue
+                visited.add(key)
+                subdirs.append((entry.path, rel + "/"))
+            elif (should_scan_name(name) or archive_kind(name)) and entry.is_file():
+                # FIFO やデバイス、リンク切れは読まない
+                yield native(rel), entry
+        stack.extend(reversed(subdirs))
+
+
+def iter_directory_items(
+    dir_path: Path,
+    result: ScanResult,
+    max_file_size: int = MAX_FILE_SIZE,
+    high_risk_first: bool = False,
+    ignore: Optional[IgnoreRules] = None,
+    metrics: Optional["ScanMetrics"] = None,
+) -> Iterator[tuple[str, object]]:
+    """スキャン対象を (相対パス, 内容) で返す
+
+    大きなファイルは LargeFile としてチャンクスキャンに回し、max_file_size を
+    超えるファイルは読まずに result.errors に記録する。
+    アーカイブはディスクに展開せずにメンバーを返す（展開量の上限はディレクトリ全体で共有）。
+    high_risk_first なら走査順ではなく危険の大きいファイルから返す（risk_rank）。
+    metrics を渡すと走査・読み込み・アーカイブの展開の時間を数える。
+    """
+    budget = ExtractionBudget()
+    targets = walk_scan_targets(dir_path, ignore)
+    if metrics:
+        targets = metrics.timed("walk", targets)
+    if high_risk_first:
+        targets = sorted(targets, key=lambda target: risk_rank(os.path.basename(target[0])))
+    for rel_path, entry in targets:
+        if isinstance(entry, OutsideSymlink):
+            yield rel_path, entry
+            continue
+        if archive_kind(entry.name):
+            path = Path(entry.path)
+            members = iter_archive_items(rel_path, lambda path=path: open_archive(path), budget)
+            yield from metrics.timed("archive", members) if metrics else members
+            continue
+        started = time.perf_counter() if metrics else 0.0
+        try:
+            size = entry.stat().st_size
+        except OSError:
+            size = 0
+        if size > max_file_size:
+            result.errors.append(
+                f"ファイルサイズが上限（{max_file_size / 1024 / 1024:.0f}MB）を超えたため"
+                f"スキャンしていません: {rel_path}（{size / 1024 / 1024:.1f}MB）"
+            )
+            result.skipped_files += 1
+        elif size > LARGE_FILE_THRESHOLD:
+            yield rel_path, LargeFile(Path(entry.path), size)
+        elif metrics:
+            data = read_file_bytes(entry.path)
+            metrics.add("read", time.perf_counter() - started)
+            yield rel_path, data
+        else:
+            yield rel_path, read_file_bytes(entry.path)
+
+
+def scan_directory(
+    dir_path: Path,
+    jobs: int = 1,
+    cache: Optional["ScanCache"] = None,
+    reporter=None,
+    max_file_size: int = MAX_FILE_SIZE,
+    profiler: Optional["ScanProfiler"] = None,
+    max_per_rule: Optional[int] = None,
+    update: Optional["SkillUpdate"] = None,
+    limits: Optional["ScanLimits"] = None,
+    ignore: Optional[IgnoreRules] = None,
+    metrics: Optional["ScanMetrics"] = None,
+) -> ScanResult:
+    """ディレクトリ全体をスキャン
+
+    jobs が 2 以上の場合はプロセスプールで並列にスキャンする。結果は走査順に
+    結合するため、出力は逐次スキャンと同一になる。
+    reporter を渡すと検出は ScanResult に保持せず、見つかった順に書き出す。
+    profiler を渡すとルールごとの評価コストを集計し、result.profile に入れる。
+    max_per_rule を指定すると、同じファイルの同じルールの検出は最初の N 件だけ保持する。
+    update を渡すとマニフェストを記録し、インストール済みのバージョンとの差分をスキャンする。
+    limits を渡すと危険の大きいファイルから順にスキャンし、条件を満たしたら打ち切る。
+    ignore を渡すと既定の除外ディレクトリの代わりにその規則で走査から外す。
+    metrics を渡すとフェーズごとの所要時間と読み込み量を数える（ScanMetrics）。
+    """
+    result = ScanResult(path=str(dir_path), findings=FindingStore(max_per_rule))
+    if profiler:
+        cache = None
+    if cache:
+        cache.reset_stats()
+    cutoff = limits.start() if limits else None
+    items = iter_directory_items(
+        dir_path, result, max_file_size, high_risk_first=cutoff is not None, ignore=ignore,
+        metrics=metrics,
+    )
+    if cutoff:
+        items = cutoff.items(items)
+    if update is not None:
+        items = update.items(items)
+
+    for findings, line_count in scan_blobs(items, jobs, cache, profiler, metrics, cutoff is not None):
+        if update is not None:
+            update.record(findings, line_count)
+        result.file_count += 1
+        result.total_lines += line_count
+        result.add_findings(findings, reporter)
+        if cutoff and cutoff.after_file(result):
+            break
+
+    finish_result(result, cache, cutoff)
+    if profiler:
+        result.profile = profiler.to_dict()
+    if update is not None:
+        result.update = update.finish(complete=result.partial is None)
+    return result
+
+
+def finish_result(
+    result: ScanResult,
+    cache: Optional["ScanCache"] = None,
+    cutoff: Optional["ScanCutoff"] = None,
+):
+    """判定とキャッシュ統計、打ち切った場合はその内容を設定する"""
+    if cutoff and cutoff.reason:
+        result.partial = cutoff.to_dict()
+    result.verdict = verdict_from_counts(result.severity_counts)
+    if (result.skipped_files or result.partial) and result.verdict == "SAFE":
+        # 未検査のファイルが残っている以上 SAFE とは言えない
+        result.verdict = "WARNING"
+    if cache:
+        result.cache_stats = cache.stats()
+
+
+class ZipBombError(Exception):
+    """ZIPメンバーの実際の展開量が上限を超えた"""
+
+
+class UnsafeMemberError(Exception):
+    """アーカイブのメンバーのパスが展開先の外を指している"""
+
+
+class ExtractionBudget:
+    """入れ子を含むアーカイブ全体で共有する展開量の上限"""
+
+    def __init__(self, limit: int = MAX_ZIP_SIZE):
+        self.limit = limit
+        self.remaining = limit
+
+    def take(self, size: int):
+        self.remaining -= size
+        if self.remaining < 0:
+            raise ZipBombError(
+                f"展開後の合計サイズが上限（{self.limit / 1024 / 1024:.0f}MB）を超えています"
+            )
+
+
+def iter_limited_chunks(fp, name: str, budget: ExtractionBudget) -> Iterator[bytes]:
+    """メンバーを上限付きでストリーム展開し、ZIP_READ_CHUNK ずつ返す
+
+    ヘッダーのサイズはアーカイブ自身が申告する値なので信用せず、
+    実際に展開したバイト数でメンバー単体と累計の上限を判定する。
+    """
+    size = 0
+    while True:
+        chunk = fp.read(ZIP_READ_CHUNK)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_ZIP_MEMBER_SIZE:
+            raise ZipBombError(
+                f"{name} の展開後サイズが上限"
+                f"（{MAX_ZIP_MEMBER_SIZE / 1024 / 1024:.0f}MB）を超えています"
+            )
+        budget.take(len(chunk))
+        yield chunk
+
+
+def read_limited(fp, name: str, budget: ExtractionBudget) -> bytes:
+    """メンバーを上限付きでメモリに展開する"""
+    return b"".join(iter_limited_chunks(fp, name, budget))
+
+
+# ---------------------------------------------------------------------------
+# アーカイブ（ZIP / tar と、その入れ子）
+# ---------------------------------------------------------------------------
+#
+# アーカイブはディスクに展開せず、メンバーを1つずつメモリに展開してスキャンする。
+# メンバーがアーカイブなら、その内容も「外側のパス!/内側のパス」としてスキャンする
+# （入れ子にして検査をすり抜ける手口への対策）。展開量の上限（ExtractionBudget）は
+# 入れ子の全階層で共有し、MAX_ARCHIVE_DEPTH より深い入れ子は展開しない。
+
+ZIP_SUFFIXES = (".skill", ".zip")
+TAR_SUFFIXES = (".tar", ".tgz", ".tar.gz")
+MAX_ARCHIVE_DEPTH = 3  # 最も外側のアーカイブを 1 とする
+
+
+def archive_kind(name: str) -> Optional[str]:
+    """"zip" / "tar"（アーカイブでなければ None）"""
+    lower = name.lower()
+    if lower.endswith(ZIP_SUFFIXES):
+        return "zip"
+    if lower.endswith(TAR_SUFFIXES):
+        return "tar"
+    return None
+
+
+def archive_stem(name: str) -> str:
+    """アーカイブの拡張子を除いた名前（foo.tar.gz → foo）"""
+    lower = name.lower()
+    for suffix in ZIP_SUFFIXES + TAR_SUFFIXES:
+        if lower.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def is_scan_member(member: PurePosixPath) -> bool:
+    """アーカイブのメンバーをスキャン（または入れ子として展開）するか"""
+    # 除外ディレクトリ配下のメンバーはスキップ
+    if any(part in SKIP_DIRS for part in member.parts[:-1]):
+        return False
+    return should_scan_file(member) or archive_kind(member.name) is not None
+
+
+def declared_size_error(
+    zf: zipfile.ZipFile, file_size: int, limit: int = MAX_ZIP_SIZE
+) -> Optional[str]:
+    """ヘッダー申告値による展開後サイズの事前チェック
+
+    上限は ExtractionBudget と同じ値を使い、実際の展開時の判定とずらさない。
+    """
+    total_uncompressed = sum(info.file_size for info in zf.infolist())
+    if total_uncompressed > limit:
+        return (
+            f"展開後サイズ {total_uncompressed / 1024 / 1024:.1f}MB "
+            f"（圧縮率 {total_uncompressed / max(file_size, 1):.0f}x）"
+        )
+    return None
+
+
+def iter_zip_members(
+    zf: zipfile.ZipFile,
+    budget: Optional[ExtractionBudget] = None,
+    prefix: str = "",
+    depth: int = 1,
+) -> Iterator[tuple[str, object]]:
+    """スキャン対象メンバーを順にストリーム展開し、(名前, 内容) を返す"""
+    budget = budget or ExtractionBudget()
+    for info in zf.infolist():
+        if info.is_dir() or not is_scan_member(PurePosixPath(info.filename)):
+            continue
+        with zf.open(info) as fp:
+            data = read_limited(fp, info.filename, budget)
+        yield from expand_member(prefix + info.filename, data, budget, depth)
+
+
+def iter_tar_members(
+    tf: tarfile.TarFile,
+    budget: Optional[ExtractionBudget] = None,
+    prefix: str = "",
+    depth: int = 1,
+) -> Iterator[tuple[str, object]]:
+    """tar のメンバーを先頭から順に展開し、(名前, 内容) を返す（ストリームモードで使う）"""
+    budget = budget or ExtractionBudget()
+    for info in tf:
+        if not info.isfile():
+            # リンク・デバイスなどは内容を持たない
+            continue
+        member = PurePosixPath(info.name)
+        fp = tf.extractfile(info) if is_scan_member(member) else None
+        if fp is None:
+            # 読み飛ばす場合も圧縮の展開は行われるため、申告サイズを上限に数える
+            budget.take(info.size)
+            continue
+        data = read_limited(fp, info.name, budget)
+        # "./SKILL.md" のような名前は正規化してディレクトリのスキャンと揃える
+        yield from expand_member(prefix + member.as_posix(), data, budget, depth)
+
+
+def open_archive(source, kind: Optional[str] = None):
+    """ファイルパスまたはバイト列のアーカイブを開く（tar は先頭から読むストリームモード）"""
+    if kind is None:
+        kind = archive_kind(source.name)
+    fileobj = io.BytesIO(source) if isinstance(source, bytes) else None
+    if kind == "zip":
+        return zipfile.ZipFile(fileobj or source, "r")
+    if fileobj is not None:
+        return tarfile.open(fileobj=fileobj, mode="r|*")
+    return tarfile.open(source, mode="r|*")
+
+
+def iter_archive_members(archive, budget: ExtractionBudget, prefix: str = "", depth: int = 1):
+    if isinstance(archive, zipfile.ZipFile):
+        return iter_zip_members(archive, budget, prefix, depth)
+    return iter_tar_members(archive, budget, prefix, depth)
+
+
+def expand_member(
+    rel_path: str,
+    data: bytes,
+    budget: ExtractionBudget,
+    depth: int,
+) -> Iterator[tuple[str, object]]:
+    """メンバーがアーカイブなら入れ子として展開し、それ以外はそのまま返す"""
+    kind = archive_kind(rel_path)
+    if kind is None:
+        yield rel_path, data
+        return
+    yield from iter_nested_archive(
+        rel_path, lambda: open_archive(data, kind), budget, depth + 1,
+    )
+
+
+def iter_nested_archive(
+    rel_path: str,
+    opener,
+    budget: ExtractionBudget,
+    depth: int,
+) -> Iterator[tuple[str, object]]:
+    """opener() で開いたアーカイブのメンバーを "rel_path!/メンバー" として返す
+
+    展開できない場合は ArchiveError を返す（展開量の上限超過だけは呼び出し元に送出する）。
+    """
+    if depth > MAX_ARCHIVE_DEPTH:
+        yield rel_path, ArchiveError(
+            f"アーカイブの入れ子が深すぎるため展開していません（上限 {MAX_ARCHIVE_DEPTH} 段）",
+            Severity.MEDIUM,
+        )
+        return
+    try:
+        with opener() as archive:
+            yield from iter_archive_members(archive, budget, rel_path + "!/", depth)
+    except ZipBombError:
+        raise
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, tarfile.TarError, EOFError, OSError) as e:
+        yield rel_path, ArchiveError(f"入れ子のアーカイブを展開できません: {e}")
+
+
+def iter_archive_items(rel_path: str, opener, budget: ExtractionBudget) -> Iterator[tuple[str, object]]:
+    """ディレクトリなどの中のアーカイブのメンバーを返す（上限超過も ArchiveError にする）"""
+    try:
+        yield from iter_nested_archive(rel_path, opener, budget, depth=1)
+    except ZipBombError as e:
+        yield rel_path, ArchiveError(f"ZIPボムの可能性: {e}")
+
+
+def iter_archive_file(path: Path, budget: Optional[ExtractionBudget] = None) -> Iterator[tuple[str, object]]:
+    """アーカイブファイルのメンバー（入れ子を含む）を順にストリーム展開する"""
+    budget = budget or ExtractionBudget()
+    with open_archive(path) as archive:
+        if isinstance(archive, zipfile.ZipFile):
+            error = declared_size_error(archive, path.stat().st_size, budget.limit)
+            if error:
+                raise ZipBombError(error)
+        yield from iter_archive_members(archive, budget)
+
+
+def scan_archive(
+    archive_path: Path,
+    jobs: int = 1,
+    cache: Optional["ScanCache"] = None,
+    reporter=None,
+    profiler: Optional["ScanProfiler"] = None,
+    max_per_rule: Optional[int] = None,
+    limits: Optional["ScanLimits"] = None,
+    metrics: Optional["ScanMetrics"] = None,
+) -> ScanResult:
+    """ZIP/.skill/tar ファイルをスキャン（入れ子のアーカイブも展開する）
+
+    limits を渡すと条件を満たしたら打ち切る（メンバーの順序はアーカイブ内の順のまま）。
+    metrics を渡すとメンバーの展開（archive）とスキャンの時間を数える。
+    """
+    result = ScanResult(path=str(archive_path), findings=FindingStore(max_per_rule))
+    if profiler:
+        cache = None
+    if cache:
+        cache.reset_stats()
+
+    if check_zip_file_size(archive_path, result) is None:
+        return result
+
+    cutoff = limits.start() if limits else None
+    items = iter_archive_file(archive_path)
+    if metrics:
+        items = metrics.timed("archive", items)
+    if cutoff:
+        items = cutoff.items(items)
+    try:
+        # 一時ディレクトリに展開せず、メンバーを直接ストリーム展開してスキャン
+        for findings, line_count in scan_blobs(items, jobs, cache, profiler, metrics, cutoff is not None):
+            result.file_count += 1
+            result.total_lines += line_count
+            result.add_findings(findings, reporter)
+            if cutoff and cutoff.after_file(result):
+                break
+    except Exception as e:
+        record_zip_error(result, e)
+        return result
+
+    finish_result(result, cache, cutoff)
+    if profiler:
+        result.profile = profiler.to_dict()
+    return result
+
+
+# 以前の名前（ZIP 専用だった頃の API）
+scan_zip = scan_archive
+
+
+def check_zip_file_size(zip_path: Path, result: ScanResult) -> Optional[int]:
+    """ZIP ファイル自体のサイズを検査する。問題があれば result を DANGER にして None を返す"""
+    # ZIPボム検出
+    try:
+        file_size = zip_path.stat().st_size
+        if file_size > MAX_ZIP_SIZE:
+            result.errors.append(f"ファイルサイズが上限（100MB）を超えています: {file_size / 1024 / 1024:.1f}MB")
+            result.verdict = "DANGER"
+            return None
+    except OSError as e:
+        result.errors.append(f"ファイルアクセスエラー: {e}")
+        result.verdict = "DANGER"
+        return None
+    return file_size
+
+
+def check_zip_headers(zf: zipfile.ZipFile, file_size: int, result: ScanResult) -> bool:
+    """展開後サイズチェック（ヘッダー申告値による事前チェック）"""
+    error = declared_size_error(zf, file_size)
+    if error:
+        result.errors.append(f"ZIPボムの可能性: {error}")
+        result.verdict = "DANGER"
+        return False
+    return True
+
+
+def record_zip_error(result: ScanResult, error: Exception):
+    """アーカイブの展開中の例外をエラーとして記録し、DANGER にする"""
+    if isinstance(error, ZipBombError):
+        result.errors.append(f"ZIPボムの可能性: {error}")
+    elif isinstance(error, UnsafeMemberError):
+        result.errors.append(f"展開先の外を指すメンバーがあります: {error}")
+    elif isinstance(error, zipfile.BadZipFile):
+        result.errors.append("無効なZIPファイルです")
+    elif isinstance(error, tarfile.TarError):
+        result.errors.append(f"無効なtarファイルです: {error}")
+    else:
+        result.errors.append(f"ZIP展開エラー: {error}")
+    result.verdict = "DANGER"
+
+
+def count_severities(findings: Iterable[Finding]) -> list[int]:
+    """severity ごとの件数（添字が Severity の値）"""
+    counts = [0] * len(Severity)
+    for f in findings:
+        counts[f.severity] += 1
+    return counts
+
+
+def verdict_from_counts(counts: list[int]) -> str:
+    """severity ごとの件数から最終判定を返す"""
+    if counts[Severity.HIGH] or counts[Severity.CRITICAL]:
+        return "DANGER"
+    elif counts[Severity.MEDIUM]:
+        return "WARNING"
+    elif counts[Severity.LOW] >= 3:
+        # LOW が3件以上ある場合は WARNING
+        return "WARNING"
+    else:
+        return "SAFE"
+
+
+def determine_verdict(findings: list[Finding]) -> str:
+    """検出結果から最終判定を返す"""
+    return verdict_from_counts(count_severities(findings))
+
+
+# ---------------------------------------------------------------------------
+# スキャンの打ち切り（--fail-fast / --max-seconds / --max-total-size / --max-files）
+# ---------------------------------------------------------------------------
+#
+# --install の可否は判定が DANGER かどうかで決まり、HIGH 以上の検出が1件でも
+# あれば判定は DANGER から変わらない。--fail-fast ではその時点で残りのスキャンを
+# やめる。時間・読み込み量・ファイル数の上限に達した場合も打ち切り、未検査の
+# ファイルが残った部分的な結果（ScanResult.partial）として返す。部分的な結果の
+# 判定は SAFE にしない。打ち切る可能性がある場合は、危険の大きいファイル
+# （SKILL.md、スクリプト、設定ファイルの順）から先にスキャンする。
+
+SKILL_MD_RISK_RANK = 0
+# ファイル種別ごとのスキャン順（小さいほど先）。種別が不明なもの（Makefile など）は
+# 実行されうるのでスクリプトと同じ扱いにする
+RISK_RANKS = {"python": 1, "js": 1, "shell": 1, "code": 1, None: 1, "config": 2}
+OTHER_RISK_RANK = 3
+
+
+def risk_rank(name: str) -> int:
+    """打ち切る可能性がある場合のスキャン順（小さいほど先、同じなら走査順）"""
+    if name.lower() == "skill.md":
+        return SKILL_MD_RISK_RANK
+    if archive_kind(name):
+        return OTHER_RISK_RANK
+    return RISK_RANKS.get(file_class(name), OTHER_RISK_RANK)
+
+
+@dataclass(frozen=True)
+class ScanLimits:
+    """スキャンを打ち切る条件（None は無制限）"""
+    fail_fast: bool = False
+    max_seconds: Optional[float] = None
+    max_bytes: Optional[int] = None
+    max_files: Optional[int] = None
+
+    def start(self) -> "ScanCutoff":
+        """1回のスキャンの計測を始める"""
+        return ScanCutoff(self)
+
+
+class ScanCutoff:
+    """1回のスキャンで ScanLimits をどこまで使ったかを数え、打ち切りを判定する
+
+    items() はスキャンに渡す前に時間・読み込み量・ファイル数を確かめ、上限に
+    達したら以降を渡さない（渡した分は最後までスキャンする）。スキャン結果を
+    1件受け取るたびに after_file() を呼び、True なら呼び出し元は残りの結果を
+    待たずに打ち切る。
+    """
+
+    def __init__(self, limits: ScanLimits):
+        self.limits = limits
+        self.started = time.monotonic()
+        self.files = 0
+        self.bytes = 0
+        # 打ち切った理由（ScanLimits のフィールド名。打ち切っていなければ None）
+        self.reason: Optional[str] = None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def _out_of_time(self) -> bool:
+        return self.limits.max_seconds is not None and self.elapsed() > self.limits.max_seconds
+
+    def _exhausted(self, size: int) -> Optional[str]:
+        """size バイトのファイルを渡すと上限を超えるなら、その上限の名前"""
+        limits = self.limits
+        if limits.max_files is not None and self.files >= limits.max_files:
+            return "max_files"
+        if limits.max_bytes is not None and self.bytes + size > limits.max_bytes:
+            return "max_bytes"
+        if self._out_of_time():
+            return "max_seconds"
+        return None
+
+    def items(self, items: Iterable[tuple[str, object]]) -> Iterator[tuple[str, object]]:
+        for rel_path, data in items:
+            size = blob_size(data)
+            # after_file で打ち切りが決まっていれば、それ以降は渡さない
+            if self.reason is None:
+                self.reason = self._exhausted(size)
+            if self.reason is not None:
+                return
+            self.files += 1
+            self.bytes += size
+            yield rel_path, data
+
+    def after_file(self, result: ScanResult) -> bool:
+        """1ファイル分の結果を result に反映した後に呼ぶ。すぐに打ち切るなら True"""
+        counts = result.severity_counts
+        if self.limits.fail_fast and (counts[Severity.HIGH] or counts[Severity.CRITICAL]):
+            self.reason = "fail_fast"
+            return True
+        if self._out_of_time():
+            self.reason = "max_seconds"
+            return True
+        return False
+
+    def message(self) -> str:
+        limits = self.limits
+        if self.reason == "fail_fast":
+            return "HIGH 以上の検出で判定が DANGER に確定したため打ち切りました"
+        if self.reason == "max_seconds":
+            return f"時間の上限（{limits.max_seconds:g} 秒）に達したため打ち切りました"
+        if self.reason == "max_bytes":
+            return f"読み込み量の上限（{limits.max_bytes / 1024 / 1024:.4g}MB）に達したため打ち切りました"
+        return f"ファイル数の上限（{limits.max_files}）に達したため打ち切りました"
+
+    def to_dict(self) -> dict:
+        return {
+            "reason": self.reason,
+            "message": self.message(),
+            "read_files": self.files,
+            "read_bytes": self.bytes,
+            "elapsed": round(self.elapsed(), 3),
+        }
+
+
+# ---------------------------------------------------------------------------
+# ルールごとのプロファイル（--profile）
+# ---------------------------------------------------------------------------
+
+@dataclass
+class RuleStats:
+    time: float = 0.0     # search / finditer の累積時間（秒）
+    evaluated: int = 0    # 評価した行・窓の数
+    chars: int = 0        # 評価した文字数
+    matches: int = 0      # マッチした（行, ルール）の数
+    by_extension: dict = field(default_factory=dict)  # 拡張子 → 時間（秒）
+
+
+class ScanProfiler:
+    """ルールごと・拡張子ごとの評価コストを集計する"""
+
+    def __init__(self):
+        self.rules = [RuleStats() for _ in PATTERNS]
+        self.extensions: dict[str, dict] = {}
+
+    def record(self, rel_path: str, chars: int, budget: RuleBudget, hits: dict):
+        """1ファイル分の結果を加算する"""
+        ext = PurePosixPath(rel_path).suffix.lower() or "(なし)"
+        ext_stats = self.extensions.setdefault(ext, {"files": 0, "chars": 0, "time": 0.0})
+        ext_stats["files"] += 1
+        ext_stats["chars"] += chars
+        for rule_id, seconds in budget.spent.items():
+            stats = self.rules[rule_id]
+            stats.time += seconds
+            stats.by_extension[ext] = stats.by_extension.get(ext, 0.0) + seconds
+            ext_stats["time"] += seconds
+        for rule_id, evaluated in budget.evaluated.items():
+            self.rules[rule_id].evaluated += evaluated
+            self.rules[rule_id].chars += budget.chars[rule_id]
+        for _line, rule_id in hits:
+            self.rules[rule_id].matches += 1
+
+    def to_dict(self) -> dict:
+        """時間の降順に並べた JSON 用の辞書"""
+        order = sorted(range(len(self.rules)), key=lambda idx: -self.rules[idx].time)
+        return {
+            "rules": [
+                {
+                    "rule": idx,
+                    "category": PATTERNS[idx].category,
+                    "message": PATTERNS[idx].message,
+                    "pattern": PATTERNS[idx].pattern,
+                    "time_ms": round(self.rules[idx].time * 1000, 3),
+                    "evaluated": self.rules[idx].evaluated,
+                    "chars": self.rules[idx].chars,
+                    "matches": self.rules[idx].matches,
+                    "time_ms_by_extension": {
+                        ext: round(seconds * 1000, 3)
+                        for ext, seconds in sorted(
+                            self.rules[idx].by_extension.items(), key=lambda item: -item[1]
+                        )
+                    },
+                }
+                for idx in order
+            ],
+            "extensions": {
+                ext: {
+                    "files": stats["files"],
+                    "chars": stats["chars"],
+                    "time_ms": round(stats["time"] * 1000, 3),
+                }
+                for ext, stats in sorted(self.extensions.items(), key=lambda item: -item[1]["time"])
+            },
+        }
+
+
+# ---------------------------------------------------------------------------
+# 運用メトリクス（--metrics / --metrics-file）
+# ---------------------------------------------------------------------------
+#
+# フェーズごとの所要時間と、ファイル数・読み込み量・検出件数を集計する。--profile と
+# 違いキャッシュと並列スキャンはそのまま使い、並列時のスキャンのフェーズはワーカーの
+# 時間の合計になる。計測しない場合（metrics が None）はファイル単位で None かを
+# 確かめるだけで、行やルールの単位では何もしない。
+#
+# match はスキャン（scan_blob）全体の時間から decode と context を引いたもの。
+
+METRIC_PHASES = ("walk", "read", "archive", "stage", "cache", "decode", "match", "context", "report")
+# 1ファイルのスキャン時間のヒストグラムの境界（秒）
+FILE_SECONDS_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0)
+SLOWEST_FILES = 5  # スキャン時間の長いファイルを何件報告するか
+METRICS_PREFIX = "skill_scanner"
+
+
+class ScanMetrics:
+    """フェーズごとの所要時間と件数を集計する（複数のスキャンの結果を足し合わせられる）"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(METRIC_PHASES, 0.0)
+        self.scan_seconds = 0.0  # scan_blob の合計
+        self.buckets = [0] * (len(FILE_SECONDS_BUCKETS) + 1)
+        self.slowest: list[tuple[float, str]] = []
+        self.scanned = 0
+        self.cached = 0
+        self.bytes_read = 0
+        self.files = 0
+        self.skipped = 0
+        self.errors = 0
+        self.partial = 0
+        self.findings = [0] * len(Severity)
+        self.verdicts = dict.fromkeys(VERDICT_ORDER, 0)
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] += seconds
+
+    def timed(self, phase: str, items: Iterable) -> Iterator:
+        """items から取り出すのにかかった時間を phase に加算しながら返す"""
+        iterator = iter(items)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.phases[phase] += time.perf_counter() - started
+                yield item
+        finally:
+            # 途中で閉じられたら元のジェネレータも閉じる（開いたアーカイブを閉じるため）
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+
+    def timed_call(self, phase: str, func):
+        """func を呼ぶたびに時間を phase に加算する関数"""
+        def call(*args):
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.phases[phase] += time.perf_counter() - started
+        return call
+
+    def count_bytes(self, items: Iterable[tuple[str, object]]) -> Iterator[tuple[str, object]]:
+        """scan_blobs に渡す (相対パス, 内容) の読み込み量を数える"""
+        for item in items:
+            self.bytes_read += blob_size(item[1])
+            yield item
+
+    def cache_lookup(self, cache: "ScanCache"):
+        """時間とヒット数を数える cache.lookup"""
+        lookup = self.timed_call("cache", cache.lookup)
+
+        def call(data, rel_path: str):
+            cached = lookup(data, rel_path)
+            if cached is not None:
+                self.cached += 1
+            return cached
+        return call
+
+    def scan_blob(self, data, rel_path: str, profiler: Optional["ScanProfiler"] = None):
+        """scan_blob を呼び、1ファイルのスキャン時間を記録する"""
+        started = time.perf_counter()
+        file_result = scan_blob(data, rel_path, profiler, self)
+        seconds = time.perf_counter() - started
+        self.scanned += 1
+        self.scan_seconds += seconds
+        self.buckets[bisect_right(FILE_SECONDS_BUCKETS, seconds)] += 1
+        if len(self.slowest) < SLOWEST_FILES:
+            heapq.heappush(self.slowest, (seconds, rel_path))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, rel_path))
+        return file_result
+
+    def merge(self, other: "ScanMetrics"):
+        """ワーカーで集計したスキャンの時間を加える"""
+        for phase, seconds in other.phases.items():
+            self.phases[phase] += seconds
+        self.scan_seconds += other.scan_seconds
+        self.scanned += other.scanned
+        for idx, n in enumerate(other.buckets):
+            self.buckets[idx] += n
+        for entry in other.slowest:
+            if len(self.slowest) < SLOWEST_FILES:
+                heapq.heappush(self.slowest, entry)
+            elif entry[0] > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def add_result(self, result: ScanResult):
+        """スキャン1回分の結果（ファイル数・検出件数・判定）を加える"""
+        self.files += result.file_count
+        self.skipped += result.skipped_files
+        self.errors += len(result.errors)
+        self.partial += result.partial is not None
+        for sev, n in enumerate(result.severity_counts):
+            self.findings[sev] += n
+        self.verdicts[result.verdict] += 1
+
+    def phase_seconds(self) -> dict[str, float]:
+        phases = dict(self.phases)
+        phases["match"] = max(0.0, self.scan_seconds - phases["decode"] - phases["context"])
+        return phases
+
+    def to_dict(self) -> dict:
+        cumulative = list(accumulate(self.buckets))
+        return {
+            "duration_seconds": round(time.perf_counter() - self.started, 6),
+            "phases": {phase: round(seconds, 6) for phase, seconds in self.phase_seconds().items()},
+            "files": {
+                "total": self.files,
+                "scanned": self.scanned,
+                "cached": self.cached,
+                "skipped": self.skipped,
+            },
+            "bytes_read": self.bytes_read,
+            "findings": {SEVERITY_LABELS[sev]: self.findings[sev] for sev in reversed(Severity)},
+            "errors": self.errors,
+            "partial": self.partial,
+            "verdicts": dict(self.verdicts),
+            "file_scan_seconds": {
+                "buckets": {
+                    str(bound): n for bound, n in zip(FILE_SECONDS_BUCKETS + ("+Inf",), cumulative)
+                },
+                "sum": round(self.scan_seconds, 6),
+                "count": self.scanned,
+            },
+            "slowest_files": [
+                {"file": rel_path, "seconds": round(seconds, 6)}
+                for seconds, rel_path in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+    def to_openmetrics(self) -> str:
+        """OpenMetrics のテキスト形式（node_exporter の textfile collector などで読む）"""
+        p = METRICS_PREFIX
+        lines = []
+
+        def family(name: str, kind: str, help_text: str, unit: Optional[str] = None):
+            lines.append(f"# TYPE {p}_{name} {kind}")
+            if unit:
+                lines.append(f"# UNIT {p}_{name} {unit}")
+            lines.append(f"# HELP {p}_{name} {help_text}")
+
+        family("duration_seconds", "gauge", "Wall-clock time of the scanner run.", "seconds")
+        lines.append(f"{p}_duration_seconds {time.perf_counter() - self.started:.6f}")
+        family("phase_seconds", "gauge", "Time spent in each phase (summed over workers).", "seconds")
+        for phase, seconds in self.phase_seconds().items():
+            lines.append(f'{p}_phase_seconds{{phase="{phase}"}} {seconds:.6f}')
+        family("files", "gauge", "Files by outcome.")
+        for state, n in (
+            ("total", self.files), ("scanned", self.scanned),
+            ("cached", self.cached), ("skipped", self.skipped),
+        ):
+            lines.append(f'{p}_files{{state="{state}"}} {n}')
+        family("read_bytes", "gauge", "Bytes handed to the scanner.", "bytes")
+        lines.append(f"{p}_read_bytes {self.bytes_read}")
+        family("findings", "gauge", "Findings by severity.")
+        for sev in reversed(Severity):
+            lines.append(f'{p}_findings{{severity="{SEVERITY_LABELS[sev]}"}} {self.findings[sev]}')
+        family("results", "gauge", "Scan results by verdict.")
+        for verdict, n in self.verdicts.items():
+            lines.append(f'{p}_results{{verdict="{verdict}"}} {n}')
+        family("errors", "gauge", "Errors reported in scan results.")
+        lines.append(f"{p}_errors {self.errors}")
+        family("partial_results", "gauge", "Scans cut short by --fail-fast or a limit.")
+        lines.append(f"{p}_partial_results {self.partial}")
+        family("file_scan_seconds", "histogram", "Time to scan one file.", "seconds")
+        for bound, n in zip(FILE_SECONDS_BUCKETS + ("+Inf",), accumulate(self.buckets)):
+            lines.append(f'{p}_file_scan_seconds_bucket{{le="{bound}"}} {n}')
+        lines.append(f"{p}_file_scan_seconds_sum {self.scan_seconds:.6f}")
+        lines.append(f"{p}_file_scan_seconds_count {self.scanned}")
+        family("last_run_timestamp_seconds", "gauge", "Unix time the scanner run finished.", "seconds")
+        lines.append(f"{p}_last_run_timestamp_seconds {time.time():.3f}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def save_metrics_file(path: Path, metrics: ScanMetrics):
+    """OpenMetrics を書く。読み手が書きかけを読まないよう、一時ファイルから置き換える
+
+    書けなくてもスキャンの判定（終了コード）は変えず、警告だけ出す。
+    """
+    tmp = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(metrics.to_openmetrics())
+        # 収集側（node_exporter など）は別ユーザーで動くことが多い
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"警告: メトリクスを書き込めません: {e}", file=sys.stderr)
+        if tmp:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+# ---------------------------------------------------------------------------
+# スキャン結果キャッシュ
+# ---------------------------------------------------------------------------
+
+CACHE_FILENAME = "scan-cache.sqlite3"
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # 64MB
+# スキャンロジック（ルール以外）を変えて結果が変わる場合に上げる
+CACHE_FORMAT_VERSION = 5
+
+
+def default_cache_dir() -> Path:
+    """キャッシュの既定の保存先（$XDG_CACHE_HOME または ~/.cache 配下）"""
+    base = os.environ.get("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+    return Path(base) / "skill-security-checker"
+
+
+def ruleset_fingerprint() -> str:
+    """PATTERNS から導出したルールセットの指紋。ルールを変えると変わる"""
+    payload = json.dumps(
+        [CACHE_FORMAT_VERSION, [asdict(rule) for rule in PATTERNS]],
+        ensure_ascii=False,
+        sort_keys=True,
+        default=sorted,  # applies_to（frozenset）
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def encode_findings(findings: Iterable[Finding]) -> list[list]:
+    """1ファイル分の検出を JSON で保存できる形にする（ファイル名は含めない）"""
+    return [
+        [f.category, int(f.severity), f.message, f.line, f.matched_text, f.in_code_block, f.context]
+        for f in findings
+    ]
+
+
+def decode_findings(rows: Iterable, rel_path: str) -> list[Finding]:
+    """encode_findings の逆変換"""
+    return [
+        Finding(
+            category=category,
+            severity=severity,
+            message=message,
+            file=rel_path,
+            line=line,
+            matched_text=matched_text,
+            in_code_block=in_code_block,
+            context=context,
+        )
+        for category, severity, message, line, matched_text, in_code_block, context in rows
+    ]
+
+
+class ScanCache:
+    """ファイル内容のハッシュをキーにしたスキャン結果の永続キャッシュ（SQLite）
+
+    キーは「ルールセット指紋 + コンテキスト（Markdownか） + 内容ハッシュ」。
+    合計サイズが max_bytes を超えたら最終利用日時の古い順に削除する。
+    キャッシュの障害でスキャンを失敗させないよう、SQLite のエラーが起きたら
+    以降はキャッシュを無効化して通常どおりスキャンする。
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = CACHE_MAX_BYTES):
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = cache_dir / CACHE_FILENAME
+        self.max_bytes = max_bytes
+        self.fingerprint = ruleset_fingerprint()
+        self.hits = 0
+        self.misses = 0
+        self._touched: dict[str, float] = {}
+        self._stores = 0
+        self.conn: Optional[sqlite3.Connection] = sqlite3.connect(str(self.path), timeout=5)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY,"
+                " fingerprint TEXT NOT NULL,"
+                " line_count INTEGER NOT NULL,"
+                " findings TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            # ルールが変わった古いエントリは使えないので削除
+            self.conn.execute("DELETE FROM results WHERE fingerprint != ?", (self.fingerprint,))
+
+    def _key(self, data: bytes, rel_path: str) -> str:
+        # 結果はファイル種別（評価するルール）とコードブロック判定の有無で変わる
+        context = f"{file_class(rel_path) or 'all'}:{'md' if is_markdown_path(rel_path) else 'plain'}"
+        return f"{self.fingerprint}:{context}:{hashlib.sha256(data).hexdigest()}"
+
+    def _disable(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except sqlite3.Error:
+                pass
+        self.conn = None
+
+    def lookup(self, data: bytes, rel_path: str) -> Optional[tuple[list[Finding], int]]:
+        """キャッシュを検索する。ヒットすれば (findings, line_count) を返す"""
+        if self.conn is None or not isinstance(data, bytes):
+            return None
+        key = self._key(data, rel_path)
+        try:
+            row = self.conn.execute(
+                "SELECT line_count, findings FROM results WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            self._disable()
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched[key] = time.time()
+        line_count, payload = row
+        return decode_findings(json.loads(payload), rel_path), line_count
+
+    def store(self, data: bytes, rel_path: str, file_result: tuple[list[Finding], int]):
+        """スキャン結果を保存する
+
+        時間予算で打ち切ったルールがある結果は保存しない（次回はもう一度評価する）。
+        """
+        if self.conn is None or not isinstance(data, bytes):
+            return
+        findings, line_count = file_result
+        if has_budget_findings(findings):
+            return
+        payload = json.dumps(encode_findings(findings), ensure_ascii=False)
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (self._key(data, rel_path), self.fingerprint, line_count, payload,
+                 len(payload) + 128, time.time()),
+            )
+            self._stores += 1
+            if self._stores % 256 == 0:
+                self._evict()
+                self.conn.commit()
+        except sqlite3.Error:
+            self._disable()
+
+    def _evict(self):
+        """合計サイズが上限を超えていれば、最終利用の古いものから削除する"""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # 毎回の削除を避けるため、上限の 90% まで減らす
+        to_free = total - int(self.max_bytes * 0.9)
+        victims = []
+        for key, size in self.conn.execute("SELECT key, size FROM results ORDER BY last_used"):
+            victims.append((key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+        self.conn.executemany("DELETE FROM results WHERE key = ?", victims)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+    def flush(self):
+        """最終利用日時の更新と容量調整を書き込む"""
+        if self.conn is None:
+            return
+        try:
+            self.conn.executemany(
+                "UPDATE results SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._touched.items()],
+            )
+            self._touched.clear()
+            self._evict()
+            self.conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        """未書き込みの内容を書き込んで閉じる"""
+        self.flush()
+        self._disable()
+
+
+def open_cache(cache_dir: Optional[Path]) -> Optional[ScanCache]:
+    """キャッシュを開く。開けない場合は警告を出してキャッシュなしで続行する"""
+    try:
+        return ScanCache(cache_dir or default_cache_dir())
+    except (sqlite3.Error, OSError) as e:
+        print(f"警告: キャッシュを使用できません: {e}", file=sys.stderr)
+        return None
+
+
+# ---------------------------------------------------------------------------
+# 差分スキャン（インストール済みスキルの更新）
+# ---------------------------------------------------------------------------
+#
+# --install はファイルごとの内容ハッシュ・行数・検出をマニフェストに記録する。
+# 同じスキルを更新するときは、記録と同じ内容のファイルは検出をそのまま引き継ぎ、
+# 変わったファイルはインストール済みのファイルと行単位の差分を取る。
+# 単一行ルールは変更された行だけを照合し、変わらなかった行の検出は行番号を
+# ずらして引き継ぐ。複数行ルール（数が少なくアンカーで絞り込める）は変更箇所を
+# またぐマッチがありうるため、ファイル全体で評価し直す。
+# 判定は引き継いだ検出を含めた全体で行い、更新で増えた検出は別に報告する。
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+# 照合し直す行がファイルのこの割合を超えたら、差分を使わず全体をスキャンする
+DIFF_RESCAN_RATIO = 0.5
+# (category, message) → ルール番号（記録した検出からルールを引く）
+RULE_IDS = {(rule.category, rule.message): idx for idx, rule in enumerate(PATTERNS)}
+
+
+def split_rule_set(rule_set: RuleSet) -> tuple[RuleSet, RuleSet]:
+    """(単一行ルール, 複数行ルール) に分ける"""
+    rule_ids = set(rule_set.unanchored).union(*rule_set.anchor_rules.values())
+    return build_rule_set(rule_ids - MULTILINE_RULES), build_rule_set(rule_ids & MULTILINE_RULES)
+
+
+# ファイル種別（不明な拡張子は None）→ split_rule_set の結果
+SPLIT_RULE_SETS = {None: split_rule_set(ALL_RULES)}
+SPLIT_RULE_SETS.update((cls, split_rule_set(rule_set)) for cls, rule_set in RULE_SETS.items())
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    """マニフェストに記録した1ファイル分のスキャン結果"""
+    sha256: str
+    line_count: int
+    findings: tuple  # encode_findings の形式
+
+
+@dataclass(frozen=True)
+class UnchangedFile:
+    """インストール済みのバージョンと同じ内容のファイル（検出を引き継ぐ）"""
+    entry: ManifestEntry
+
+
+@dataclass(frozen=True)
+class FileUpdate:
+    """インストール済みのバージョンから変わったファイル（差分だけを照合する）"""
+    data: bytes
+    base_data: bytes
+    base: ManifestEntry
+
+
+def decode_hits(rows: Iterable) -> Optional[dict[tuple[int, int], str]]:
+    """記録した検出を find_matches の形式に戻す。ルール以外の検出があれば None"""
+    hits = {}
+    for category, _severity, message, line, matched_text, *_rest in rows:
+        rule_id = RULE_IDS.get((category, message))
+        if rule_id is None:
+            # 評価の打ち切りなど。引き継ぐと見落としが残りうる
+            return None
+        hits[(line - 1, rule_id)] = matched_text
+    return hits
+
+
+def diff_lines(base_content: str, content: str) -> tuple[list[tuple[int, int]], dict[int, int]]:
+    """変更された行の区間 [開始, 終了) のリストと、変わらなかった行の対応（base の行 → 行）"""
+    # splitlines は LINE_BREAK と同じ改行で分けるので、行番号は build_line_index と一致する
+    base_lines = base_content.splitlines(keepends=True)
+    lines = content.splitlines(keepends=True)
+    # 変更は局所的なことが多いので、先頭と末尾の共通部分は SequenceMatcher に渡さない
+    limit = min(len(base_lines), len(lines))
+    head = 0
+    while head < limit and base_lines[head] == lines[head]:
+        head += 1
+    tail = 0
+    while tail < limit - head and base_lines[-1 - tail] == lines[-1 - tail]:
+        tail += 1
+    line_map = dict(zip(range(head), range(head)))
+    line_map.update(zip(
+        range(len(base_lines) - tail, len(base_lines)), range(len(lines) - tail, len(lines)),
+    ))
+    changed = []
+    matcher = SequenceMatcher(
+        None, base_lines[head:len(base_lines) - tail], lines[head:len(lines) - tail],
+    )
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            line_map.update(zip(range(head + i1, head + i2), range(head + j1, head + j2)))
+        elif j2 > j1:
+            changed.append((head + j1, head + j2))
+    return changed, line_map
+
+
+def scan_file_update(
+    update: FileUpdate,
+    rel_path: str,
+    profiler: Optional["ScanProfiler"] = None,
+) -> tuple[list[Finding], int]:
+    """変更された行だけを照合し、変わらなかった行の検出はインストール済みの記録から引き継ぐ
+
+    記録にルール以外の検出がある場合、バイナリの場合、変更が大きい場合は全体をスキャンする。
+    """
+    data = update.data
+    base_hits = decode_hits(update.base.findings)
+    if base_hits is None or is_binary(data[:BINARY_SAMPLE]) or is_binary(update.base_data[:BINARY_SAMPLE]):
+        return scan_blob(data, rel_path, profiler)
+    if not may_match_bytes(data, rule_set_for(rel_path)):
+        return scan_bytes(data, rel_path, profiler)
+
+    content = decode_text(data)
+    line_starts = build_line_index(content)
+    changed, line_map = diff_lines(decode_text(update.base_data), content)
+    spans = [
+        (line_starts[start], line_starts[end] if end < len(line_starts) else len(content))
+        for start, end in changed
+    ]
+    if sum(end - start for start, end in spans) > len(content) * DIFF_RESCAN_RATIO:
+        return scan_text(content, rel_path, is_markdown_path(rel_path), profiler)
+
+    single_rules, multiline_rules = SPLIT_RULE_SETS[file_class(rel_path)]
+    budget = RuleBudget(profile=profiler is not None)
+    hits = {}
+    for (base_line, rule_id), matched_text in base_hits.items():
+        line = line_map.get(base_line)
+        if line is not None and rule_id not in MULTILINE_RULES:
+            hits[(line, rule_id)] = matched_text
+    for (first, _end), (start, end) in zip(changed, spans):
+        window = content[start:end]
+        for (i, rule_id), matched_text in find_matches(
+            window, build_line_index(window), budget, single_rules,
+        ).items():
+            hits[(first + i, rule_id)] = matched_text
+    hits.update(find_matches(content, line_starts, budget, multiline_rules))
+
+    if profiler:
+        profiler.record(rel_path, sum(end - start for start, end in spans), budget, hits)
+    line_count = count_lines(content, line_starts)
+    contexts = build_context_map(content, line_starts) if hits and is_markdown_path(rel_path) else None
+    return build_findings(hits, rel_path, contexts) + budget_findings(budget, rel_path), line_count
+
+
+class SkillUpdate:
+    """スキャンしたファイルのマニフェストを作り、base があれば差分スキャンに回す
+
+    scan_directory の update に渡す。items() でスキャン対象を base と照合して
+    置き換え、スキャン結果を投入順に record() で受け取る。
+    """
+
+    def __init__(self, base: Optional[dict[str, ManifestEntry]] = None, base_dir: Optional[Path] = None):
+        self.base = base
+        self.base_dir = base_dir
+        self.files: dict[str, ManifestEntry] = {}
+        self.new_findings: list[Finding] = []
+        self.retired = 0
+        self.counts = {"unchanged": 0, "diff": 0, "full": 0}
+        self._seen: set[str] = set()
+        # items() で渡して record() をまだ受け取っていない (相対パス, ハッシュ, 種類)
+        self._pending: deque = deque()
+
+    def items(self, items: Iterable[tuple[str, object]]) -> Iterator[tuple[str, object]]:
+        for rel_path, data in items:
+            digest = hashlib.sha256(data).hexdigest() if isinstance(data, bytes) else None
+            entry = self.base.get(rel_path) if self.base and digest else None
+            kind = "full"
+            if entry is not None and entry.sha256 == digest:
+                data, kind = UnchangedFile(entry), "unchanged"
+            elif entry is not None:
+                base_data = self.read_base(rel_path, entry)
+                if base_data is not None:
+                    data, kind = FileUpdate(data, base_data, entry), "diff"
+            self._pending.append((rel_path, digest, kind))
+            yield rel_path, data
+
+    def read_base(self, rel_path: str, entry: ManifestEntry) -> Optional[bytes]:
+        """記録と同じ内容のインストール済みファイル（無い・変わっている場合は None）"""
+        if "!/" in rel_path:
+            # 入れ子のアーカイブのメンバーはファイルとして存在しない
+            return None
+        path = self.base_dir / rel_path
+        try:
+            if path.stat().st_size > LARGE_FILE_THRESHOLD:
+                return None
+            data = path.read_bytes()
+        except OSError:
+            return None
+        return data if hashlib.sha256(data).hexdigest() == entry.sha256 else None
+
+    def record(self, findings: list[Finding], line_count: int):
+        rel_path, digest, kind = self._pending.popleft()
+        if digest is not None:
+            self.files[rel_path] = ManifestEntry(digest, line_count, tuple(encode_findings(findings)))
+        if self.base is None:
+            return
+        self.counts[kind] += 1
+        self._seen.add(rel_path)
+        if kind == "unchanged":
+            return
+        # 更新前の同じファイルに同じ検出（ルールとマッチした文字列）が無ければ、更新で増えたもの
+        entry = self.base.get(rel_path)
+        remaining: dict[tuple, int] = {}
+        for category, _severity, message, _line, matched_text, *_rest in entry.findings if entry else ():
+            key = (category, message, matched_text)
+            remaining[key] = remaining.get(key, 0) + 1
+        for f in findings:
+            key = (f.category, f.message, f.matched_text)
+            if remaining.get(key):
+                remaining[key] -= 1
+            else:
+                self.new_findings.append(f)
+        self.retired += sum(remaining.values())
+
+    def finish(self, complete: bool = True) -> Optional[dict]:
+        """更新の内訳（base が無ければ None）
+
+        スキャンを打ち切った場合（complete=False）は、スキャンしなかったファイルを
+        削除されたものとは数えない。
+        """
+        if self.base is None:
+            return None
+        for rel_path, entry in self.base.items() if complete else ():
+            if rel_path not in self._seen:
+                # 更新で削除されたファイル
+                self.retired += len(entry.findings)
+        return {
+            "base": str(self.base_dir),
+            "unchanged_files": self.counts["unchanged"],
+            "diff_scanned_files": self.counts["diff"],
+            "full_scanned_files": self.counts["full"],
+            "new_findings": [f.to_dict() for f in self.new_findings],
+            "retired_findings": self.retired,
+        }
+
+
+def save_manifest(path: Path, files: dict[str, ManifestEntry]):
+    """マニフェストを書く。書けなくても差分スキャンが使えないだけなので無視する"""
+    payload = {
+        "version": MANIFEST_VERSION,
+        "fingerprint": ruleset_fingerprint(),
+        "files": {
+            rel_path: [entry.sha256, entry.line_count, list(entry.findings)]
+            for rel_path, entry in files.items()
+        },
+    }
+    try:
+        path.write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+    except OSError:
+        pass
+
+
+def load_manifest(path: Path) -> Optional[dict[str, ManifestEntry]]:
+    """マニフェストを読む。無い・壊れている・ルールが変わった場合は None"""
+    try:
+        payload = json.loads(path.read_text(encoding="utf-8"))
+        if payload["version"] != MANIFEST_VERSION or payload["fingerprint"] != ruleset_fingerprint():
+            return None
+        return {
+            rel_path: ManifestEntry(sha256, line_count, tuple(tuple(row) for row in findings))
+            for rel_path, (sha256, line_count, findings) in payload["files"].items()
+        }
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+# ---------------------------------------------------------------------------
+# レポート出力
+# ---------------------------------------------------------------------------
+
+VERDICT_ICONS = {
+    "SAFE": "✅",
+    "WARNING": "⚠️",
+    "DANGER": "🚨",
+}
+
+
+def format_report(result: ScanResult) -> str:
+    """human-readable レポートを生成"""
+    lines = []
+    icon = VERDICT_ICONS.get(result.verdict, "❓")
+
+    lines.append(f"{'=' * 60}")
+    lines.append(f"  Skill Security Scanner - スキャン結果")
+    lines.append(f"{'=' * 60}")
+    lines.append(f"")
+    lines.append(f"  対象: {result.path}")
+    lines.append(f"  ファイル数: {result.file_count}")
+    lines.append(f"  総行数: {result.total_lines}")
+    if result.cache_stats is not None:
+        stats = result.cache_stats
+        lines.append(
+            f"  キャッシュ: {stats['hits']}/{stats['hits'] + stats['misses']} ヒット"
+            f"（{stats['hit_rate'] * 100:.0f}%）"
+        )
+    lines.append(f"")
+    lines.append(f"  判定: {icon} {result.verdict}")
+    if result.partial is not None:
+        partial = result.partial
+        lines.append(f"  ⏹  部分的な結果: {partial['message']}")
+        lines.append(f"     （{partial['elapsed']:.1f} 秒・未検査のファイルが残っている可能性があります）")
+    lines.append(f"")
+
+    if result.errors:
+        lines.append(f"  エラー:")
+        for err in result.errors:
+            lines.append(f"    ❌ {err}")
+        lines.append(f"")
+
+    summary = result.summary()
+    lines.append(f"  検出サマリー:")
+    lines.append(f"    🚨 CRITICAL: {summary['CRITICAL']}")
+    lines.append(f"    🔴 HIGH:     {summary['HIGH']}")
+    lines.append(f"    🟠 MEDIUM:   {summary['MEDIUM']}")
+    lines.append(f"    🟡 LOW:      {summary['LOW']}")
+    lines.append(f"    ℹ️  INFO:     {summary['INFO']}")
+    lines.append(f"")
+
+    if result.findings:
+        lines.append(f"{'─' * 60}")
+        lines.append(f"  検出詳細")
+        lines.append(f"{'─' * 60}")
+        lines.append(f"")
+
+        # カテゴリでグループ化
+        by_category: dict[str, list[Finding]] = {}
+        for f in sorted(result.findings, key=lambda x: (-x.severity, x.category)):
+            by_category.setdefault(f.category, []).append(f)
+
+        category_labels = {
+            "credential_exposure": "認証情報の露出",
+            "dangerous_command": "危険コマンド",
+            "data_exfiltration": "データ窃取",
+            "path_traversal": "パストラバーサル",
+            "permission_bypass": "権限バイパス",
+            "prompt_injection": "プロンプトインジェクション",
+            "obfuscation": "難読化",
+            "supply_chain": "サプライチェーン",
+            "scan_limit": "スキャン制限",
+            BUDGET_CATEGORY: "スキャン時間超過",
+        }
+
+        for cat, cat_findings in by_category.items():
+            label = category_labels.get(cat, cat)
+            lines.append(f"  [{label}]")
+            for f in cat_findings:
+                sev_icon = SEVERITY_ICONS.get(f.severity, "❓")
+                code_note = CONTEXT_NOTES.get(f.context, "")
+                lines.append(f"    {sev_icon} {SEVERITY_LABELS[f.severity]} | {f.file}:{f.line}")
+                lines.append(f"       {f.message}{code_note}")
+                lines.append(f"       → {f.matched_text}")
+                lines.append(f"")
+
+        suppressed = result.findings.suppressed() if result.findings.cap is not None else []
+        if suppressed:
+            lines.append(f"  [省略した検出（同じファイル・ルールで {result.findings.cap} 件を超えた分）]")
+            for entry in suppressed:
+                lines.append(f"    {entry['file']} | {entry['message']}: 他 {entry['count']} 件")
+            lines.append(f"")
+    else:
+        lines.append(f"  検出なし - 既知の危険パターンは見つかりませんでした。")
+        lines.append(f"")
+
+    if result.history is not None:
+        history = result.history
+        lines.append(f"{'─' * 60}")
+        lines.append(f"  Git 履歴")
+        lines.append(f"{'─' * 60}")
+        lines.append(
+            f"  コミット {history['commits']} / ブロブ {history['blobs']}"
+            f"（参照 {history['references']}）"
+        )
+        for blob in history["blobs_with_findings"]:
+            note = "" if blob["in_head"] else "（HEAD には無いが履歴から読める）"
+            lines.append(f"  {blob['file']}{note}")
+            for ref in blob["introduced"][:HISTORY_REPORT_REFS]:
+                lines.append(f"    {ref['commit'][:GIT_SHORT_OID]} {ref['path']}")
+            if len(blob["introduced"]) > HISTORY_REPORT_REFS:
+                lines.append(f"    他 {len(blob['introduced']) - HISTORY_REPORT_REFS} 件")
+        lines.append(f"")
+
+    if result.update is not None:
+        update = result.update
+        lines.append(f"{'─' * 60}")
+        lines.append(f"  更新差分（インストール済み: {update['base']}）")
+        lines.append(f"{'─' * 60}")
+        lines.append(
+            f"  変更なし {update['unchanged_files']} / 差分スキャン {update['diff_scanned_files']}"
+            f" / 全体スキャン {update['full_scanned_files']} ファイル"
+        )
+        lines.append(f"  解消した検出: {update['retired_findings']} 件")
+        if update["new_findings"]:
+            lines.append(f"  この更新で追加された検出:")
+            for f in update["new_findings"]:
+                sev_icon = SEVERITY_ICONS.get(f["severity_level"], "❓")
+                lines.append(f"    {sev_icon} {f['severity']} | {f['file']}:{f['line']} {f['message']}")
+        else:
+            lines.append(f"  この更新で追加された検出はありません。")
+        lines.append(f"")
+
+    lines.append(f"{'=' * 60}")
+
+    if result.verdict == "SAFE":
+        lines.append(f"  自動スキャンでは問題は検出されませんでした。")
+        lines.append(f"  ※ セマンティック分析（Claude）での追加確認を推奨します。")
+    elif result.verdict == "WARNING":
+        lines.append(f"  注意が必要な項目があります。")
+        lines.append(f"  インストール前に検出項目を確認してください。")
+    else:
+        lines.append(f"  危険な項目が検出されました。")
+        lines.append(f"  このスキルのインストールは推奨しません。")
+
+    lines.append(f"{'=' * 60}")
+
+    return "\n".join(lines)
+
+
+def format_profile(profile: dict) -> str:
+    """--profile の結果を時間の降順の表にする"""
+    total = sum(rule["time_ms"] for rule in profile["rules"]) or 1.0
+    lines = []
+    lines.append(f"{'=' * 60}")
+    lines.append(f"  ルール別プロファイル（時間の降順）")
+    lines.append(f"{'=' * 60}")
+    lines.append(f"  {'時間(ms)':>10} {'割合':>6} {'評価数':>8} {'文字数':>11} {'マッチ':>6}  ルール")
+    for rule in profile["rules"]:
+        lines.append(
+            f"  {rule['time_ms']:>10.1f} {rule['time_ms'] / total * 100:>5.1f}% "
+            f"{rule['evaluated']:>8} {rule['chars']:>11} {rule['matches']:>6}  "
+            f"#{rule['rule']} {rule['message']}"
+        )
+    lines.append(f"")
+    lines.append(f"  拡張子別")
+    lines.append(f"  {'時間(ms)':>10} {'ファイル':>8} {'文字数':>11}  拡張子")
+    for ext, stats in profile["extensions"].items():
+        lines.append(f"  {stats['time_ms']:>10.1f} {stats['files']:>8} {stats['chars']:>11}  {ext}")
+    lines.append(f"{'=' * 60}")
+    return "\n".join(lines)
+
+
+# ---------------------------------------------------------------------------
+# ストリーミング出力
+# ---------------------------------------------------------------------------
+#
+# reporter を渡してスキャンすると、検出は ScanResult に溜めずに見つかった順に
+# 書き出される。severity の件数は ScanResult 側で差分更新されるため、
+# 検出件数が増えてもピークメモリは増えない。
+
+SARIF_LEVELS = {
+    Severity.CRITICAL: "error",
+    Severity.HIGH: "error",
+    Severity.MEDIUM: "warning",
+    Severity.LOW: "note",
+    Severity.INFO: "note",
+}
+
+
+class NdjsonReporter:
+    """検出を1件1行の JSON で書き出し、最後に集計レコードを書く"""
+
+    def __init__(self, out):
+        self.out = out
+
+    def finding(self, f: Finding):
+        record = {"type": "finding"}
+        record.update(f.to_dict())
+        self.out.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def finish(self, result: ScanResult):
+        record = {"type": "result"}
+        record.update(result.to_dict())
+        del record["findings"]
+        self.out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.out.flush()
+
+
+class SarifReporter:
+    """検出を SARIF 2.1.0 の results 配列として逐次書き出す"""
+
+    def __init__(self, out):
+        self.out = out
+        self.count = 0
+        header = {
+            "$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+            "version": "2.1.0",
+        }
+        driver = json.dumps({"driver": {"name": "skill-security-checker"}})
+        # results 配列の直前までを先に書き、各 result を続けて書き足す
+        self.out.write(json.dumps(header)[:-1] + ', "runs": [{"tool": ' + driver + ', "results": [\n')
+
+    def finding(self, f: Finding):
+        record = {
+            "ruleId": f.category,
+            "level": SARIF_LEVELS[f.severity],
+            "message": {"text": f.message},
+            "locations": [{
+                "physicalLocation": {
+                    "artifactLocation": {"uri": PurePath(f.file).as_posix()},
+                    "region": {"startLine": f.line, "snippet": {"text": f.matched_text}},
+                },
+            }],
+            "properties": {
+                "severity": SEVERITY_LABELS[f.severity],
+                "in_code_block": f.in_code_block,
+                "context": f.context,
+            },
+        }
+        if self.count:
+            self.out.write(",\n")
+        self.out.write(json.dumps(record, ensure_ascii=False))
+        self.count += 1
+
+    def finish(self, result: ScanResult):
+        properties = result.to_dict()
+        del properties["findings"]
+        self.out.write('\n], "properties": ' + json.dumps(properties, ensure_ascii=False) + "}]}\n")
+        self.out.flush()
+
+
+REPORTERS = {
+    "ndjson": NdjsonReporter,
+    "sarif": SarifReporter,
+}
+
+
+# ---------------------------------------------------------------------------
+# インストール機能
+# ---------------------------------------------------------------------------
+
+SKILLS_DIR = Path.home() / ".claude" / "skills"
+# ステージングと退避先。SKILLS_DIR と同じファイルシステムに置き、rename で入れ替える
+# （SKILLS_DIR の中に置くと Claude Code が読み込んでしまう）
+STAGING_DIR = SKILLS_DIR.parent / "skill-staging"
+BACKUP_DIR = SKILLS_DIR.parent / "skill-backups"
+# インストールしたスキルのマニフェスト（差分スキャンの基準）
+MANIFEST_DIR = SKILLS_DIR.parent / "skill-manifests"
+INSTALL_IGNORE = (".DS_Store", "__pycache__", "*.pyc")
+FICLONE = 0x40049409  # Linux の reflink ioctl
+# ステージングはインストールする全ファイルをスキャンする（SKIP_DIRS も除外しない）
+INSTALL_SCAN = IgnoreRules(skip_dirs=())
+# renameat2 の RENAME_EXCHANGE（2つのパスを1回の操作で入れ替える）
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+def _load_renameat2():
+    if ctypes is None or not sys.platform.startswith("linux"):
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):  # glibc 2.28 未満など
+        return None
+    func.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    func.restype = ctypes.c_int
+    return func
+
+
+_renameat2 = _load_renameat2()
+
+
+def exchange_paths(a: Path, b: Path) -> bool:
+    """a と b を入れ替える。どちらかが消えている瞬間はない。使えない環境なら False"""
+    if _renameat2 is None:
+        return False
+    if _renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False  # カーネルやファイルシステムが対応していない
+    raise OSError(err, os.strerror(err), str(a))
+
+
+def swap_into_place(src: Path, dest: Path, old: Path):
+    """src を dest に配置し、dest にあったものを old に移す（old は存在しないこと）
+
+    RENAME_EXCHANGE が使えれば dest は常にどちらかのバージョンを指す。使えない環境では
+    2回の rename の間だけ dest が無くなり、2回目が失敗した場合は old を dest に戻す。
+    """
+    if exchange_paths(src, dest):
+        # 途中で止まっても、置き換え前のバージョンは src に残っている
+        os.rename(src, old)
+        return
+    os.rename(dest, old)
+    try:
+        os.rename(src, dest)
+    except OSError:
+        os.rename(old, dest)
+        raise
+
+
+def remove_path(path: Path):
+    """ファイル・シンボリックリンク・ディレクトリを削除する（リンク先は辿らない）"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def is_ignored_for_install(parts: Iterable[str]) -> bool:
+    return any(fnmatch.fnmatch(part, pattern) for part in parts for pattern in INSTALL_IGNORE)
+
+
+def clone_file(src, dst):
+    """可能なら reflink（コピーオンライト）で複製し、できなければ通常のコピーをする
+
+    ハードリンクは使わない。スキャン後に元のファイルが書き換えられると
+    インストールしたスキルも変わってしまうため。
+    """
+    # FIFO などを open すると止まるので、通常のファイル以外は copy2 に任せる（エラーになる）
+    if fcntl is not None and os.path.isfile(src):
+        try:
+            with open(src, "rb") as fin, open(dst, "wb") as fout:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def extract_archive_to(archive_path: Path, dest: Path, result: ScanResult) -> bool:
+    """ZIP/tar を上限付きで dest に展開する。失敗したら result を DANGER にして False を返す
+
+    入れ子のアーカイブはそのまま置く（スキャン時にメモリ上で展開して検査する）。
+    tar のリンクやデバイスは展開しない。
+    """
+    file_size = check_zip_file_size(archive_path, result)
+    if file_size is None:
+        return False
+    budget = ExtractionBudget()
+    try:
+        with open_archive(archive_path) as archive:
+            if isinstance(archive, zipfile.ZipFile):
+                if not check_zip_headers(archive, file_size, result):
+                    return False
+                dest.mkdir()
+                for info in archive.infolist():
+                    path = staged_member_path(dest, info.filename)
+                    if path is None:
+                        continue
+                    if info.is_dir():
+                        path.mkdir(parents=True, exist_ok=True)
+                        continue
+                    with archive.open(info) as fp:
+                        write_member(path, fp, info.filename, budget)
+            else:
+                dest.mkdir()
+                for info in archive:
+                    path = staged_member_path(dest, info.name)
+                    if path is None or not (info.isfile() or info.isdir()):
+                        budget.take(info.size)
+                        continue
+                    if info.isdir():
+                        path.mkdir(parents=True, exist_ok=True)
+                        continue
+                    write_member(path, archive.extractfile(info), info.name, budget)
+    except Exception as e:
+        record_zip_error(result, e)
+        return False
+    return True
+
+
+def staged_member_path(dest: Path, name: str) -> Optional[Path]:
+    """メンバーの展開先。インストールしないメンバーは None（展開先の外を指せば送出）"""
+    member = PurePosixPath(name)
+    if member.is_absolute() or ".." in member.parts or "\\" in name:
+        raise UnsafeMemberError(name)
+    if not member.parts or is_ignored_for_install(member.parts):
+        return None
+    return dest.joinpath(*member.parts)
+
+
+def write_member(path: Path, fp, name: str, budget: ExtractionBudget):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as out:
+        for chunk in iter_limited_chunks(fp, name, budget):
+            out.write(chunk)
+
+
+def copy_tree_to(source_dir: Path, dest: Path, result: ScanResult) -> bool:
+    """ディレクトリを dest に複製する。失敗したら result を DANGER にして False を返す
+
+    シンボリックリンクはリンクのまま複製する（辿るとスキル外のファイルを取り込み、
+    循環していれば終わらない）。外を指すリンクはスキャンで検出になる。
+    """
+    try:
+        shutil.copytree(
+            source_dir,
+            dest,
+            symlinks=True,
+            ignore=shutil.ignore_patterns(*INSTALL_IGNORE),
+            copy_function=clone_file,
+        )
+    except OSError as e:
+        result.errors.append(f"ステージングへの複製に失敗しました: {e}")
+        result.verdict = "DANGER"
+        return False
+    return True
+
+
+def stage_skill(
+    target: Path,
+    jobs: int = 1,
+    cache: Optional[ScanCache] = None,
+    reporter=None,
+    max_file_size: int = MAX_FILE_SIZE,
+    profiler: Optional[ScanProfiler] = None,
+    max_per_rule: Optional[int] = None,
+    limits: Optional[ScanLimits] = None,
+    metrics: Optional[ScanMetrics] = None,
+) -> tuple[ScanResult, Optional[Path]]:
+    """インストール対象を STAGING_DIR に1度だけ展開（複製）し、そのファイルをスキャンする
+
+    スキャンしたファイルそのものをインストールするため、検査と使用の間に内容が
+    変わることはない。返したステージングは install_staged_skill で配置するか
+    discard_staging で削除する（展開に失敗した場合は None）。
+    同名のスキルがインストール済みなら、変わったファイルの差分だけを照合する。
+    インストールするファイルはすべてスキャンする（SKIP_DIRS も走査する）。
+    """
+    STAGING_DIR.mkdir(parents=True, exist_ok=True)
+    staging_root = Path(tempfile.mkdtemp(prefix="stage_", dir=STAGING_DIR))
+    # ディレクトリ名は detect_skill_name のフォールバックになるので元の名前にする
+    staged = staging_root / (archive_stem(target.name) if target.is_file() else target.name)
+    result = ScanResult(path=str(target))
+    try:
+        started = time.perf_counter()
+        if target.is_file() and archive_kind(target.name):
+            staged_ok = extract_archive_to(target, staged, result)
+        elif target.is_dir():
+            staged_ok = copy_tree_to(target, staged, result)
+        else:
+            result, staged_ok = unsupported_target_result(target), False
+        if metrics:
+            metrics.add("stage", time.perf_counter() - started)
+        if not staged_ok:
+            discard_staging(staged)
+            return result, None
+        # --profile は全ファイルの評価コストを測るため差分スキャンしない
+        update = installed_skill_update(staged) if profiler is None else SkillUpdate()
+        result = scan_directory(
+            staged, jobs=jobs, cache=cache, reporter=reporter,
+            max_file_size=max_file_size, profiler=profiler, max_per_rule=max_per_rule,
+            update=update, limits=limits, ignore=INSTALL_SCAN, metrics=metrics,
+        )
+        save_manifest(staging_root / MANIFEST_FILENAME, update.files)
+    except BaseException:
+        discard_staging(staged)
+        raise
+    result.path = str(target)
+    return result, staged
+
+
+def installed_skill_update(staged: Path) -> SkillUpdate:
+    """ステージングと同名のインストール済みスキルがあり、マニフェストが使えれば差分を基準にする"""
+    skill_name = detect_skill_name(staged)
+    if not skill_name or not is_valid_skill_name(skill_name):
+        return SkillUpdate()
+    installed = SKILLS_DIR / skill_name
+    base = load_manifest(skill_manifest_path(skill_name)) if installed.is_dir() else None
+    return SkillUpdate(base, installed) if base is not None else SkillUpdate()
+
+
+def skill_manifest_path(skill_name: str) -> Path:
+    return MANIFEST_DIR / f"{skill_name}.json"
+
+
+def backup_manifest_path(skill_name: str) -> Path:
+    """退避したバージョンのマニフェスト（スキル名は "." で始まらないので退避先と衝突しない）"""
+    return BACKUP_DIR / ".manifests" / f"{skill_name}.json"
+
+
+def move_manifest(src: Path, dst: Path):
+    """src のマニフェストを dst に移す。src が無ければ dst も消す（基準の無いバージョン）"""
+    if os.path.lexists(src):
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, dst)
+    elif os.path.lexists(dst):
+        os.unlink(dst)
+
+
+def discard_staging(staged: Path):
+    shutil.rmtree(staged.parent, ignore_errors=True)
+
+
+def is_valid_skill_name(name: str) -> bool:
+    """スキル名が SKILLS_DIR 直下の1階層を指すか（パストラバーサル対策）"""
+    return bool(name) and not name.startswith(".") and not any(c in name for c in "/\\\0")
+
+
+def detect_skill_name(source_dir: Path) -> Optional[str]:
+    """SKILL.md の YAML フロントマターから name を取得する。"""
+    skill_md = source_dir / "SKILL.md"
+    if not skill_md.exists():
+        return None
+    try:
+        content = skill_md.read_text(encoding="utf-8", errors="replace")
+        lines = content.splitlines()
+        if lines and lines[0].strip() == "---":
+            for line in lines[1:]:
+                if line.strip() == "---":
+                    break
+                m = re.match(r'^name:\s*(.+)', line)
+                if m:
+                    return m.group(1).strip().strip('"').strip("'")
+    except OSError:
+        pass
+    # フォールバック: ディレクトリ名を使用
+    return source_dir.name if source_dir.name else None
+
+
+def install_staged_skill(staged: Path, skill_name: str) -> Path:
+    """ステージングしたスキルを ~/.claude/skills/ に rename で配置する
+
+    既存のバージョンは BACKUP_DIR に退避し（rollback_skill で戻せる）、
+    配置に失敗した場合は元に戻す（swap_into_place）。
+    """
+    if not is_valid_skill_name(skill_name):
+        raise ValueError(f"不正なスキル名です: {skill_name}")
+    SKILLS_DIR.mkdir(parents=True, exist_ok=True)
+    dest = SKILLS_DIR / skill_name
+    backup = BACKUP_DIR / skill_name
+    replaced = os.path.lexists(dest)
+    if replaced:
+        BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+        # 退避は直前の1世代のみ
+        if os.path.lexists(backup):
+            remove_path(backup)
+        swap_into_place(staged, dest, backup)
+    else:
+        os.rename(staged, dest)
+    # マニフェストもスキルと一緒に退避する（rollback_skill で戻したときの差分の基準）
+    try:
+        if replaced:
+            move_manifest(skill_manifest_path(skill_name), backup_manifest_path(skill_name))
+        MANIFEST_DIR.mkdir(parents=True, exist_ok=True)
+        os.replace(staged.parent / MANIFEST_FILENAME, skill_manifest_path(skill_name))
+    except OSError:
+        pass
+    discard_staging(staged)
+    return dest
+
+
+def rollback_skill(skill_name: str) -> Path:
+    """インストール済みのスキルと退避した直前のバージョンを入れ替える（マニフェストも）"""
+    if not is_valid_skill_name(skill_name):
+        raise ValueError(f"不正なスキル名です: {skill_name}")
+    dest = SKILLS_DIR / skill_name
+    backup = BACKUP_DIR / skill_name
+    if not backup.is_dir():
+        raise FileNotFoundError(f"退避されたバージョンがありません: {skill_name}")
+    if not os.path.lexists(dest):
+        os.rename(backup, dest)
+    elif not exchange_paths(backup, dest):
+        swap = BACKUP_DIR / f".{skill_name}.swap"
+        if os.path.lexists(swap):
+            remove_path(swap)
+        swap_into_place(backup, dest, swap)
+        os.rename(swap, backup)
+    swap_manifests(skill_name)
+    return dest
+
+
+def swap_manifests(skill_name: str):
+    """インストール済みと退避したバージョンのマニフェストを入れ替える
+
+    入れ替えに失敗した場合は両方とも消す（差分スキャンが使えず全体をスキャンするだけで、
+    別のバージョンのマニフェストを基準にするよりよい）。
+    """
+    current, backup = skill_manifest_path(skill_name), backup_manifest_path(skill_name)
+    swap = backup.with_name(f".{backup.name}.swap")
+    try:
+        move_manifest(current, swap)
+        move_manifest(backup, current)
+        move_manifest(swap, backup)
+    except OSError:
+        for path in (current, backup, swap):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def install_scanned_skill(result: ScanResult, staged: Optional[Path], message_out):
+    """--install: SAFE ならステージングしたスキルを配置し、それ以外は中断・拒否を表示する"""
+    if result.verdict == "SAFE":
+        skill_name = detect_skill_name(staged)
+        if not skill_name:
+            print("エラー: SKILL.md が見つからない、またはスキル名を特定できません", file=sys.stderr)
+            sys.exit(2)
+        if not is_valid_skill_name(skill_name):
+            print(f"エラー: 不正なスキル名です: {skill_name}", file=sys.stderr)
+            sys.exit(2)
+        replaced = os.path.lexists(SKILLS_DIR / skill_name)
+        try:
+            dest = install_staged_skill(staged, skill_name)
+        except OSError as e:
+            print(f"エラー: インストールに失敗しました: {e}", file=sys.stderr)
+            sys.exit(2)
+        print(f"\n✅ インストール完了: {dest}", file=message_out)
+        if replaced:
+            print(
+                f"   以前のバージョン: {BACKUP_DIR / skill_name}（--rollback {skill_name} で戻せます）",
+                file=message_out,
+            )
+    elif result.verdict == "WARNING" and result.partial is not None:
+        print(f"\n⚠️  スキャンを途中で打ち切ったためインストールを中断しました。", file=message_out)
+        print(f"   {result.partial['message']}。上限を外してスキャンし直してください。", file=message_out)
+    elif result.verdict == "WARNING":
+        print(f"\n⚠️  WARNING検出のためインストールを中断しました。", file=message_out)
+        print(f"   検出内容を確認し、問題なければ手動でコピーしてください。", file=message_out)
     else:
-        print(f"エラー: サポートされていない形式です: {target}", file=sys.stderr)
-        sys.exit(2)
+        print(f"\n🚨 DANGER検出のためインストールを拒否しました。", file=message_out)
+        print(f"   このスキルのインストールは推奨しません。", file=message_out)
+
+
+# ---------------------------------------------------------------------------
+# バッチモード
+# ---------------------------------------------------------------------------
+
+VERDICT_ORDER = {"SAFE": 0, "WARNING": 1, "DANGER": 2}
 
-    if args.json:
-        print(json.dumps(result.to_dict(), ensure_ascii=False, indent=2))
+
+def scan_target(
+    target: Path,
+    jobs: int = 1,
+    cache: Optional[ScanCache] = None,
+    reporter=None,
+    max_file_size: int = MAX_FILE_SIZE,
+    profiler: Optional[ScanProfiler] = None,
+    max_per_rule: Optional[int] = None,
+    limits: Optional[ScanLimits] = None,
+    ignore: Optional[IgnoreRules] = None,
+    metrics: Optional[ScanMetrics] = None,
+) -> ScanResult:
+    """ディレクトリまたはアーカイブ（.skill/.zip/tar）をスキャンする。対象外のパスはエラー結果を返す"""
+    if target.is_file() and archive_kind(target.name):
+        return scan_archive(
+            target, jobs=jobs, cache=cache, reporter=reporter,
+            profiler=profiler, max_per_rule=max_per_rule, limits=limits, metrics=metrics,
+        )
+    if target.is_dir():
+        return scan_directory(
+            target, jobs=jobs, cache=cache, reporter=reporter,
+            max_file_size=max_file_size, profiler=profiler, max_per_rule=max_per_rule,
+            limits=limits, ignore=ignore, metrics=metrics,
+        )
+    return unsupported_target_result(target)
+
+
+def unsupported_target_result(target: Path) -> ScanResult:
+    result = ScanResult(path=str(target), verdict="DANGER")
+    if target.exists():
+        result.errors.append(f"サポートされていない形式です: {target}")
     else:
-        print(format_report(result))
-        # JSON も stderr に出力（Claude解析用）
-        print(json.dumps(result.to_dict(), ensure_ascii=False, indent=2), file=sys.stderr)
-
-    # --install モード
-    if args.install:
-        if result.verdict == "SAFE":
-            source_dir, tmpdir_obj = resolve_skill_source(target)
+        result.errors.append(f"パスが見つかりません: {target}")
+    return result
+
+
+def iter_batch_paths(paths: Iterable[str], paths_from: Optional[str] = None) -> Iterator[str]:
+    """引数とパスリスト（ファイルまたは "-" で標準入力）から対象パスを順に返す"""
+    yield from paths
+    if paths_from is None:
+        return
+    stream = sys.stdin if paths_from == "-" else open(paths_from, encoding="utf-8")
+    try:
+        for line in stream:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def run_batch(
+    paths: Iterable[str],
+    jobs: int = 1,
+    cache: Optional[ScanCache] = None,
+    out=None,
+    max_file_size: int = MAX_FILE_SIZE,
+    max_per_rule: Optional[int] = None,
+    limits: Optional[ScanLimits] = None,
+    ignore: Optional[IgnoreRules] = None,
+    metrics: Optional[ScanMetrics] = None,
+) -> dict:
+    """複数スキルを1プロセスで順にスキャンし、1スキル1行の JSON を出力する
+
+    結果は出力したら保持しないため、スキル数が増えてもメモリは一定。
+    最後に集計行（batch_summary）を出力し、その内容を返す。
+    limits の上限はスキルごとに適用する。
+    metrics を渡すと全スキル分を合計し、集計行の "metrics" に入れる。
+    """
+    out = out or sys.stdout
+    summary = {
+        "skills": 0,
+        "files": 0,
+        "lines": 0,
+        "verdicts": {verdict: 0 for verdict in VERDICT_ORDER},
+        "findings": {SEVERITY_LABELS[sev]: 0 for sev in reversed(Severity)},
+        "errors": 0,
+        "partial": 0,
+        "verdict": "SAFE",
+    }
+    for path in paths:
+        result = scan_target(
+            Path(path).expanduser().resolve(), jobs=jobs, cache=cache,
+            max_file_size=max_file_size, max_per_rule=max_per_rule, limits=limits, ignore=ignore,
+            metrics=metrics,
+        )
+        if metrics:
+            metrics.add_result(result)
+        out.write(json.dumps(result.to_dict(), ensure_ascii=False) + "\n")
+        out.flush()
+
+        summary["skills"] += 1
+        summary["files"] += result.file_count
+        summary["lines"] += result.total_lines
+        summary["verdicts"][result.verdict] += 1
+        for label, n in result.summary().items():
+            summary["findings"][label] += n
+        summary["errors"] += len(result.errors)
+        summary["partial"] += result.partial is not None
+        if VERDICT_ORDER[result.verdict] > VERDICT_ORDER[summary["verdict"]]:
+            summary["verdict"] = result.verdict
+
+    if metrics:
+        summary["metrics"] = metrics.to_dict()
+    out.write(json.dumps({"batch_summary": summary}, ensure_ascii=False) + "\n")
+    out.flush()
+    return summary
+
+
+# ---------------------------------------------------------------------------
+# Git 履歴のスキャン（--git-history）
+# ---------------------------------------------------------------------------
+#
+# 削除したファイルでもコミット済みの認証情報は履歴から読めるため、到達可能な
+# 全コミットのファイルを検査する。git log --raw で各コミットが追加・変更した
+# ブロブを列挙し、同じ内容のブロブは何コミットから参照されていても1回だけ、
+# 1本の git cat-file --batch で読んでスキャンする（結果キャッシュも内容ハッシュ単位）。
+# 検出のファイル名は最初にそのブロブを追加したコミットとパス（"コミット:パス"）で、
+# 追加・変更したコミットとパスの一覧は result.history に示す。
+# 同じブロブが種別の異なるパスにある場合は、最初のパスの種別でルールを選ぶ。
+
+GIT_READ_CHUNK = 64 * 1024
+GIT_LOG_ARGS = ("log", "--all", "--raw", "-c", "--no-abbrev", "--no-renames", "-z", "--format=%x01%H")
+GIT_REGULAR_MODES = {b"100644", b"100755"}
+GIT_SHORT_OID = 12  # 報告に使うコミット ID の長さ
+HISTORY_REPORT_REFS = 5  # レポートに表示する、1ブロブあたりのコミットとパスの数
+
+
+class GitError(Exception):
+    """git コマンドが失敗した"""
+
+
+def git_command(repo: Path, *args: str) -> list[str]:
+    return ["git", "-C", str(repo), *args]
+
+
+def _iter_nul_fields(stream) -> Iterator[bytes]:
+    """NUL 区切り（-z）の出力をフィールドごとに返す"""
+    pending = b""
+    while True:
+        chunk = stream.read(GIT_READ_CHUNK)
+        if not chunk:
+            break
+        fields = (pending + chunk).split(b"\0")
+        pending = fields.pop()
+        yield from fields
+    if pending:
+        yield pending
+
+
+def _finish_git(proc: subprocess.Popen, command: str):
+    stderr = proc.stderr.read().decode("utf-8", errors="replace")
+    proc.stderr.close()
+    if proc.wait() != 0:
+        raise GitError(f"git {command}: {stderr.strip() or f'終了コード {proc.returncode}'}")
+
+
+def collect_git_blobs(repo: Path) -> tuple[dict[str, list[tuple[str, str]]], int]:
+    """スキャン対象のブロブ → 追加・変更した [(コミット, パス), ...]（古い順）と、コミット数
+
+    ブロブは最初に追加されたのが古い順に並べる。マージコミットは、どの親とも
+    異なる結果になったファイル（衝突の解決など）だけを数える。
+    """
+    proc = subprocess.Popen(
+        git_command(repo, *GIT_LOG_ARGS), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    blobs: dict[str, list[tuple[str, str]]] = {}
+    oldest: dict[str, int] = {}  # ブロブ → 最も古い参照の（新しい順の）コミット番号
+    commits = 0
+    commit = ""
+    fields = _iter_nul_fields(proc.stdout)
+    for raw in fields:
+        token = raw.lstrip(b"\n")
+        if token.startswith(b"\x01"):
+            commit = token[1:].decode("ascii")
+            commits += 1
+        elif token.startswith(b":"):
+            # ":旧モード 新モード 旧ID 新ID 状態"（マージは親の数だけ ":" とモード・ID が増える）
+            path = next(fields).decode("utf-8", errors="replace")
+            parents = len(token) - len(token.lstrip(b":"))
+            meta = token[parents:].split()
+            mode, oid = meta[parents], meta[2 * parents + 1].decode("ascii")
+            if mode not in GIT_REGULAR_MODES or not is_scan_member(PurePosixPath(path)):
+                continue
+            blobs.setdefault(oid, []).append((commit, sys.intern(path)))
+            oldest[oid] = commits
+    _finish_git(proc, "log")
+    # git log は新しい順なので、古い順に直す
+    return {
+        oid: blobs[oid][::-1]
+        for oid in sorted(blobs, key=lambda oid: -oldest[oid])
+    }, commits
+
+
+def git_head_blobs(repo: Path) -> set[str]:
+    """HEAD のツリーにあるブロブ（HEAD が無ければ空）"""
+    proc = subprocess.run(git_command(repo, "ls-tree", "-r", "-z", "HEAD"), capture_output=True)
+    if proc.returncode != 0:
+        return set()
+    # "モード 種類 ID\tパス"
+    return {
+        entry.split(b"\t", 1)[0].split()[2].decode("ascii")
+        for entry in proc.stdout.split(b"\0") if entry
+    }
+
+
+def _write_oids(stdin, oids: Iterable[str]):
+    try:
+        for oid in oids:
+            stdin.write(oid.encode("ascii") + b"\n")
+        stdin.close()
+    except (BrokenPipeError, ValueError):
+        # 読み手が先に終了した
+        pass
+
+
+def iter_git_blob_contents(
+    repo: Path,
+    oids: list[str],
+    max_file_size: int = MAX_FILE_SIZE,
+) -> Iterator[tuple[str, object]]:
+    """ブロブの内容を1本の git cat-file --batch で順に読む
+
+    max_file_size を超えるブロブは読み捨ててサイズ（int）を、無いブロブは None を返す。
+    """
+    proc = subprocess.Popen(
+        git_command(repo, "cat-file", "--batch"),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    # 全 ID を書き終えるのを待つと出力のパイプが詰まるので、書き込みは別スレッドで行う
+    writer = threading.Thread(target=_write_oids, args=(proc.stdin, oids), daemon=True)
+    writer.start()
+    stdout = proc.stdout
+    truncated = False
+    try:
+        for oid in oids:
+            # "<ID> blob <サイズ>" または "<ID> missing"
+            header = stdout.readline().split()
+            if not header:
+                truncated = True
+                break
+            if len(header) != 3 or header[1] != b"blob":
+                yield oid, None
+                continue
+            size = int(header[2])
+            if size > max_file_size:
+                remaining = size + 1
+                while remaining > 0:
+                    skipped = stdout.read(min(remaining, ZIP_READ_CHUNK))
+                    if not skipped:
+                        break
+                    remaining -= len(skipped)
+                yield oid, size
+                continue
+            data = stdout.read(size)
+            stdout.read(1)  # 内容の後の改行
+            yield oid, data
+    finally:
+        # 並列スキャンのワーカー（fork）が stdin を継承していると git は入力の終わりを
+        # 受け取れないので、読み終えたら（または読み手がやめたら）終了させる
+        if proc.poll() is None:
+            proc.kill()
+        writer.join()
+        stdout.close()
+        stderr = proc.stderr.read().decode("utf-8", errors="replace")
+        proc.stderr.close()
+        proc.wait()
+    if truncated:
+        raise GitError(f"git cat-file: {stderr.strip() or '出力が途中で終わりました'}")
+
+
+def scan_git_history(
+    repo: Path,
+    jobs: int = 1,
+    cache: Optional[ScanCache] = None,
+    reporter=None,
+    max_file_size: int = MAX_FILE_SIZE,
+    profiler: Optional[ScanProfiler] = None,
+    max_per_rule: Optional[int] = None,
+    limits: Optional[ScanLimits] = None,
+    metrics: Optional[ScanMetrics] = None,
+) -> ScanResult:
+    """リポジトリの全履歴を、同じ内容のブロブは1回ずつスキャンする
+
+    limits を渡すと条件を満たしたら打ち切る（ブロブの順序は追加された順のまま）。
+    metrics には履歴の列挙を walk、ブロブの読み込み（入れ子のアーカイブの展開を含む）を
+    read として数える。
+    """
+    result = ScanResult(path=str(repo), findings=FindingStore(max_per_rule))
+    if profiler:
+        cache = None
+    if cache:
+        cache.reset_stats()
+    # 時間の上限には履歴の列挙にかかった時間も含める
+    cutoff = limits.start() if limits else None
+    started = time.perf_counter()
+    try:
+        blobs, commit_count = collect_git_blobs(repo)
+        head_blobs = git_head_blobs(repo)
+    except (OSError, GitError) as e:
+        result.errors.append(f"git の履歴を読めません: {e}")
+        result.verdict = "DANGER"
+        return result
+    if metrics:
+        metrics.add("walk", time.perf_counter() - started)
+
+    # items() で渡して結果をまだ受け取っていないブロブ（入れ子のアーカイブはメンバーごと）
+    pending: deque = deque()
+
+    def items() -> Iterator[tuple[str, object]]:
+        for oid, data in iter_git_blob_contents(repo, list(blobs), max_file_size):
+            commit, path = blobs[oid][0]
+            label = f"{commit[:GIT_SHORT_OID]}:{path}"
+            if data is None:
+                result.errors.append(f"ブロブを読めません: {oid}（{label}）")
+                result.skipped_files += 1
+            elif isinstance(data, int):
+                result.errors.append(
+                    f"ファイルサイズが上限（{max_file_size / 1024 / 1024:.0f}MB）を超えたため"
+                    f"スキャンしていません: {label}（{data / 1024 / 1024:.1f}MB）"
+                )
+                result.skipped_files += 1
+            elif archive_kind(path):
+                for item in iter_archive_items(
+                    label, lambda data=data, path=path: open_archive(data, archive_kind(path)),
+                    ExtractionBudget(),
+                ):
+                    pending.append(oid)
+                    yield item
+            else:
+                pending.append(oid)
+                yield label, data
+
+    blob_items = metrics.timed("read", items()) if metrics else items()
+    if cutoff:
+        blob_items = cutoff.items(blob_items)
+    found: dict[str, None] = {}
+    try:
+        for findings, line_count in scan_blobs(
+            blob_items, jobs, cache, profiler, metrics, cutoff is not None,
+        ):
+            oid = pending.popleft()
+            if findings:
+                found[oid] = None
+            result.file_count += 1
+            result.total_lines += line_count
+            result.add_findings(findings, reporter)
+            if cutoff and cutoff.after_file(result):
+                break
+    except (OSError, GitError) as e:
+        result.errors.append(f"git の履歴を読めません: {e}")
+        result.verdict = "DANGER"
+        return result
+
+    finish_result(result, cache, cutoff)
+    if profiler:
+        result.profile = profiler.to_dict()
+    result.history = {
+        "commits": commit_count,
+        "blobs": len(blobs),
+        "references": sum(len(refs) for refs in blobs.values()),
+        "blobs_with_findings": [
+            {
+                "blob": oid,
+                "file": f"{blobs[oid][0][0][:GIT_SHORT_OID]}:{blobs[oid][0][1]}",
+                # HEAD に無い = 削除済みだが履歴からは読める
+                "in_head": oid in head_blobs,
+                "introduced": [{"commit": commit, "path": path} for commit, path in blobs[oid]],
+            }
+            for oid in found
+        ],
+    }
+    return result
+
+
+# ---------------------------------------------------------------------------
+# 監視モード
+# ---------------------------------------------------------------------------
+
+WATCH_INTERVAL = 1.0  # 秒
+
+
+@dataclass
+class WatchedFile:
+    skill: str
+    mtime_ns: int
+    size: int
+    digest: str
+    findings: list
+    counts: list
+
+
+class SkillWatcher:
+    """ディレクトリをポーリングし、変更されたファイルだけを再スキャンする
+
+    ファイルごとに (mtime, サイズ, 内容ハッシュ, 検出結果) を保持し、
+    stat が変わったファイルだけを読み、内容が変わったファイルだけを
+    scan_blob する。判定はスキルごとの severity 件数を差分更新して求め、
+    判定が変わったときにイベントを返す。
+
+    root 直下に SKILL.md があれば root 全体を1つのスキルとして、
+    なければ（~/.claude/skills のように）直下のディレクトリを各スキルとして扱う。
+    ファイルサイズの扱いは scan_directory と同じで、LARGE_FILE_THRESHOLD を超える
+    ファイルは読み込まずにチャンクスキャンし、max_file_size を超えるファイルは
+    スキャンせずに scan_limit として報告する（未検査のまま SAFE にしない）。
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        ignore: Optional[IgnoreRules] = None,
+        max_file_size: int = MAX_FILE_SIZE,
+    ):
+        self.root = root
+        self.ignore = ignore
+        self.max_file_size = max_file_size
+        self.single_skill = (root / "SKILL.md").is_file()
+        self.files: dict[Path, WatchedFile] = {}
+        self.skill_counts: dict[str, list[int]] = {}
+        self.skill_files: dict[str, int] = {}
+        self.verdicts: dict[str, str] = {}
+
+    def skill_of(self, fpath: Path) -> str:
+        rel = fpath.relative_to(self.root)
+        if self.single_skill or len(rel.parts) == 1:
+            return self.root.name
+        return rel.parts[0]
+
+    def _apply(self, skill: str, counts: list[int], sign: int):
+        total = self.skill_counts.setdefault(skill, [0] * len(Severity))
+        for sev, n in enumerate(counts):
+            total[sev] += sign * n
+        self.skill_files[skill] = self.skill_files.get(skill, 0) + sign
+
+    def poll(self) -> list[dict]:
+        """1回分の変更検出と再スキャンを行い、判定の遷移イベントを返す"""
+        changed: dict[str, list[str]] = {}
+        seen = set()
+
+        for rel_path, entry in walk_scan_targets(self.root, self.ignore):
+            fpath = self.root / rel_path
+            outside = isinstance(entry, OutsideSymlink)
             try:
-                skill_name = detect_skill_name(source_dir)
-                if not skill_name:
-                    print("エラー: SKILL.md が見つからない、またはスキル名を特定できません", file=sys.stderr)
-                    sys.exit(2)
-                dest = install_skill(source_dir, skill_name)
-                print(f"\n✅ インストール完了: {dest}")
-            finally:
-                if tmpdir_obj:
-                    tmpdir_obj.cleanup()
-        elif result.verdict == "WARNING":
-            print(f"\n⚠️  WARNING検出のためインストールを中断しました。")
-            print(f"   検出内容を確認し、問題なければ手動でコピーしてください。")
+                # 外を指すリンクはリンク自体の stat で変化を見る
+                st = fpath.lstat() if outside else entry.stat()
+            except OSError:
+                continue
+            seen.add(fpath)
+            state = self.files.get(fpath)
+            if state and state.mtime_ns == st.st_mtime_ns and state.size == st.st_size:
+                continue
+
+            if outside:
+                data = entry
+                digest = hashlib.sha256(os.fsencode(entry.target)).hexdigest()
+            elif st.st_size > self.max_file_size:
+                data = None
+                digest = f"oversize:{st.st_size}"
+            elif st.st_size > LARGE_FILE_THRESHOLD:
+                data = LargeFile(Path(entry.path), st.st_size)
+                digest = file_sha256(entry.path)
+            else:
+                data = read_file_bytes(entry.path)
+                digest = hashlib.sha256(data).hexdigest()
+            if state and state.digest == digest:
+                # 内容は同じ（touch など）なので再スキャン不要
+                state.mtime_ns, state.size = st.st_mtime_ns, st.st_size
+                continue
+
+            if data is None:
+                findings = [oversize_finding(rel_path, st.st_size, self.max_file_size)]
+            else:
+                findings, _line_count = scan_blob(data, rel_path)
+            skill = self.skill_of(fpath)
+            if state:
+                self._apply(state.skill, state.counts, -1)
+            new_state = WatchedFile(
+                skill, st.st_mtime_ns, st.st_size, digest, findings, count_severities(findings)
+            )
+            self._apply(skill, new_state.counts, +1)
+            self.files[fpath] = new_state
+            changed.setdefault(skill, []).append(rel_path)
+
+        for fpath in [p for p in self.files if p not in seen]:
+            state = self.files.pop(fpath)
+            self._apply(state.skill, state.counts, -1)
+            changed.setdefault(state.skill, []).append(str(fpath.relative_to(self.root)))
+
+        events = []
+        for skill, files in sorted(changed.items()):
+            previous = self.verdicts.get(skill)
+            if self.skill_files.get(skill, 0) <= 0:
+                # スキルのファイルがすべて削除された
+                self.skill_counts.pop(skill, None)
+                self.skill_files.pop(skill, None)
+                self.verdicts.pop(skill, None)
+                if previous is not None:
+                    events.append(self._event(skill, previous, None, files, [0] * len(Severity)))
+                continue
+            counts = self.skill_counts[skill]
+            verdict = verdict_from_counts(counts)
+            self.verdicts[skill] = verdict
+            if verdict != previous:
+                events.append(self._event(skill, previous, verdict, files, counts))
+        return events
+
+    def _event(self, skill, previous, verdict, files, counts) -> dict:
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "event": "verdict",
+            "skill": skill,
+            "from": previous,
+            "to": verdict,
+            "changed_files": sorted(files),
+            "summary": {SEVERITY_LABELS[sev]: counts[sev] for sev in reversed(Severity)},
+        }
+
+
+def file_sha256(path) -> str:
+    """ファイル全体を読み込まずに内容ハッシュを求める"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(SCAN_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def oversize_finding(rel_path: str, size: int, max_file_size: int) -> Finding:
+    """サイズの上限を超えてスキャンしなかったファイル（--watch ではエラーの代わりに検出にする）"""
+    return Finding(
+        category="scan_limit",
+        severity=Severity.MEDIUM,
+        message=(
+            f"ファイルサイズが上限（{max_file_size / 1024 / 1024:.0f}MB）を超えたため"
+            f"スキャンしていません（{size / 1024 / 1024:.1f}MB）"
+        ),
+        file=rel_path,
+        line=1,
+        matched_text="",
+    )
+
+
+def watch_directory(
+    root: Path,
+    interval: float = WATCH_INTERVAL,
+    emit=None,
+    ignore: Optional[IgnoreRules] = None,
+    max_file_size: int = MAX_FILE_SIZE,
+):
+    """Ctrl-C まで監視を続け、判定の遷移を1行1イベントの JSON で出力する"""
+    watcher = SkillWatcher(root, ignore, max_file_size)
+    while True:
+        for event in watcher.poll():
+            if emit:
+                emit(event)
+            else:
+                print(json.dumps(event, ensure_ascii=False), flush=True)
+        time.sleep(interval)
+
+
+# ---------------------------------------------------------------------------
+# 非同期 API
+# ---------------------------------------------------------------------------
+#
+# サービスに組み込む場合の scan_target の非同期版:
+#   result = await scan_path(path, executor=pool, concurrency=8, deadline=30)
+# ファイルの読み込み・ZIP の展開は既定のスレッドプールで1つずつ進め、照合は
+# executor（省略時はイベントループの既定の executor）に最大 concurrency 件まで並行して
+# 投入する。結果の追加は投入順なので、検出の順序は逐次スキャンと同じになる。
+# 照合は CPU を使うため、GIL を避けて並列化するには ProcessPoolExecutor を渡す。
+
+ASYNC_CONCURRENCY = 4
+
+
+async def scan_path(
+    target,
+    *,
+    executor=None,
+    concurrency: int = ASYNC_CONCURRENCY,
+    deadline: Optional[float] = None,
+    cache: Optional[ScanCache] = None,
+    reporter=None,
+    max_file_size: int = MAX_FILE_SIZE,
+    max_per_rule: Optional[int] = None,
+) -> ScanResult:
+    """ディレクトリまたは .skill/.zip を非同期にスキャンする
+
+    deadline 秒を超えると asyncio.TimeoutError を送出する。タイムアウトとキャンセル時は
+    未着手の照合を取り消す（実行中の1ファイル分の照合は executor 側で完了まで走る）。
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be >= 1")
+    scan = _scan_path(
+        Path(target), executor, concurrency, cache, reporter, max_file_size, max_per_rule,
+    )
+    if deadline is None:
+        return await scan
+    return await asyncio.wait_for(scan, deadline)
+
+
+async def _scan_path(
+    target: Path,
+    executor,
+    concurrency: int,
+    cache: Optional[ScanCache],
+    reporter,
+    max_file_size: int,
+    max_per_rule: Optional[int],
+) -> ScanResult:
+    result = ScanResult(path=str(target), findings=FindingStore(max_per_rule))
+    if cache:
+        cache.reset_stats()
+
+    if target.is_file() and archive_kind(target.name):
+        if check_zip_file_size(target, result) is None:
+            return result
+        try:
+            await _scan_items_async(
+                iter_archive_file(target), result, executor, concurrency, cache, reporter,
+            )
+        except Exception as e:
+            record_zip_error(result, e)
+            return result
+    elif target.is_dir():
+        items = iter_directory_items(target, result, max_file_size)
+        await _scan_items_async(items, result, executor, concurrency, cache, reporter)
+    else:
+        return unsupported_target_result(target)
+
+    finish_result(result, cache)
+    return result
+
+
+async def _scan_items_async(
+    items: Iterable[tuple[str, object]],
+    result: ScanResult,
+    executor,
+    concurrency: int,
+    cache: Optional[ScanCache],
+    reporter,
+):
+    """(相対パス, 内容) を読みながら照合し、投入順に result へ追加する"""
+    loop = asyncio.get_running_loop()
+    iterator = iter(items)
+    # (相対パス, 内容, キャッシュに保存するか, 照合結果の future)
+    pending: deque = deque()
+
+    async def complete_oldest():
+        rel_path, data, uncached, future = pending.popleft()
+        findings, line_count = file_result = await future
+        if uncached and cache:
+            cache.store(data, rel_path, file_result)
+        result.file_count += 1
+        result.total_lines += line_count
+        result.add_findings(findings, reporter)
+
+    try:
+        while True:
+            # 読み込み（ZIP なら展開）はブロックするのでスレッドで進める
+            item = await loop.run_in_executor(None, next, iterator, None)
+            if item is None:
+                break
+            rel_path, data = item
+            cached = cache.lookup(data, rel_path) if cache else None
+            if cached is not None:
+                future = loop.create_future()
+                future.set_result(cached)
+            else:
+                future = loop.run_in_executor(executor, scan_blob, data, rel_path)
+            pending.append((rel_path, data, cached is None, future))
+            if len(pending) >= concurrency:
+                await complete_oldest()
+        while pending:
+            await complete_oldest()
+    finally:
+        for _, _, _, future in pending:
+            future.cancel()
+
+
+# ---------------------------------------------------------------------------
+# 常駐モード（Unix ドメインソケット）
+# ---------------------------------------------------------------------------
+#
+# プロトコルは1接続1リクエストの改行区切り JSON:
+#   → {"path": "...", "stamp": <skill_scanner.py の mtime_ns>}
+#   ← scan_target(path).to_dict()、または {"error": "..."}
+# stamp が常駐中のスクリプトと異なる場合（スキャナーが更新された）は "stale" を
+# 返して終了し、クライアントはプロセス内スキャンに切り替える。
+# クライアントは scan_client.py（ルールをコンパイルしないよう本モジュールを import しない）。
+
+SOCKET_FILENAME = "scanner.sock"
+MAX_REQUEST_BYTES = 64 * 1024
+# 要求の受信・応答の送信が止まった接続を切る時間（要求は順に処理するため、
+# 何も送らない接続が他のクライアントを待たせないようにする）
+CLIENT_IO_TIMEOUT = 2.0  # 秒
+
+
+def default_socket_path() -> Path:
+    return default_cache_dir() / SOCKET_FILENAME
+
+
+def scanner_stamp() -> int:
+    """このスクリプトの更新時刻。クライアントとの版の一致確認に使う"""
+    return Path(__file__).resolve().stat().st_mtime_ns
+
+
+def _socket_in_use(socket_path: Path) -> bool:
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(str(socket_path))
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+
+def handle_request(request: dict, cache: Optional[ScanCache], stamp: int) -> tuple[dict, bool]:
+    """1リクエストを処理し、(応答, 終了するか) を返す"""
+    if request.get("stamp") not in (None, stamp):
+        return {"error": "stale"}, True
+    if request.get("command") == "shutdown":
+        return {"ok": True}, True
+    path = request.get("path")
+    if not isinstance(path, str) or not path:
+        return {"error": "path を指定してください"}, False
+    result = scan_target(Path(path).expanduser().resolve(), cache=cache)
+    return result.to_dict(), False
+
+
+def serve(socket_path: Path, cache: Optional[ScanCache] = None):
+    """ソケットでスキャン要求を待ち受ける（コンパイル済みルールとキャッシュを保持したまま）
+
+    要求は1つずつ順に処理する（スキャンは CPU 律速で、キャッシュの SQLite
+    接続もスレッド間で共有しない）。送受信が CLIENT_IO_TIMEOUT 秒止まった
+    接続は応答せずに切り、次の要求に進む。
+    """
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    if socket_path.exists():
+        if _socket_in_use(socket_path):
+            raise OSError(f"既に起動しています: {socket_path}")
+        socket_path.unlink()  # 前回の異常終了で残ったソケット
+
+    stamp = scanner_stamp()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # 他のユーザーから任意のパスをスキャンさせないよう、所有者のみ接続可能にする
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(str(socket_path))
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+        print(f"待ち受け中: {socket_path}", file=sys.stderr, flush=True)
+        while True:
+            conn, _ = server.accept()
+            conn.settimeout(CLIENT_IO_TIMEOUT)
+            with conn, conn.makefile("rwb") as stream:
+                try:
+                    line = stream.readline(MAX_REQUEST_BYTES)
+                except OSError:
+                    continue  # 要求を送らないまま止まった（socket.timeout）か切断された
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("JSON オブジェクトではありません")
+                except ValueError as e:
+                    request, response, stop = None, {"error": f"不正なリクエスト: {e}"}, False
+                if request is not None:
+                    try:
+                        response, stop = handle_request(request, cache, stamp)
+                    except Exception as e:
+                        # 1つの要求の失敗（読めないパス、壊れたアーカイブなど）で常駐を止めない
+                        response, stop = {"error": f"スキャンに失敗しました: {e}"}, False
+                try:
+                    stream.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+                    stream.flush()
+                except OSError:
+                    pass  # クライアントが先に切断した
+            if cache:
+                # 他のプロセス（CLI）からも結果を使えるよう、応答後に要求ごとに書き込む
+                cache.flush()
+            if stop:
+                return
+    finally:
+        server.close()
+        try:
+            socket_path.unlink()
+        except OSError:
+            pass
+
+
+# ---------------------------------------------------------------------------
+# メイン
+# ---------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Claude Code スキルの安全性を検査する",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__,
+    )
+    parser.add_argument(
+        "path",
+        nargs="*",
+        help="スキャン対象のパス（ディレクトリ、.skill/.zip または .tar/.tar.gz/.tgz）。--watch では省略時 ~/.claude/skills。"
+        "--batch では複数指定可",
+    )
+    parser.add_argument("--json", action="store_true", help="JSON出力のみ")
+    parser.add_argument(
+        "--stream",
+        choices=sorted(REPORTERS),
+        help="検出を保持せず見つかった順に出力する（ndjson: 1件1行、sarif: SARIF 2.1.0）",
+    )
+    parser.add_argument(
+        "--install",
+        action="store_true",
+        help="スキャン後、SAFEの場合のみ ~/.claude/skills/ にインストール",
+    )
+    parser.add_argument(
+        "--rollback",
+        metavar="NAME",
+        help="--install で置き換えたスキルを直前のバージョンに戻す（もう一度実行すると元に戻る）",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="並列スキャンのプロセス数（0 で CPU 数、既定は 1 = 逐次）",
+    )
+    parser.add_argument("--no-cache", action="store_true", help="スキャン結果キャッシュを使わない")
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        help="スキャン結果キャッシュの保存先（既定: ~/.cache/skill-security-checker）",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="ディレクトリを監視し、変更されたファイルだけ再スキャンして判定の変化を出力",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=WATCH_INTERVAL,
+        metavar="SEC",
+        help=f"--watch のポーリング間隔（秒、既定 {WATCH_INTERVAL}）",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="複数のスキルを1プロセスでスキャンし、1スキル1行の JSON（NDJSON）と集計行を出力",
+    )
+    parser.add_argument(
+        "--paths-from",
+        metavar="FILE",
+        help="--batch の対象パスを1行1パスで読むファイル（- で標準入力）",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="常駐してソケット経由のスキャン要求に応える（クライアントは scan_client.py）",
+    )
+    parser.add_argument(
+        "--socket",
+        metavar="PATH",
+        help=f"--serve のソケットのパス（既定: キャッシュディレクトリの {SOCKET_FILENAME}）",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="ルールごとの評価時間・評価量・マッチ数を集計して表示（キャッシュを使わず逐次スキャン）",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=float,
+        default=MAX_FILE_SIZE / 1024 / 1024,
+        metavar="MB",
+        help=f"これより大きいファイルはスキャンせずエラーとして報告（既定 {MAX_FILE_SIZE // 1024 // 1024}MB）",
+    )
+    parser.add_argument(
+        "--git-history",
+        action="store_true",
+        help="Git リポジトリの全履歴（到達可能な全コミット）のファイルをスキャンする",
+    )
+    parser.add_argument(
+        "--max-per-rule",
+        type=int,
+        metavar="N",
+        help="同じファイルの同じルールの検出は最初の N 件だけ出力し、残りは件数のみ報告（既定は無制限）",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="危険の大きいファイルから順にスキャンし、HIGH 以上の検出で DANGER が確定したら打ち切る",
+    )
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        metavar="SEC",
+        help="スキャン時間の上限。超えたら打ち切り、部分的な結果として報告する",
+    )
+    parser.add_argument(
+        "--max-total-size",
+        type=float,
+        metavar="MB",
+        help="読み込むファイルの合計サイズの上限。超える分はスキャンせず、部分的な結果として報告する",
+    )
+    parser.add_argument(
+        "--max-files",
+        type=int,
+        metavar="N",
+        help="スキャンするファイル数の上限。超える分はスキャンせず、部分的な結果として報告する",
+    )
+    parser.add_argument(
+        "--ignore-file",
+        action="append",
+        metavar="FILE",
+        help=".gitignore 形式で除外するパスを書いたファイル（複数指定可。スキャン対象の .gitignore は読まない）",
+    )
+    parser.add_argument(
+        "--skip-dir",
+        action="append",
+        metavar="NAME",
+        help=f"走査しないディレクトリ名を追加する（複数指定可。既定: {', '.join(sorted(SKIP_DIRS))}）",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="フェーズごとの所要時間とファイル数・読み込み量・検出件数を JSON 出力の metrics に加える",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="PATH",
+        help="--metrics の内容を OpenMetrics のテキスト形式でこのファイルに書く（--metrics を含む）",
+    )
+    args = parser.parse_args()
+    max_file_size = int(args.max_file_size * 1024 * 1024)
+    if args.max_per_rule is not None and args.max_per_rule < 1:
+        parser.error("--max-per-rule は 1 以上を指定してください")
+    for option, value in (
+        ("--max-seconds", args.max_seconds),
+        ("--max-total-size", args.max_total_size),
+        ("--max-files", args.max_files),
+    ):
+        if value is not None and value <= 0:
+            parser.error(f"{option} は正の値を指定してください")
+    limits = None
+    if args.fail_fast or args.max_seconds or args.max_total_size or args.max_files:
+        limits = ScanLimits(
+            fail_fast=args.fail_fast,
+            max_seconds=args.max_seconds,
+            max_bytes=int(args.max_total_size * 1024 * 1024) if args.max_total_size else None,
+            max_files=args.max_files,
+        )
+    ignore = None
+    if args.ignore_file or args.skip_dir:
+        try:
+            ignore = IgnoreRules.from_files(
+                [Path(path).expanduser() for path in args.ignore_file or ()],
+                SKIP_DIRS | set(args.skip_dir or ()),
+            )
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"エラー: 除外パターンのファイルを読めません: {e}", file=sys.stderr)
+            sys.exit(2)
+    metrics = ScanMetrics() if args.metrics or args.metrics_file else None
+    metrics_file = Path(args.metrics_file).expanduser() if args.metrics_file else None
+
+    if args.rollback is not None:
+        if args.path or args.install or args.watch or args.batch or args.serve:
+            parser.error("--rollback は他の操作と同時に指定できません")
+        try:
+            dest = rollback_skill(args.rollback)
+        except (OSError, ValueError) as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            sys.exit(2)
+        print(f"↩️  直前のバージョンに戻しました: {dest}")
+        sys.exit(0)
+
+    if args.serve:
+        if args.path or args.install or args.watch or args.batch or limits or ignore or metrics:
+            parser.error(
+                "--serve は path / --install / --watch / --batch / --fail-fast / --max-* / "
+                "--ignore-file / --skip-dir / --metrics と同時に指定できません"
+            )
+        if not hasattr(socket, "AF_UNIX"):
+            print("エラー: この環境は Unix ドメインソケットに対応していません", file=sys.stderr)
+            sys.exit(2)
+        cache = None
+        if not args.no_cache:
+            cache = open_cache(Path(args.cache_dir).expanduser() if args.cache_dir else None)
+        socket_path = Path(args.socket).expanduser() if args.socket else default_socket_path()
+        try:
+            serve(socket_path, cache)
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            sys.exit(2)
+        finally:
+            if cache:
+                cache.close()
+        sys.exit(0)
+
+    if args.batch:
+        if args.install or args.watch or args.git_history:
+            parser.error("--batch は --install / --watch / --git-history と同時に指定できません")
+        if not args.path and args.paths_from is None:
+            parser.error("--batch には path または --paths-from を指定してください")
+        cache = None
+        if not args.no_cache:
+            cache = open_cache(Path(args.cache_dir).expanduser() if args.cache_dir else None)
+        try:
+            summary = run_batch(
+                iter_batch_paths(args.path, args.paths_from), args.jobs, cache,
+                max_file_size=max_file_size, max_per_rule=args.max_per_rule, limits=limits,
+                ignore=ignore, metrics=metrics,
+            )
+        finally:
+            if cache:
+                cache.close()
+        if metrics_file:
+            save_metrics_file(metrics_file, metrics)
+        sys.exit(VERDICT_ORDER[summary["verdict"]])
+
+    if args.git_history and (args.install or args.watch):
+        parser.error("--git-history は --install / --watch と同時に指定できません")
+    if args.git_history and ignore:
+        parser.error("--git-history は --ignore-file / --skip-dir と同時に指定できません")
+    if args.install and ignore:
+        # 除外したファイルもインストールされるため、スキャンから外させない
+        parser.error("--install は --ignore-file / --skip-dir と同時に指定できません")
+    if len(args.path) > 1:
+        parser.error("複数のパスを指定する場合は --batch を使用してください")
+    if not args.path and not args.watch:
+        parser.error("path を指定してください")
+    target = Path(args.path[0]).expanduser().resolve() if args.path else SKILLS_DIR
+
+    if args.watch:
+        if args.install:
+            parser.error("--watch と --install は同時に指定できません")
+        if limits:
+            parser.error("--watch と --fail-fast / --max-* は同時に指定できません")
+        if metrics:
+            parser.error("--watch と --metrics / --metrics-file は同時に指定できません")
+        if not target.is_dir():
+            print(f"エラー: ディレクトリが見つかりません: {target}", file=sys.stderr)
+            sys.exit(2)
+        try:
+            watch_directory(target, args.interval, ignore=ignore, max_file_size=max_file_size)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if not target.exists():
+        print(f"エラー: パスが見つかりません: {target}", file=sys.stderr)
+        sys.exit(2)
+
+    if not (target.is_dir() or (target.is_file() and archive_kind(target.name))):
+        print(f"エラー: サポートされていない形式です: {target}", file=sys.stderr)
+        sys.exit(2)
+    if args.git_history and not target.is_dir():
+        print(f"エラー: --git-history にはリポジトリのディレクトリを指定してください: {target}", file=sys.stderr)
+        sys.exit(2)
+
+    cache = None
+    if not args.no_cache and not args.profile:
+        cache = open_cache(Path(args.cache_dir).expanduser() if args.cache_dir else None)
+    reporter = REPORTERS[args.stream](sys.stdout) if args.stream else None
+    profiler = ScanProfiler() if args.profile else None
+    staged = None
+    try:
+        if args.install:
+            # 1度だけ展開したファイルをスキャンし、そのままインストールする
+            result, staged = stage_skill(
+                target, jobs=args.jobs, cache=cache, reporter=reporter,
+                max_file_size=max_file_size, profiler=profiler, max_per_rule=args.max_per_rule,
+                limits=limits, metrics=metrics,
+            )
+        elif args.git_history:
+            result = scan_git_history(
+                target, jobs=args.jobs, cache=cache, reporter=reporter,
+                max_file_size=max_file_size, profiler=profiler, max_per_rule=args.max_per_rule,
+                limits=limits, metrics=metrics,
+            )
         else:
-            print(f"\n🚨 DANGER検出のためインストールを拒否しました。")
-            print(f"   このスキルのインストールは推奨しません。")
+            result = scan_target(
+                target, jobs=args.jobs, cache=cache, reporter=reporter,
+                max_file_size=max_file_size, profiler=profiler, max_per_rule=args.max_per_rule,
+                limits=limits, ignore=ignore, metrics=metrics,
+            )
+    finally:
+        if cache:
+            cache.close()
+
+    # JSON の metrics には、その JSON 自体を書き出す時間は含まない（--metrics-file には含む）
+    report_started = time.perf_counter()
+    if metrics:
+        metrics.add_result(result)
+    try:
+        if reporter:
+            if metrics:
+                result.metrics = metrics.to_dict()
+            reporter.finish(result)
+            if result.profile:
+                print(format_profile(result.profile), file=sys.stderr)
+        elif args.json:
+            if metrics:
+                result.metrics = metrics.to_dict()
+            print(json.dumps(result.to_dict(), ensure_ascii=False, indent=2))
+        else:
+            report = format_report(result)
+            if metrics:
+                metrics.add("report", time.perf_counter() - report_started)
+                report_started = time.perf_counter()
+                result.metrics = metrics.to_dict()
+            print(report)
+            if result.profile:
+                print(format_profile(result.profile))
+            # JSON も stderr に出力（Claude解析用）
+            print(json.dumps(result.to_dict(), ensure_ascii=False, indent=2), file=sys.stderr)
+
+        # --install モード（ストリーミング出力中は stdout を汚さないよう stderr に出す）
+        message_out = sys.stderr if reporter else sys.stdout
+        if metrics:
+            metrics.add("report", time.perf_counter() - report_started)
+        if args.install:
+            install_scanned_skill(result, staged, message_out)
+    finally:
+        if staged:
+            discard_staging(staged)
+    if metrics_file:
+        save_metrics_file(metrics_file, metrics)
 
     # 終了コード
     if result.verdict == "SAFE":